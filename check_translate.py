@@ -1,12 +1,24 @@
 """Check for any missing/additional translations in the translated XML file."""
 
-import re
+from __future__ import annotations
+
 import argparse
 import sys
+from collections import Counter
 from pathlib import Path
 from prompt_toolkit import prompt
 from prompt_toolkit.completion import PathCompleter
 
+from line_lexer import LineLexer, lex_file
+
+# kinds of problems found by the checker itself, besides the lexer's (line_lexer.py)
+EMPTY_LINE = "empty_line"
+OUTSIDE_CHUNK = "outside_chunk"
+WRONG_CHUNK = "wrong_chunk"
+MISSING_IDS = "missing_ids"
+# kinds that are not tag errors: the file can still be read as it is
+NOT_TAG_ERRORS = {EMPTY_LINE, WRONG_CHUNK, MISSING_IDS}
+
 
 def get_validated_input(message: str, validator=None, completer=None) -> str:
     """Get input with validation and completion"""
@@ -22,94 +34,185 @@ def get_validated_input(message: str, validator=None, completer=None) -> str:
         sys.exit(0)
 
 
+class XmlScan:
+    """What one pass over a chunks or translation file found."""
+
+    def __init__(self):
+        self.id_counts = Counter()
+        self.chunk_of = {}  # line id -> chunk it first appeared in
+        self.has_chunks = False
+        self.problems = []  # (chunk or None, line id or None, kind, message)
+
+    @property
+    def ids(self) -> set:
+        return set(self.id_counts)
+
+    @property
+    def duplicates(self) -> dict:
+        return {id_: count for id_, count in self.id_counts.items() if count > 1}
+
+
+def scan_xml(xml_file: str) -> XmlScan:
+    """Read the file once with the shared lexer, counting IDs and checking the tags.
+
+    Reports <line> tags without </line>, stray </line>, empty lines, unbalanced
+    <chunkN> tags and IDs outside any chunk.
+    """
+    scan = XmlScan()
+    outside = []
+    lexer = LineLexer()
+    for chunk, id_, text, _ in lex_file(xml_file, lexer):
+        scan.id_counts[id_] += 1
+        scan.chunk_of.setdefault(id_, chunk)
+        if chunk is None:
+            outside.append(id_)
+        if not text:
+            scan.problems.append((chunk, id_, EMPTY_LINE, f"ID {id_}: empty line"))
+    scan.problems.extend(lexer.problems)
+    scan.has_chunks = lexer.has_chunks
+    if scan.has_chunks and outside:
+        scan.problems.append(
+            (None, None, OUTSIDE_CHUNK, f"IDs outside any <chunk>: {outside}")
+        )
+    return scan
+
+
 def extract_ids_from_file(xml_file: str) -> tuple[set, dict]:
     """
     Extract all ID numbers from the XML file.
     Returns a tuple of (unique_ids, duplicate_ids_dict)
     """
     try:
-        with open(xml_file, "r", encoding="utf-8") as f:
-            content = f.read()
-
-        # Find all instances of <line id="number"> in the text
-        id_pattern = r'<line id="(\d+)">'
-        all_ids = [int(id_) for id_ in re.findall(id_pattern, content)]
-        unique_ids = set(all_ids)
-
-        # Find duplicates
-        duplicates = {}
-        for id_ in all_ids:
-            if all_ids.count(id_) > 1:
-                duplicates[id_] = all_ids.count(id_)
-
-        return unique_ids, duplicates
+        scan = scan_xml(xml_file)
     except Exception as e:
         print(f"Error reading source file: {e}")
         return set(), {}
+    return scan.ids, scan.duplicates
 
 
-def check_translation_completeness(
-    xml_source_file: str, xml_translated_file: str
-) -> bool:
+def compare_scans(source: XmlScan, translated: XmlScan) -> dict:
+    """Compare a translation's scan with its source's; JSON-friendly result.
+
+    `diagnostics` is a list of [chunk, kind, message] (kinds: the constants
+    above and in line_lexer.py); problems in a translation without chunk tags
+    are put under the chunk the ID belongs to in the source.
     """
-    Check if all IDs from XML chunks exist in the English translation.
-    Also checks for duplicate IDs in both files.
-    Returns True if all IDs are present and no duplicates found, False otherwise.
+    missing_ids = source.ids - translated.ids
+    diagnostics = []
+    tag_errors = False
+    for chunk, id_, kind, message in translated.problems:
+        if chunk is None and id_ is not None:
+            chunk = source.chunk_of.get(id_)
+        diagnostics.append([chunk, kind, message])
+        tag_errors = tag_errors or kind not in NOT_TAG_ERRORS
+    for id_ in sorted(translated.ids & source.ids):
+        expected, found = source.chunk_of[id_], translated.chunk_of[id_]
+        if found is not None and expected is not None and found != expected:
+            diagnostics.append([found, WRONG_CHUNK, f"ID {id_} belongs to chunk {expected}"])
+    missing_by_chunk = {}
+    for id_ in sorted(missing_ids):
+        missing_by_chunk.setdefault(source.chunk_of[id_], []).append(id_)
+    for chunk, ids in missing_by_chunk.items():
+        diagnostics.append([chunk, MISSING_IDS, f"missing {len(ids)} IDs: {ids}"])
+    diagnostics.sort(key=lambda d: (d[0] is None, d[0] or 0))
+
+    result = {
+        "ids": len(source.ids),
+        "source_duplicates": sorted(source.duplicates.items()),
+        "duplicates": sorted(translated.duplicates.items()),
+        "missing": sorted(missing_ids),
+        "extra": sorted(translated.ids - source.ids),
+        "diagnostics": diagnostics,
+        "tag_errors": tag_errors,
+    }
+    result["ok"] = bool(source.ids) and not (
+        source.duplicates or translated.duplicates or missing_ids or tag_errors
+    )
+    return result
+
+
+def print_check_result(
+    result: dict, xml_source_file: str, xml_translated_file: str, scope: str = ""
+):
+    """Print a compare_scans() result the way check_translate.py always has.
+
+    `scope` says what was checked when it is not the whole file (e.g. " in 3 chunks").
     """
-    if not Path(xml_translated_file).exists():
-        print(f"Error: Translation file not found: {xml_translated_file}")
-        return False
-
-    # sometimes AI forgets to close the </line> tag
-    # fix_content_before_extract(xml_translated_file)
-
-    # better fix it manually :)
-
-    source_xml_ids, source_duplicates = extract_ids_from_file(xml_source_file)
-    translated_ids, translated_duplicates = extract_ids_from_file(xml_translated_file)
-
-    if not source_xml_ids:
+    if result.get("error"):
+        print(f"Error: {result['error']}")
+        return
+    if not result["ids"]:
         print("Error: No IDs found in source file or file couldn't be read")
-        return False
-
-    has_errors = False
+        return
 
     # Check for duplicates in source file
-    if source_duplicates:
+    if result["source_duplicates"]:
         print(f"❌ {xml_source_file}: Found duplicate IDs in source file:")
-        for id_, count in sorted(source_duplicates.items()):
+        for id_, count in result["source_duplicates"]:
             print(f"  ID {id_} appears {count} times")
-        has_errors = True
 
     # Check for duplicates in translated file
-    if translated_duplicates:
+    if result["duplicates"]:
         print(f"❌ {xml_translated_file}: Found duplicate IDs in translation file:")
-        for id_, count in sorted(translated_duplicates.items()):
+        for id_, count in result["duplicates"]:
             print(f"  ID {id_} appears {count} times")
-        has_errors = True
 
-    # Find missing IDs
-    missing_ids = source_xml_ids - translated_ids
-    if missing_ids:
+    # Find missing IDs (listed per chunk below)
+    if result["missing"]:
         print(
-            f"❌ {xml_translated_file}: Missing translations for {len(missing_ids)} lines:"
+            f"❌ {xml_translated_file}: Missing translations for {len(result['missing'])} lines"
         )
-        print(f"Missing IDs: {sorted(missing_ids)}")
-        has_errors = True
 
     # Find extra IDs in translation that don't exist in source
-    extra_ids = translated_ids - source_xml_ids
-    if extra_ids:
+    if result["extra"]:
         print(
-            f"⚠️ {xml_translated_file}: warning found: {len(extra_ids)} extra IDs in translation file:"
+            f"⚠️ {xml_translated_file}: warning found: {len(result['extra'])} extra IDs in translation file:"
         )
-        print(f"Extra IDs: {sorted(extra_ids)}")
+        print(f"Extra IDs: {result['extra']}")
+
+    if result["diagnostics"]:
+        errors = result["tag_errors"] or result["missing"]
+        print(f"{'❌' if errors else '⚠️'} {xml_translated_file}: per chunk:")
+        for chunk, _, message in result["diagnostics"]:
+            name = f"Chunk {chunk}" if chunk is not None else "No chunk"
+            print(f"  {name}: {message}")
+
+    if result["ok"]:
+        print(f"✅ Found {result['ids']} line ids == with the source file{scope}")
+
+
+def check_translation(
+    xml_source_file: str, xml_translated_file: str, source: XmlScan | None = None
+) -> dict:
+    """compare_scans() of the two files; pass `source` to reuse a scanned source."""
+    if not Path(xml_translated_file).exists():
+        return {"ok": False, "error": f"Translation file not found: {xml_translated_file}"}
+    try:
+        if source is None:
+            source = scan_xml(xml_source_file)
+        translated = scan_xml(xml_translated_file)
+    except Exception as e:
+        return {"ok": False, "error": f"Error reading file: {e}"}
+    return compare_scans(source, translated)
+
+
+def check_translation_completeness(
+    xml_source_file: str, xml_translated_file: str
+) -> bool:
+    """
+    Check if all IDs from XML chunks exist in the English translation.
+    Also checks for duplicate IDs in both files, unclosed/stray </line> tags,
+    empty lines and IDs found in another chunk than in the source.
+    Returns True if all IDs are present and no duplicates or broken tags found, False otherwise.
+    """
+    # sometimes AI forgets to close the </line> tag
+    # fix_content_before_extract(xml_translated_file)
 
-    if not has_errors:
-        print(f"✅ Found {len(source_xml_ids)} line ids == with the source file")
-        return True
+    # better fix it manually :)
 
-    return False
+    result = check_translation(xml_source_file, xml_translated_file)
+    print_check_result(result, xml_source_file, xml_translated_file)
+    return result["ok"]
 
 
 # def fix_content_before_extract(inputfile: str) -> bool:
@@ -1,9 +1,40 @@
+"""Check the translations of every chunk file in a directory.
+
+Each source is parsed once and all its `_translated_N.xml` (or only `-i N`) are
+checked against it; with `-j 8` several sources are checked in parallel. Pairs
+whose files did not change since the last run are taken from a cache
+(`.check_translate_cache.json` in the directory; a change to the checker's
+code invalidates it), and `--report` writes the
+results as JSON:
+
+python3 check_translate_dir.py -d your_chunks_directory -j 8 --report check_report.json
+"""
+
+from __future__ import annotations
+
 import argparse
+import hashlib
+import json
+import re
+import sys
+import time
+from concurrent.futures import ProcessPoolExecutor
 from pathlib import Path
 
 # from prompt_toolkit import prompt
 from prompt_toolkit.completion import PathCompleter
-from check_translate import check_translation_completeness, get_validated_input
+
+import check_translate
+import line_lexer
+from check_translate import (
+    check_translation,
+    get_validated_input,
+    print_check_result,
+    scan_xml,
+)
+from section_cache import code_version
+
+CACHE_FILE = ".check_translate_cache.json"
 
 
 def validate_directory(path: str) -> bool:
@@ -15,28 +46,187 @@ def validate_directory(path: str) -> bool:
         return False
 
 
-def process_directory(directory: Path, source_pattern: str, index: int) -> bool:
+def translated_files_for(source_file: Path, index: int | None) -> list[Path]:
+    """`_translated_{index}.xml` of the source, or all of them if index is None."""
+    if index is not None:
+        translated_file = (
+            source_file.stem.replace("_chunks", "") + f"_chunks_translated_{index}.xml"
+        )
+        return [source_file.parent / translated_file]
+    pattern = re.compile(re.escape(source_file.stem) + r"_translated_(\d+)\.xml$")
+    found = []
+    for path in source_file.parent.glob(f"{source_file.stem}_translated_*.xml"):
+        match = pattern.match(path.name)
+        if match:
+            found.append((int(match.group(1)), path))
+    return [path for _, path in sorted(found)]
+
+
+def file_state(path: Path, previous: dict | None) -> dict | None:
+    """Size/mtime and sha256 of a file; the hash is reused while size/mtime match."""
+    try:
+        stat = path.stat()
+    except OSError:
+        return None
+    signature = [stat.st_size, stat.st_mtime_ns]
+    if previous and previous["signature"] == signature:
+        return previous
+    digest = hashlib.sha256()
+    with open(path, "rb") as f:
+        for block in iter(lambda: f.read(1 << 20), b""):
+            digest.update(block)
+    return {"signature": signature, "sha256": digest.hexdigest()}
+
+
+def same_content(a: dict | None, b: dict | None) -> bool:
+    return a is not None and b is not None and a["sha256"] == b["sha256"]
+
+
+def check_source(source_file: Path, translated_files: list[Path], cached: dict) -> list[dict]:
+    """Check all translations of one source, parsing the source at most once.
+
+    `cached` maps translation paths to their cache entries; returns one entry
+    per translation ({"source", "translation", "result", "cached"}).
+    """
+    source = None
+    previous = next(iter(cached.values()), {}).get("source")
+    source_state = file_state(source_file, previous)
+    entries = []
+    for translated_file in translated_files:
+        entry = cached.get(str(translated_file))
+        translation_state = file_state(
+            translated_file, entry["translation"] if entry else None
+        )
+        if (
+            entry
+            and same_content(entry["source"], source_state)
+            and same_content(entry["translation"], translation_state)
+        ):
+            entries.append({**entry, "source": source_state, "translation": translation_state, "cached": True})
+            continue
+        if source is None:
+            source = scan_xml(str(source_file))
+        entries.append(
+            {
+                "source": source_state,
+                "translation": translation_state,
+                "result": check_translation(str(source_file), str(translated_file), source),
+                "cached": False,
+            }
+        )
+    return entries
+
+
+def load_cache(cache_file: Path | None) -> dict:
+    if cache_file is None or not cache_file.exists():
+        return {}
+    try:
+        with open(cache_file, "r", encoding="utf-8") as f:
+            return json.load(f)
+    except (OSError, ValueError) as e:
+        print(f"Ignoring unreadable cache {cache_file}: {e}")
+        return {}
+
+
+def save_cache(cache_file: Path, cache: dict):
+    tmp_file = cache_file.with_name(cache_file.name + ".tmp")
+    with open(tmp_file, "w", encoding="utf-8") as f:
+        json.dump(cache, f)
+    tmp_file.replace(cache_file)
+
+
+def process_directory(
+    directory: Path,
+    source_pattern: str,
+    index: int | None,
+    jobs: int = 1,
+    cache_file: Path | None = None,
+    report_file: Path | None = None,
+) -> bool:
     """Process all matching files in directory"""
-    success = True
     source_files = sorted(list(directory.glob(source_pattern)))
 
     if not source_files:
         print(f"No files matching pattern '{source_pattern}' found in {directory}")
         return False
 
-    for source_file in sorted(source_files):
-        translated_file = (
-            source_file.stem.replace("_chunks", "") + f"_chunks_translated_{index}.xml"
-        )
-        translated_path = source_file.parent / translated_file
+    start_time = time.time()
+    cache = load_cache(cache_file)
+    # results of another version of the checker are not reused
+    version = code_version(check_translate, line_lexer)
+    tasks = []
+    for source_file in source_files:
+        translated_files = translated_files_for(source_file, index)
+        cached = {
+            str(t): cache[str(t)]
+            for t in translated_files
+            if str(t) in cache
+            and cache[str(t)].get("source_file") == str(source_file)
+            and cache[str(t)].get("version") == version
+        }
+        tasks.append((source_file, translated_files, cached))
 
-        print(f"\nProcessing pair:")
-        print(f"Source: {source_file}")
-        print(f"Translation: {translated_path}")
+    if jobs > 1:
+        with ProcessPoolExecutor(max_workers=jobs) as executor:
+            results = list(executor.map(check_source, *zip(*tasks)))
+    else:
+        results = [check_source(*task) for task in tasks]
 
-        if not check_translation_completeness(str(source_file), str(translated_path)):
-            success = False
+    success = True
+    pairs = []
+    unchanged = 0
+    for (source_file, translated_files, _), entries in zip(tasks, results):
+        if not translated_files:
+            print(f"\nNo translations found for {source_file}")
+            continue
+        for translated_path, entry in zip(translated_files, entries):
+            result = entry["result"]
+            print(f"\nProcessing pair:")
+            print(f"Source: {source_file}")
+            print(f"Translation: {translated_path}{' (unchanged)' if entry['cached'] else ''}")
+            print_check_result(result, str(source_file), str(translated_path))
+            success = success and result["ok"]
+            unchanged += entry["cached"]
+            pairs.append(
+                {
+                    "source": str(source_file),
+                    "translation": str(translated_path),
+                    "cached": entry["cached"],
+                    **result,
+                }
+            )
+            if entry["translation"] is not None and entry["source"] is not None:
+                cache[str(translated_path)] = {
+                    "version": version,
+                    "source_file": str(source_file),
+                    "source": entry["source"],
+                    "translation": entry["translation"],
+                    "result": result,
+                }
 
+    failed = sum(not pair["ok"] for pair in pairs)
+    print(
+        f"\nChecked {len(pairs)} translations ({unchanged} unchanged) of "
+        f"{len(source_files)} sources in {time.time() - start_time:.1f}s: "
+        f"{failed} with problems"
+    )
+    if cache_file is not None:
+        save_cache(cache_file, cache)
+    if report_file is not None:
+        with open(report_file, "w", encoding="utf-8") as f:
+            json.dump(
+                {
+                    "directory": str(directory),
+                    "checked_at": time.strftime("%Y-%m-%d %H:%M:%S"),
+                    "ok": success,
+                    "failed": failed,
+                    "pairs": pairs,
+                },
+                f,
+                ensure_ascii=False,
+                indent=2,
+            )
+        print(f"Report saved to {report_file}")
     return success
 
 
@@ -58,14 +248,27 @@ def main():
         "-i",
         "--index",
         type=int,
-        help="Translation index number (used in translated filename)",
+        help="Translation index number (used in translated filename; default: all translations)",
+    )
+    parser.add_argument(
+        "-j", "--jobs", type=int, default=1, help="Sources checked in parallel (default: 1)"
+    )
+    parser.add_argument(
+        "--cache",
+        default=None,
+        help=f"Cache of unchanged pairs (default: {CACHE_FILE} in the directory)",
+    )
+    parser.add_argument(
+        "--no-cache", action="store_true", help="Check every pair again"
     )
+    parser.add_argument("--report", default=None, help="Write the results to this JSON file")
 
     args = parser.parse_args()
 
     try:
-        # Interactive mode if no arguments provided
-        if len(sys.argv) == 1 or (not args.directory or args.index is None):
+        # Interactive mode if no directory given
+        index = args.index
+        if not args.directory:
             print("Interactive mode - Use path completion with Tab key")
             while True:
                 directory = get_validated_input(
@@ -79,24 +282,32 @@ def main():
                 while True:
                     try:
                         index_input = get_validated_input(
-                            "Enter translation index number: "
+                            "Enter translation index number (empty for all): "
                         )
-                        index = int(index_input)
+                        index = int(index_input) if index_input else None
                         break
                     except ValueError:
                         print("Please enter a valid number")
-            else:
-                index = args.index
         else:
             directory = args.directory
-            index = args.index
 
         directory_path = Path(directory)
         if not directory_path.exists() or not directory_path.is_dir():
             print(f"Error: Invalid directory path: {directory}")
             return 1
 
-        return 0 if process_directory(directory_path, args.source_pattern, index) else 1
+        cache_file = None
+        if not args.no_cache:
+            cache_file = Path(args.cache) if args.cache else directory_path / CACHE_FILE
+        ok = process_directory(
+            directory_path,
+            args.source_pattern,
+            index,
+            max(1, args.jobs),
+            cache_file,
+            Path(args.report) if args.report else None,
+        )
+        return 0 if ok else 1
 
     except (EOFError, KeyboardInterrupt):
         print("\nOperation cancelled by user")
@@ -107,6 +318,4 @@ def main():
 
 
 if __name__ == "__main__":
-    import sys
-
-    exit(main())
+    sys.exit(main())
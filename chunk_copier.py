@@ -2,12 +2,14 @@
 
 import pyperclip
 import webbrowser
-import re
 from typing import List, Tuple
 from prompt_toolkit import prompt
 from prompt_toolkit.completion import PathCompleter
 from prompt_toolkit.validation import Validator, ValidationError
 
+from line_index import LineIndex
+from line_lexer import LineLexer, lex_text
+
 
 def load_file_content(file_path: str) -> str:
     try:
@@ -20,20 +22,20 @@ def load_file_content(file_path: str) -> str:
 
 def extract_chunks(content: str) -> List[Tuple[int, str]]:
     chunks = []
-    # Updated pattern to match XML-style chunks
-    pattern = r"<chunk(\d+)>([\s\S]*?)</chunk\1>"
-    matches = re.finditer(pattern, content, re.DOTALL)
-
-    for match in matches:
-        chunk_num = int(match.group(1))
-        chunk_content = match.group(2).strip()
+    # chunk boundaries from the shared lexer (tolerates a missing </chunkN>)
+    lexer = LineLexer()
+    data = content.encode("utf-8")
+    lexer.feed(data)
+    lexer.close()
+
+    for chunk_num, start, end in lexer.chunk_spans:
+        chunk_content = data[start:end].decode("utf-8").strip()
         chunks.append((chunk_num, chunk_content))
 
     # Debug information
     if not chunks:
         print("Debug: No chunks found. First 200 characters of content:")
         print(content[:200])
-        print("\nPattern used:", pattern)
     else:
         print(f"Debug: Found {len(chunks)} chunks")
 
@@ -44,19 +46,15 @@ def chunk_info(chunk_text):
     """
     Extracts the first and last line IDs from a chunk of XML-like text.
     """
-    # Find all <line id="..."> tags
-    matches = re.findall(r'<line id="(\d+)">', chunk_text)
+    ids = [record.id for record in lex_text(chunk_text)]
 
     total_lines = len(chunk_text.splitlines())
-    if matches:
-        first_id = int(matches[0])
-        last_id = int(matches[-1])
-        total_id = len(matches)
+    if ids:
         return {
-            "first_id": first_id,
-            "last_id": last_id,
+            "first_id": ids[0],
+            "last_id": ids[-1],
             "total_lines": total_lines,
-            "total_id": total_id,
+            "total_id": len(ids),
         }
 
     return {
@@ -69,25 +67,26 @@ def chunk_info(chunk_text):
 
 def copy_chunks(
     system_prompt: str,
-    chunks: List[Tuple[int, str]],
+    index: LineIndex,
     start_chunk: int,
     num_chunks: int,
     website_url: str,
 ) -> int:
-    if not chunks:
+    chunk_numbers = sorted(index.chunk_numbers)
+    if not chunk_numbers:
         print("No chunks found in the file!")
         return 0
 
     # Find the starting point
     start_idx = 0
-    for idx, (chunk_num, _) in enumerate(chunks):
+    for idx, chunk_num in enumerate(chunk_numbers):
         if chunk_num >= start_chunk:
             start_idx = idx
             break
 
-    # Get the chunks to copy
-    end_idx = min(start_idx + num_chunks, len(chunks))
-    selected_chunks = chunks[start_idx:end_idx]
+    # Get the chunks to copy, reading only those from the file
+    end_idx = min(start_idx + num_chunks, len(chunk_numbers))
+    selected_chunks = [(n, index.chunk(n)) for n in chunk_numbers[start_idx:end_idx]]
 
     if not selected_chunks:
         print("No more chunks to copy!")
@@ -102,12 +101,12 @@ def copy_chunks(
     pyperclip.copy(text_to_copy.strip())
 
     # Print copied chunks info
-    chunk_numbers = [chunk_num for chunk_num, _ in selected_chunks]
+    copied = [chunk_num for chunk_num, _ in selected_chunks]
     print(text_to_copy)
-    print(f"Copied chunks {chunk_numbers} to clipboard. File: {len(chunks)} chunks")
+    print(f"Copied chunks {copied} to clipboard. File: {len(chunk_numbers)} chunks")
 
     for chunk_num, chunk_text in selected_chunks:
-        chunk_text = f"<chunk{chunk_num}>\n\n{content}\n\n</chunk{chunk_num}>"
+        chunk_text = f"<chunk{chunk_num}>\n\n{chunk_text}\n\n</chunk{chunk_num}>"
         ifo = chunk_info(chunk_text)
         print(f'Chunk{chunk_num}: {ifo["total_lines"]} lines. Total lines ID {ifo["total_id"]}: [{ifo["first_id"]}-{ifo["last_id"]}]', end=" ")
     print("\n")
@@ -164,13 +163,15 @@ def main():
 
     # Load files
     system_prompt = load_file_content(system_prompt_path)
-    chunk_content = load_file_content(chunk_file_path)
-
-    if not system_prompt or not chunk_content:
+    if not system_prompt:
         return
 
-    # Extract chunks
-    chunks = extract_chunks(chunk_content)
+    # Index the chunks (line_index.py); they are read from the file when copied
+    try:
+        index = LineIndex(chunk_file_path)
+    except OSError as e:
+        print(f"Error reading file {chunk_file_path}: {e}")
+        return
     last_copied_chunk = 0
 
     while True:
@@ -191,7 +192,7 @@ def main():
         # hot reload prompt:)
         system_prompt = load_file_content(system_prompt_path)
         last_copied_chunk = copy_chunks(
-            system_prompt, chunks, start_chunk, chunks_per_copy, website_url
+            system_prompt, index, start_chunk, chunks_per_copy, website_url
         )
 
         if last_copied_chunk == 0:
@@ -0,0 +1,159 @@
+"""Machine-readable chunk events and status index of a translated file.
+
+Next to every `X_translated_N.xml` two files are kept:
+- `X_translated_N.events.jsonl`: one JSON record per attempt/result of a chunk
+  (time, chunk, event, lane, elapsed seconds, input/output chars, ...), append only;
+- `X_translated_N.status.json`: a snapshot of the status of each chunk
+  ("done", "failed" or "fixed") up to a byte offset of the event log. Loading
+  it replays only the events after that offset, so failed chunks are found
+  without scanning logs. Recording an event only appends to the event log; the
+  snapshot is rewritten every COMPACT_EVERY status changes.
+
+The human-readable `.log` line of each event is rendered from the same record
+by `render_event`. For translations made before these files existed, the index
+is rebuilt once from the `CHUNK_FAILED` lines of the old log.
+"""
+
+from __future__ import annotations
+
+import json
+import os
+import re
+import threading
+import time
+from datetime import datetime
+from pathlib import Path
+
+# events that change the status of a chunk
+STATUS_OF_EVENT = {
+    "done": "done",
+    "failed": "failed",
+    "fixed": "fixed",
+    "retry_failed": "failed",
+}
+COMPACT_EVERY = 1000  # status changes between two snapshots
+
+
+def events_path(output_file) -> Path:
+    return Path(output_file).with_suffix(".events.jsonl")
+
+
+def status_path(output_file) -> Path:
+    return Path(output_file).with_suffix(".status.json")
+
+
+def render_event(event: dict) -> str:
+    """The `.log` line of an event (formats as written by translator_gemini.py)."""
+    n = event["chunk"]
+    log_time = datetime.fromtimestamp(event["ts"]).strftime("%Y-%m-%d %H:%M:%S")
+    kind = event["event"]
+    if kind == "failed":
+        reason = event.get("reason", "Translation returned None after all retries.")
+        return f"Chunk {n}: CHUNK_FAILED at {log_time}. {reason}\n"
+    if kind == "retry_failed":
+        return f"Chunk {n}: CHUNK_FAILED at {log_time}. Retry failed.\n"
+    if kind == "fixed":
+        return f"Retry successful - Chunk {n}: {log_time}\n"
+    if kind == "attempt_failed":
+        return f"Chunk {n}: attempt {event.get('attempt')} failed at {log_time}, will retry.\n"
+    if "report" in event:
+        unclosed = " UNCLOSED_CHUNK_TAG." if event.get("unclosed") else ""
+        return f"{event['report']}. {log_time}.{unclosed}\n"
+    lane = f". Lane: {event['lane']}" if event.get("lane") else ""
+    return (
+        f"Chunk {n}: {log_time}. Took: {event['elapsed']:.2f}s. "
+        f"Len tr./input chars: {event['output_chars']}/{event['input_chars']}{lane}\n"
+    )
+
+
+def _legacy_status(log_file: Path) -> dict[int, str]:
+    """Status index from an old text log (CHUNK_FAILED / FIXED_CHUNK_FAILED lines)."""
+    status = {}
+    if not log_file.exists():
+        return status
+    with open(log_file, "r", encoding="utf-8") as f:
+        for match in re.finditer(r"Chunk (\d+): (FIXED_)?CHUNK_FAILED", f.read()):
+            status[int(match.group(1))] = "fixed" if match.group(2) else "failed"
+    return status
+
+
+class ChunkEventLog:
+    """Event log and status index of one `_translated_N.xml` file."""
+
+    def __init__(self, output_file, fresh: bool = False):
+        self.output_file = Path(output_file)
+        self.events_file = events_path(output_file)
+        self.status_file = status_path(output_file)
+        self.lock = threading.Lock()
+        self.offset = 0  # end of the events in self.status; None if another writer appended
+        self.changes = 0  # status changes since the last snapshot
+        if fresh:
+            self.status = {}
+            self.events_file.write_bytes(b"")
+            self.status_file.unlink(missing_ok=True)
+        else:
+            self.status = self._load_status()
+
+    def _load_status(self) -> dict[int, str]:
+        """The snapshot, brought up to date with the events recorded after it."""
+        if not self.events_file.exists():
+            return _legacy_status(self.output_file.with_suffix(".log"))
+        status = {}
+        try:
+            with open(self.status_file, "r", encoding="utf-8") as f:
+                snapshot = json.load(f)
+            if snapshot["offset"] <= self.events_file.stat().st_size:
+                status = {int(n): s for n, s in snapshot["chunks"].items()}
+                self.offset = snapshot["offset"]
+        except (OSError, ValueError, KeyError, TypeError, AttributeError):
+            pass  # no snapshot (or an old one): replay all events
+        with open(self.events_file, "rb") as f:
+            f.seek(self.offset)
+            for line in f:
+                if not line.endswith(b"\n"):
+                    break  # being written
+                self.offset += len(line)
+                if line.strip():
+                    event = json.loads(line)
+                    if event["event"] in STATUS_OF_EVENT:
+                        status[event["chunk"]] = STATUS_OF_EVENT[event["event"]]
+                        self.changes += 1
+        self.status = status
+        if self.changes >= COMPACT_EVERY:
+            self._save_status()
+        return status
+
+    def _save_status(self):
+        tmp_file = self.status_file.with_suffix(".json.tmp")
+        with open(tmp_file, "w", encoding="utf-8") as f:
+            json.dump(
+                {
+                    "offset": self.offset,
+                    "chunks": {str(n): s for n, s in sorted(self.status.items())},
+                },
+                f,
+            )
+        os.replace(tmp_file, self.status_file)
+        self.changes = 0
+
+    def record(self, chunk: int, event: str, **fields) -> dict:
+        """Append one event and update the chunk's status; returns the record."""
+        record = {"ts": time.time(), "chunk": chunk, "event": event, **fields}
+        line = (json.dumps(record, ensure_ascii=False) + "\n").encode("utf-8")
+        with self.lock:
+            with open(self.events_file, "ab") as f:
+                if f.tell() != self.offset:
+                    self.offset = None
+                f.write(line)
+            if self.offset is not None:
+                self.offset += len(line)
+            status = STATUS_OF_EVENT.get(event)
+            if status is not None and self.status.get(chunk) != status:
+                self.status[chunk] = status
+                self.changes += 1
+                if self.changes >= COMPACT_EVERY and self.offset is not None:
+                    self._save_status()
+        return record
+
+    def failed_chunks(self) -> list[int]:
+        return sorted(n for n, s in self.status.items() if s == "failed")
@@ -0,0 +1,385 @@
+"""Directory-wide chunk scheduling for translate_dir_gemini.py.
+
+All chunks of all matching files go into one queue instead of translating one
+file after another:
+- every translation profile ("lane", i.e. one model/prompt/key) serving a
+  `_translated_N.xml` pulls from the same queue, so each key's rate budget is
+  kept busy;
+- with concurrency > 1 the longest chunks go first (longest-job-first keeps the
+  slowest chunks from being the last ones running);
+- optionally, slow requests are hedged on another lane (see hedging.py);
+- a failed chunk is put back with a backoff delay while other chunks continue
+  (this is the only long retry: each request itself is tried just
+  SCHEDULED_REQUEST_RETRIES times);
+- every request sent (retries, continuations, hedges) is charged to the daily
+  quota of its transno; a chunk is not started or retried without quota left;
+- each file is written in chunk order (to `<output>.tmp`) as results land, and
+  renamed to its output and reported as soon as its last chunk is done.
+"""
+
+from __future__ import annotations
+
+import heapq
+import os
+import random
+import threading
+import time
+from pathlib import Path
+
+from chunk_events import ChunkEventLog, render_event
+from chunk_store import ChunkStore
+from hedging import HedgePolicy
+from quota_store import next_reset
+from rate_scheduler import AdaptiveRateScheduler
+from run_metrics import metrics
+from translator_gemini import (
+    TranslationProfile,
+    read_chunks,
+    translated_file_exists,
+    write_translation_headers,
+)
+from usage_ledger import set_usage_context
+
+MAX_CHUNK_ATTEMPTS = 3
+CHUNK_RETRY_DELAY = 60
+SCHEDULED_REQUEST_RETRIES = 2
+
+
+class FileAssembly:
+    """Collects the translated chunks of one file and writes them in chunk order.
+
+    Nothing is written until the first result of the file arrives, and no file
+    handles are kept between results, so any number of files can wait in the
+    queue. The chunks go to `<output>.tmp`, which is renamed to the output
+    when the last chunk is in: a partial output never looks finished.
+    """
+
+    def __init__(self, input_file, transno, chunks_list, n_file, profile):
+        source_path = Path(input_file)
+        self.input_file = input_file
+        self.transno = transno
+        self.n_file = n_file
+        self.profile = profile
+        self.total_chunks = len(chunks_list)
+        self.output_file = source_path.parent / f"{source_path.stem}_{transno}.xml"
+        self.tmp_file = self.output_file.with_name(self.output_file.name + ".tmp")
+        self.log_file = source_path.parent / f"{source_path.stem}_{transno}.log"
+        self.results = {}
+        self.next_index = 1
+        self.done = 0
+        self.failed = []
+        self.lock = threading.Lock()
+        self.events = None
+        self.store = None
+
+    def _start(self):
+        """Create the tmp output, log, event log and chunk store (under self.lock)."""
+        if self.events is not None:
+            return
+        self.events = ChunkEventLog(self.output_file, fresh=True)
+        self.store = ChunkStore(self.output_file, fresh=True)
+        with open(self.tmp_file, "w", encoding="utf-8") as f, open(
+            self.log_file, "w", encoding="utf-8"
+        ) as log_f:
+            self.store.put_header(
+                write_translation_headers(f, log_f, self.input_file, self.profile)
+            )
+
+    def record_attempt(self, index, **fields):
+        """Record a failed attempt of a chunk that will be retried."""
+        with self.lock:
+            self._start()
+            self.events.record(index, "attempt_failed", **fields)
+
+    def put(self, index, input_chunk_text, translated_text, elapsed_time, lane_name):
+        """Record one finished chunk; returns True when the whole file is done."""
+        with self.lock:
+            self._start()
+            if translated_text is None:
+                log_message = render_event(
+                    self.events.record(index, "failed", lane=lane_name)
+                )
+                print(f"[{self.transno}] {log_message.strip()}")
+                self.failed.append(index)
+                # Write original text instead of translation
+                self.results[index] = input_chunk_text
+            else:
+                log_message = render_event(
+                    self.events.record(
+                        index,
+                        "done",
+                        elapsed=round(elapsed_time, 2),
+                        input_chars=len(input_chunk_text),
+                        output_chars=len(translated_text),
+                        lane=lane_name,
+                    )
+                )
+                print(f"{self.n_file}. [{self.transno}] {log_message.strip()}")
+                self.results[index] = translated_text
+            self.store.put(index, self.results[index])
+
+            self.done += 1
+            finished = self.done == self.total_chunks
+            with open(self.log_file, "a", encoding="utf-8") as log_f:
+                log_f.write(log_message)
+                if finished:
+                    log_f.write(f"Output saved to {self.output_file}")
+            if self.next_index in self.results:
+                with open(self.tmp_file, "a", encoding="utf-8") as f:
+                    while self.next_index in self.results:
+                        f.write(self.results.pop(self.next_index))
+                        f.write("\n\n")
+                        self.next_index += 1
+            if finished:
+                os.replace(self.tmp_file, self.output_file)
+            return finished
+
+
+class ChunkJob:
+    def __init__(self, assembly: FileAssembly, file_order: int, index: int, text: str):
+        self.assembly = assembly
+        self.file_order = file_order
+        self.index = index
+        self.text = text
+        self.attempts = 0
+
+
+class ChunkScheduler:
+    def __init__(
+        self,
+        lanes: list[TranslationProfile],
+        concurrency: int = 1,
+        hedge: HedgePolicy | None = None,
+        max_in_flight: int | None = None,
+    ):
+        """`max_in_flight`: the most requests adaptive (AIMD) lanes may grow to;
+        enough workers are started for it, other lanes stay at `concurrency`."""
+        self.concurrency = max(1, concurrency, max_in_flight or 0)
+        self.hedge = hedge
+        self.lanes = {}
+        for lane in lanes:
+            # a lane may take every worker if the other lanes are out of budget
+            if max_in_flight and isinstance(lane.scheduler, AdaptiveRateScheduler):
+                lane.scheduler.set_in_flight_ceiling(max_in_flight)
+            else:
+                lane.scheduler.set_in_flight_ceiling(max(1, concurrency))
+            # chunk-level retries replace the long per-request backoff
+            lane.set_max_retries(SCHEDULED_REQUEST_RETRIES)
+            lane.on_request = self._charge
+            metrics.register_lane(lane)
+            self.lanes.setdefault(lane.transno, []).append(lane)
+        self.heaps = {transno: [] for transno in self.lanes}
+        self.delayed = []  # (ready_at, seq, job) waiting for a retry
+        self.seq = 0
+        self.in_progress = 0
+        self.finished_files = []
+        self.cond = threading.Condition()
+
+        # daily quota (RPD) left per transno, shared by all of its lanes;
+        # `reserved` holds one request for every queued chunk attempt
+        self.budget = {}
+        self.reserved = {}
+        for transno, transno_lanes in self.lanes.items():
+            for lane in transno_lanes:
+                lane.load_quota_state()
+            self.budget[transno] = sum(lane.remaining_today() for lane in transno_lanes)
+            self.reserved[transno] = 0
+
+    def _charge(self, lane: TranslationProfile) -> bool:
+        """Count one request of `lane` against its transno's daily budget.
+
+        Returns False (the request is not sent) when the budget is spent.
+        """
+        with self.cond:
+            if self.budget[lane.transno] <= 0:
+                return False
+            self.budget[lane.transno] -= 1
+            return True
+
+    def _spare(self, transno: str) -> int:
+        return self.budget[transno] - self.reserved[transno]
+
+    def _hedged_translate(self, job: ChunkJob, lane: TranslationProfile):
+        """hedge.translate() with each hedge reserving daily budget until the race ends."""
+        transno = job.assembly.transno
+        hedges = []
+
+        def take_quota() -> bool:
+            with self.cond:
+                if self._spare(transno) <= 0:
+                    return False
+                self.reserved[transno] += 1
+                hedges.append(lane)
+                return True
+
+        try:
+            return self.hedge.translate(
+                job.text, lane, self.lanes[transno], take_quota
+            )
+        finally:
+            if hedges:
+                with self.cond:
+                    self.reserved[transno] -= len(hedges)
+
+    def _priority(self, job: ChunkJob) -> tuple:
+        if self.concurrency > 1:
+            # longest job first
+            return (-len(job.text), job.file_order, job.index)
+        return (job.file_order, job.index)
+
+    def _push(self, job: ChunkJob):
+        self.seq += 1
+        heapq.heappush(
+            self.heaps[job.assembly.transno], (self._priority(job), self.seq, job)
+        )
+
+    def add_file(self, input_file, n_file, file_order: int) -> int:
+        """Queue every chunk of `input_file` for every transno; returns the job count."""
+        chunks_list = [chunk.strip() for chunk in read_chunks(input_file)]
+        chunks_list = [chunk for chunk in chunks_list if chunk]
+        if not chunks_list:
+            return 0
+        queued = 0
+        for transno, lanes in self.lanes.items():
+            if translated_file_exists(input_file, transno):
+                continue
+            with self.cond:
+                spare = self._spare(transno)
+                if len(chunks_list) > spare:
+                    # don't start a file the daily quota can't finish
+                    print(
+                        f"------> DEFERRING {input_file} [{transno}]: needs {len(chunks_list)} requests, "
+                        f"{max(0, spare)} left today. Quota resets at {next_reset():%Y-%m-%d %H:%M %Z}"
+                    )
+                    continue
+                self.reserved[transno] += len(chunks_list)
+                assembly = FileAssembly(
+                    input_file, transno, chunks_list, n_file, lanes[0]
+                )
+                for i, chunk in enumerate(chunks_list, 1):
+                    self._push(ChunkJob(assembly, file_order, i, chunk))
+                    queued += 1
+            metrics.chunks_queued(transno, len(chunks_list))
+        return queued
+
+    def _pick_lane(self, transno: str) -> TranslationProfile:
+        # the lane with daily quota left and the most budget in its rate window
+        return max(
+            self.lanes[transno],
+            key=lambda lane: (
+                lane.remaining_today() > 0,
+                lane.scheduler.headroom(),
+                -lane.scheduler.in_flight,
+            ),
+        )
+
+    def _next_job(self) -> ChunkJob | None:
+        with self.cond:
+            while True:
+                now = time.monotonic()
+                while self.delayed and self.delayed[0][0] <= now:
+                    _, _, job = heapq.heappop(self.delayed)
+                    self._push(job)
+
+                candidates = [t for t, heap in self.heaps.items() if heap]
+                if candidates:
+                    # prefer translations whose lanes still have rate budget
+                    with_budget = [
+                        t
+                        for t in candidates
+                        if any(lane.scheduler.headroom() for lane in self.lanes[t])
+                    ]
+                    transno = min(
+                        with_budget or candidates, key=lambda t: self.heaps[t][0][0]
+                    )
+                    _, _, job = heapq.heappop(self.heaps[transno])
+                    self.reserved[transno] -= 1
+                    self.in_progress += 1
+                    return job
+
+                if not self.delayed and self.in_progress == 0:
+                    return None
+                timeout = self.delayed[0][0] - now if self.delayed else None
+                self.cond.wait(timeout)
+
+    def _worker(self):
+        while True:
+            job = self._next_job()
+            if job is None:
+                return
+            assembly = job.assembly
+            lane = self._pick_lane(assembly.transno)
+            with self.cond:
+                out_of_quota = self.budget[assembly.transno] <= 0
+            if out_of_quota:
+                # retries and continuations used up the daily quota
+                print(
+                    f"[{assembly.transno}] Chunk {job.index} not sent: no daily quota left"
+                )
+            else:
+                print(
+                    f"\n{assembly.n_file}. [{assembly.transno}] Translating chunk {job.index}/{assembly.total_chunks}..."
+                )
+            start_time = time.time()
+            set_usage_context(assembly.input_file, job.index)
+            try:
+                if out_of_quota:
+                    translated_text = None
+                elif self.hedge is not None:
+                    translated_text, lane = self._hedged_translate(job, lane)
+                else:
+                    translated_text = lane.translate(job.text)
+            except Exception as e:
+                print(f"Error translating chunk {job.index}: {e}")
+                translated_text = None
+            elapsed_time = time.time() - start_time
+
+            with self.cond:
+                self.in_progress -= 1
+                job.attempts += 1
+                if (
+                    translated_text is None
+                    and job.attempts < MAX_CHUNK_ATTEMPTS
+                    and self._spare(assembly.transno) > 0
+                ):
+                    delay = CHUNK_RETRY_DELAY * (2 ** (job.attempts - 1))
+                    delay += random.uniform(0, 0.1 * delay)
+                    assembly.record_attempt(
+                        job.index,
+                        attempt=job.attempts,
+                        lane=lane.name,
+                        retry_in=round(delay, 1),
+                    )
+                    print(
+                        f"[{assembly.transno}] Chunk {job.index} failed, will retry in {delay:.0f}s"
+                    )
+                    metrics.record_chunk_retry()
+                    self.reserved[assembly.transno] += 1
+                    self.seq += 1
+                    heapq.heappush(
+                        self.delayed, (time.monotonic() + delay, self.seq, job)
+                    )
+                    self.cond.notify_all()
+                    continue
+                self.cond.notify_all()
+
+            metrics.chunk_finished(assembly.transno, translated_text is not None)
+            if assembly.put(
+                job.index, job.text, translated_text, elapsed_time, lane.name
+            ):
+                self.finished_files.append(assembly.output_file)
+                print(
+                    f"\n=== {assembly.n_file}. Finished: {assembly.output_file}"
+                    f" (failed chunks: {assembly.failed or 'none'})"
+                )
+
+    def run(self):
+        workers = [
+            threading.Thread(target=self._worker, daemon=True)
+            for _ in range(self.concurrency)
+        ]
+        for worker in workers:
+            worker.start()
+        for worker in workers:
+            worker.join()
+        return self.finished_files
@@ -0,0 +1,125 @@
+"""Per-chunk storage of a translated file.
+
+Next to every `X_translated_N.xml` the translated chunks are also kept one file
+per chunk in `X_translated_N.chunks/` (`header.xml`, `00001.xml`, ...). Replacing
+a chunk (e.g. a re-translated failed chunk) is a single small write, and the
+`.xml` file is re-assembled from the pieces by streaming them in chunk order.
+
+A translation made before the store existed is split into the store the first
+time it is opened, with the chunk boundaries of the shared lexer (line_lexer.py),
+so a chunk whose `</chunkN>` the model left out is kept too.
+"""
+
+from __future__ import annotations
+
+import os
+import re
+import shutil
+from pathlib import Path
+
+from line_lexer import LineLexer
+
+HEADER_NAME = "header.xml"
+CHUNK_SEPARATOR = "\n\n"
+
+CHUNK_CLOSE = re.compile(rb"</chunk\d+>")
+
+
+def _write_atomic(path: Path, text: str):
+    tmp_path = path.with_suffix(path.suffix + ".tmp")
+    with open(tmp_path, "w", encoding="utf-8") as f:
+        f.write(text)
+    os.replace(tmp_path, path)
+
+
+def split_translation(xml_file) -> tuple[str, dict[int, str]]:
+    """The header and {chunk number: chunk text, tags included} of a translation.
+
+    A chunk without `</chunkN>` ends at the next `<chunkM>` or at the end of the
+    file. Raises ValueError if a `<line id>` is outside every chunk or a chunk
+    number repeats, as the file could not be re-assembled without losing it.
+    """
+    data = Path(xml_file).read_bytes()
+    lexer = LineLexer()
+    records = lexer.feed(data) + lexer.close()
+    outside = [record.id for record in records if record.chunk is None]
+    if outside:
+        raise ValueError(f"{xml_file}: lines outside every chunk: {outside[:10]}")
+    header_end = len(data)
+    chunks = {}
+    for chunk_no, start, end in lexer.chunk_spans:
+        if chunk_no in chunks:
+            raise ValueError(f"{xml_file}: <chunk{chunk_no}> appears more than once")
+        tag_start = data.rindex(b"<chunk", 0, start)
+        header_end = min(header_end, tag_start)
+        closing = CHUNK_CLOSE.match(data, end)
+        if closing:
+            end = closing.end()
+        chunks[chunk_no] = data[tag_start:end].decode("utf-8").rstrip()
+    return data[:header_end].decode("utf-8"), chunks
+
+
+class ChunkStore:
+    """Translated chunks of one `_translated_N.xml`, one file per chunk."""
+
+    def __init__(self, output_file, fresh: bool = False):
+        self.output_file = Path(output_file)
+        self.directory = self.output_file.with_suffix(".chunks")
+        if fresh and self.directory.exists():
+            shutil.rmtree(self.directory)
+        if not self.directory.exists():
+            if not fresh and self.output_file.exists():
+                self._import(self.output_file)
+            else:
+                self.directory.mkdir(parents=True)
+
+    def _import(self, xml_file: Path):
+        header, chunks = split_translation(xml_file)
+        # filled next to the store and renamed, so a failed import leaves no store
+        tmp_directory = self.directory.with_name(self.directory.name + ".tmp")
+        if tmp_directory.exists():
+            shutil.rmtree(tmp_directory)
+        tmp_directory.mkdir(parents=True)
+        (tmp_directory / HEADER_NAME).write_text(header, encoding="utf-8")
+        for chunk_no, text in chunks.items():
+            (tmp_directory / f"{chunk_no:05d}.xml").write_text(text, encoding="utf-8")
+        os.replace(tmp_directory, self.directory)
+
+    def _path(self, chunk_no: int) -> Path:
+        return self.directory / f"{chunk_no:05d}.xml"
+
+    def put_header(self, text: str):
+        _write_atomic(self.directory / HEADER_NAME, text)
+
+    def put(self, chunk_no: int, text: str):
+        """Store (or replace) the translation of one chunk."""
+        _write_atomic(self._path(chunk_no), text)
+
+    def get(self, chunk_no: int) -> str | None:
+        path = self._path(chunk_no)
+        if not path.exists():
+            return None
+        return path.read_text(encoding="utf-8")
+
+    def chunk_numbers(self) -> list[int]:
+        return sorted(
+            int(name[:-4])
+            for name in os.listdir(self.directory)
+            if name.endswith(".xml") and name[:-4].isdigit()
+        )
+
+    def assemble(self, output_file=None) -> Path:
+        """Write header + chunks in order to the `.xml` file, one piece at a time."""
+        output_file = Path(output_file or self.output_file)
+        tmp_file = output_file.with_suffix(output_file.suffix + ".tmp")
+        with open(tmp_file, "w", encoding="utf-8") as out:
+            header = self.directory / HEADER_NAME
+            if header.exists():
+                with open(header, "r", encoding="utf-8") as f:
+                    shutil.copyfileobj(f, out)
+            for chunk_no in self.chunk_numbers():
+                with open(self._path(chunk_no), "r", encoding="utf-8") as f:
+                    shutil.copyfileobj(f, out)
+                out.write(CHUNK_SEPARATOR)
+        os.replace(tmp_file, output_file)
+        return output_file
@@ -18,7 +18,9 @@ def process_directory(directory, model="gpt-4"):
     total_tokens = 0
     file_count = 0
 
-    for root, _, files in os.walk(directory):
+    for root, dirs, files in os.walk(directory):
+        # skip the per-chunk copies of translated files (chunk_store.py)
+        dirs[:] = [d for d in dirs if not d.endswith(".chunks")]
         for file in files:
             if file.endswith(".xml"):
                 file_path = os.path.join(root, file)
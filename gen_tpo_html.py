@@ -7,71 +7,151 @@ import re
 import sys
 import os
 import argparse
+import json
 
 from datetime import datetime
 from typing import Tuple
 from pathlib import Path
 
-import pypandoc
+from html import escape
 from unidecode import unidecode
-from bs4 import BeautifulSoup
 
+import md_html
+from md_html import html_headings, render_markdown
+from section_cache import code_version, file_signature, load_manifest, save_manifest
 
-def replace_smart_quotes_md(md_filepath) -> str:
-    """
-    Replaces smart quotes in a file with their HTML entity equivalents.
+try:
+    import pypandoc
+except ImportError:
+    pypandoc = None
 
-    VRI use smart quotes which causes **‘‘text** bold format issues. This use html to fix them
-    """
-    try:
-        fix_quotes_save = str(md_filepath) + "_fixed_quotes.md"
+K_ANCHOR = re.compile(r"""\bid=["']k(\d+)["']""")
+# line ID markers and translation paragraphs/headings of the joined output; a
+# translation over several markdown paragraphs has <p>s inside (as pandoc writes it)
+LAZY_PARTS = re.compile(
+    r"""<p><i>ID(\d+)</i></p>|<p class=["']t(\d+)["']>(?:<p>.*?</p>|.)*?</p>"""
+    r"""|<h([1-6])\b[^>]*\bclass=["']ht ht(\d+)["'][^>]*>.*?</h\3>""",
+    re.DOTALL,
+)
+TOC_DIV = re.compile(r"""<div\b[^>]*\bid=["']tocDivBox["'][^>]*>""", re.IGNORECASE)
 
-        with open(md_filepath, "r", encoding="utf-8") as f:
-            content = f.read()
 
-        # Perform the replacements
-        content = content.replace("‘‘", "&ldquo;")
-        content = content.replace("’’", "&rdquo;")
+def replace_smart_quotes(content: str) -> str:
+    """
+    Replaces smart quotes with their HTML entity equivalents.
 
-        # Replace en dash (–) with hyphen (-)
-        # content = content.replace("–", "-")
+    VRI use smart quotes which causes **‘‘text** bold format issues. This use html to fix them
+    """
+    content = content.replace("‘‘", "&ldquo;")
+    content = content.replace("’’", "&rdquo;")
 
-        with open(fix_quotes_save, "w", encoding="utf-8") as f:
-            f.write(content)
-        print(f"\nSmart quotes replaced with HTML entities in {md_filepath}")
+    # Replace en dash (–) with hyphen (-)
+    # content = content.replace("–", "-")
+    return content
 
-    except FileNotFoundError:
-        print(f"Error: File not found at {md_filepath}")
-    except Exception as e:
-        print(f"An error occurred: {e}")
-    return fix_quotes_save
 
+def convert_markdown_to_html(md_file, headings=None, use_pandoc=False) -> str:
+    """HTML of a Markdown file, with md_html.py or, if use_pandoc, pypandoc.
 
-def convert_markdown_to_html(md_file, output_file):
-    """Converts a Markdown file to HTML using pypandoc."""
+    The headings are appended to `headings` as md_html.render_markdown does.
+    """
+    with open(md_file, "r", encoding="utf-8") as f:
+        content = replace_smart_quotes(f.read())
 
-    fixed_smart_quotes_filepath = replace_smart_quotes_md(md_file)
+    if not use_pandoc:
+        return render_markdown(content, headings)
 
+    if pypandoc is None:
+        raise ImportError("--pandoc needs pypandoc: pip install pypandoc")
     try:
-        output = pypandoc.convert_file(
-            fixed_smart_quotes_filepath,
-            to="html",
-            outputfile=output_file,
-            extra_args=["--wrap=none"],
+        html = pypandoc.convert_text(
+            content, to="html", format="markdown", extra_args=["--wrap=none"]
         )
-        if output == "":
-            print(f"\nSuccessfully converted {md_file} to {output_file}")
-        else:
-            print(f"Conversion may have warnings: {output}")
     except RuntimeError as e:
         print(f"Error during conversion: {e}")
+        return ""
+    if headings is not None:
+        html_headings(html, headings)
+    return html
+
 
+def render_sections(md_file, output_file, headings, reuse=True):
+    """Render md_file by the sections (chunks) join_translations.py recorded,
+    reusing the HTML of sections that did not change since the last build.
 
-def generate_translation_info(md_file, num_translations: int):
-    # script to hide/show translations
+    The reused HTML is read back from the pages written last time, which the
+    manifest of output_file maps (see save_sections and section_cache.py).
+    Returns (body HTML, sections to save), or None if md_file has no sections,
+    e.g. it was not written by the joiner.
+    """
+    join_manifest = load_manifest(md_file)
+    if join_manifest is None or "sections" not in join_manifest:
+        return None
+    version = code_version(md_html, sys.modules[__name__])
+
+    cached, segments = {}, []
+    cache = load_manifest(output_file) if reuse else None
+    if cache is not None and cache.get("version") == version:
+        # a page changed by hand or by another build can't be reused
+        folder = Path(output_file).parent
+        segments = cache["segments"]
+        if all(file_signature(folder / seg[0]) == seg[4] for seg in segments):
+            cached = {key: (start, end, hs) for key, start, end, hs in cache["sections"]}
+    pages = {}
+
+    def old_html(start: int, end: int) -> str:
+        # the pieces of the old body[start:end] in the pages that hold them
+        pieces = []
+        for name, offset, seg_start, seg_end, _ in segments:
+            if seg_start < end and start < seg_end:
+                if name not in pages:
+                    with open(Path(output_file).parent / name, "r", encoding="utf-8") as f:
+                        pages[name] = f.read()
+                first = offset + max(start, seg_start) - seg_start
+                last = offset + min(end, seg_end) - seg_start
+                pieces.append(pages[name][first:last])
+        return "".join(pieces)
+
+    with open(md_file, "r", encoding="utf-8") as f:
+        md = f.read()
+    parts, sections, position, rendered = [], [], 0, 0
+    for _, key, start, end in join_manifest["sections"]:
+        if key in cached:
+            html_start, html_end, section_headings = cached[key]
+            html = old_html(html_start, html_end)
+        else:
+            section_headings = []
+            html = render_markdown(replace_smart_quotes(md[start:end]), section_headings)
+            rendered += 1
+        headings.extend(tuple(heading) for heading in section_headings)
+        parts.append(html)
+        sections.append([key, position, position + len(html), section_headings])
+        position += len(html)
+    print(f"\nRendered {rendered} of {len(sections)} sections, the others are unchanged")
+    return "".join(parts), {"version": version, "sections": sections}
+
+
+def save_sections(output_file, sections: dict, segments: list):
+    """Save where the sections of this build are, for render_sections.
+
+    `segments` are [page file, offset of the body in it, start, end] of the
+    parts of the body each written page holds. Pages whose body was changed
+    on the way (lazy translations) have none, and then nothing is saved.
+    """
+    folder = Path(output_file).parent
+    covered = sum(end - start for _, _, start, end in segments)
+    if not sections["sections"] or covered != sections["sections"][-1][2]:
+        print("Lazy translations: all sections are rendered again next time")
+        return
+    segments = [seg + [file_signature(folder / seg[0])] for seg in segments]
+    save_manifest(output_file, dict(sections, segments=segments))
+
+
+def generate_translation_info(md_file, num_translations: int, shown=None):
+    # script to hide/show translations; only the first `shown` are checked
     translation_toggles = "\n".join(
         [
-            f'<label style="margin-right: 15px; padding: 2px 6px; border-radius: 4px;"><input type="checkbox" id="toggle_t{i}" checked onchange="toggleTranslation({i})">Tr. {i}</label>'
+            f'<label style="margin-right: 15px; padding: 2px 6px; border-radius: 4px;"><input type="checkbox" id="toggle_t{i}"{"" if shown is not None and i > shown else " checked"} onchange="toggleTranslation({i})">Tr. {i}</label>'
             for i in range(1, num_translations + 1)
         ]
     )
@@ -140,90 +220,236 @@ def generate_translation_info(md_file, num_translations: int):
     return translation_toggles, "\n".join(translations_order)
 
 
-def add_toc(html_file_path, output_file_path=None):
+def toc_html(headings, pages=None) -> str:
+    """The TOC list of the (level, id, classes, text) headings, for h1-h5 with an id.
+
+    `pages` maps heading ids to the page file they are on, for paginated output.
     """
-    Adds a Table of Contents (TOC) to an HTML file.
+    items = []
+    for level, heading_id, classes, text in headings:
+        if heading_id is None or level > 5:
+            continue  # Skip headings without id
+        if "hs" in classes:
+            css = ["toc_a", "stoc"]
+        elif "ht" in classes:
+            # Remove "ht" and add "ttoc"
+            css = ["toc_a", "ttoc"] + [c for c in classes if c != "ht"]
+        else:
+            css = []
+        class_attr = f' class="{" ".join(css)}"' if css else ""
+        page = pages.get(heading_id, "") if pages else ""
+        # Add style according heading level.
+        items.append(
+            f'<li{class_attr} style="margin-left: {level - 1}em;">'
+            f'<a href="{escape(page)}#{escape(heading_id)}">{escape(text, quote=False)}</a></li>'
+        )
+    return f"<ul>{''.join(items)}</ul>"
+
+
+def add_toc(html: str, headings, pages=None, nav: str = "") -> str:
+    """Put `nav` and the TOC list of the headings into the div with id='tocDivBox'."""
+    toc_div = TOC_DIV.search(html)
+    if toc_div is None:
+        print("Error: Could not find div with id='tocDivBox'")
+        return html
+    return html[: toc_div.end()] + nav + toc_html(headings, pages) + html[toc_div.end() :]
+
+
+def split_pages(file_html: str, headings, page_size: int) -> list:
+    """Split the body between entries (at <hr />) into pages of about page_size
+    characters. A page also starts at a top-level source heading once the
+    current one has a quarter of that."""
+    levels = [level for level, _, classes, _ in headings if "hs" in classes]
+    levels = levels or [level for level, _, _, _ in headings]
+    top_heading = re.compile(rf"<h{min(levels)}\b") if levels else None
+
+    pages, current, size = [], [], 0
+    entries = file_html.split("<hr />")
+    for n, entry in enumerate(entries):
+        if n < len(entries) - 1:
+            entry += "<hr />"
+        if current and (
+            size >= page_size
+            or (size >= page_size // 4 and top_heading and top_heading.search(entry))
+        ):
+            pages.append("".join(current))
+            current, size = [], 0
+        current.append(entry)
+        size += len(entry)
+    if current:
+        pages.append("".join(current))
+    return pages
+
+
+def page_nav(names, n: int, index_name: str) -> str:
+    links = []
+    if n > 0:
+        links.append(f'<a href="{names[n - 1]}">&laquo; Previous</a>')
+    links.append(f'<a href="{index_name}">Contents</a>')
+    if n < len(names) - 1:
+        links.append(f'<a href="{names[n + 1]}">Next &raquo;</a>')
+    return (
+        '<p class="page_nav" style="text-align: center; margin: 12px 0;">'
+        + " | ".join(links)
+        + f' <span style="color: #6d6c6c;">(page {n + 1} of {len(names)})</span></p>'
+    )
+
+
+def head_links(html: str, links) -> str:
+    """Add <link rel=... href=...> tags to the <head>."""
+    tags = "".join(f'<link rel="{rel}" href="{href}" />\n    ' for rel, href in links)
+    return html.replace("</head>", tags + "</head>", 1)
+
 
-    Args:
-        html_file_path: Path to the input HTML file.
-        output_file_path: (Optional) Path to save the modified HTML.
-                          If None, overwrites the input file.
+def split_translations(file_html: str, keep: int = 1):
+    """Take translations after the first `keep` out of the body.
+
+    Returns the body and {translation number: {line ID: HTML}}.
     """
-    try:
-        with open(html_file_path, "r", encoding="utf-8") as f:
-            html_content = f.read()
-
-        soup = BeautifulSoup(html_content, "html.parser")
-
-        # Find the TOC div
-        toc_div = soup.find("div", id="tocDivBox")
-
-        if toc_div is None:
-            raise ValueError("Could not find div with id='tocDivBox'")
-
-        toc_list = soup.new_tag("ul")
-
-        # Find all heading tags (h1, h2, h3, h4, h5)
-        headings = soup.find_all(re.compile(r"^h[1-5]$"))
-
-        for heading in headings:
-
-            # Get the heading text and ID
-            heading_text = heading.get_text(strip=True)
-            heading_id = heading.get("id")
-
-            if heading_id is None:
-                # print(f"Warning: Heading '{heading_text}' has no ID. Skipping in TOC.")
-                continue  # Skip headings without id
-
-            # Create a list item for the TOC
-            list_item = soup.new_tag("li")
-            # Add style according heading level.
-            if heading.name == "h1":
-                list_item["style"] = "margin-left: 0em;"
-            elif heading.name == "h2":
-                list_item["style"] = "margin-left: 1em;"
-            elif heading.name == "h3":
-                list_item["style"] = "margin-left: 2em;"
-            elif heading.name == "h4":
-                list_item["style"] = "margin-left: 3em;"
-            elif heading.name == "h5":
-                list_item["style"] = "margin-left: 4em;"
-
-            # Create a link to the heading
-            link = soup.new_tag("a", href=f"#{heading_id}")
-            link.string = heading_text
-
-            if "hs" in heading.get("class", []):
-                list_item["class"] = ["toc_a", "stoc"] + list_item.get("class", [])
-            elif "ht" in heading.get("class", []):
-                # Remove "ht" and add "ttoc"
-                current_classes = heading.get("class", [])
-                list_item["class"] = ["toc_a", "ttoc"] + [c for c in current_classes if c != "ht"]
-            else:
-                pass
-
-            list_item.append(link)
-            toc_list.append(list_item)
-
-        # Add the TOC list to the TOC div
-        # toc_div.append(copy.deepcopy(toc_list))
-        toc_div.append(toc_list)
-
-        # Save the modified HTML (either overwrite or to a new file)
-        if output_file_path is None:
-            output_file_path = html_file_path  # Overwrite
-
-        with open(output_file_path, "w", encoding="utf-8") as f:
-            f.write(str(soup))
-        print(f"TOC added and saved to {output_file_path}")
-
-    except FileNotFoundError:
-        print(f"Error: File not found: {html_file_path}")
-    except ValueError as ve:
-        print(f"Error: {ve}")
-    except Exception as e:
-        print(f"An unexpected error occurred: {e}")
+    payloads = {}
+    out = []
+    position = 0
+    line_id = None
+    for match in LAZY_PARTS.finditer(file_html):
+        if match.group(1) is not None:
+            line_id = match.group(1)
+            continue
+        num = int(match.group(2) or match.group(4))
+        if num <= keep or line_id is None:
+            continue
+        lines = payloads.setdefault(num, {})
+        lines[line_id] = lines.get(line_id, "") + match.group(0)
+        out.append(file_html[position : match.start()])
+        position = match.end()
+        if file_html.startswith("\n", position):
+            position += 1
+    out.append(file_html[position:])
+    return "".join(out), payloads
+
+
+def lazy_translations_script(files: dict, hidden) -> str:
+    """Script that fetches a translation's JSON file the first time it is shown."""
+    return f"""
+    <script>
+      var lazyTranslations = {json.dumps({str(k): v for k, v in files.items()})};
+      var showTranslation = toggleTranslation;
+      function translationNumber(el) {{
+        var m = el.className.match(/\\bh?t(\\d+)\\b/);
+        return m ? parseInt(m[1], 10) : Infinity;
+      }}
+      function insertTranslation(id, html, num) {{
+        var source = document.getElementById("k" + id) || document.querySelector('.hs[id$="-id' + id + '"]');
+        if (!source) return;
+        var next = source.nextElementSibling;
+        while (next && next.tagName !== "HR" && translationNumber(next) < num) next = next.nextElementSibling;
+        var t = document.createElement("template");
+        t.innerHTML = html;
+        source.parentNode.insertBefore(t.content, next);
+      }}
+      toggleTranslation = function (num) {{
+        var file = lazyTranslations[num];
+        if (!file || !document.getElementById("toggle_t" + num).checked) return showTranslation(num);
+        delete lazyTranslations[num];
+        fetch(file)
+          .then(function (r) {{ return r.json(); }})
+          .then(function (lines) {{
+            for (var id in lines) insertTranslation(id, lines[id], num);
+            showTranslation(num);
+          }});
+      }};
+      {json.dumps(list(hidden))}.forEach(showTranslation);
+    </script>"""
+
+
+def write_page(path, html: str, body: str, lazy=()) -> int | None:
+    """Put the body into the page and write it.
+
+    The translations numbered in `lazy` (e.g. range(2, 4)) are written to
+    `<page>_t<N>.json` next to the page and only fetched when switched on.
+    Returns where the body starts in the page, or None if lazy changed it.
+    """
+    path = Path(path)
+    offset = None if lazy else html.index("$FILE_HTML")
+    if lazy:
+        body, payloads = split_translations(body, keep=min(lazy) - 1)
+        files = {}
+        for num, lines in sorted(payloads.items()):
+            files[num] = f"{path.stem}_t{num}.json"
+            with open(path.parent / files[num], "w", encoding="utf-8") as f:
+                json.dump(lines, f, ensure_ascii=False, separators=(",", ":"))
+        body += lazy_translations_script(files, lazy)
+    with open(path, "w", encoding="utf-8") as f:
+        f.write(html.replace("$FILE_HTML", body))
+    return offset
+
+
+def write_pages(
+    output_file,
+    page_template: str,
+    file_html: str,
+    headings,
+    page_size: int,
+    lazy=(),
+    segments=None,
+) -> list:
+    """Write the book as linked pages of about page_size characters.
+
+    output_file becomes the index page with the whole TOC and a list of the
+    pages; it sends links to a line (`#k123`, used by the Tipitakapali AI
+    assistant) on to the page that has it. Each page has its own headings in
+    the TOC box, links to the previous/next page and prefetches the next one.
+    Where each page holds the body is appended to `segments` (see save_sections).
+    """
+    output = Path(output_file)
+    pages = split_pages(file_html, headings, page_size)
+    names = [f"{output.stem}_p{n:03d}{output.suffix}" for n in range(1, len(pages) + 1)]
+
+    heading_pages = {}
+    page_items = []
+    first_ids = []
+    position = 0
+    for n, (name, page) in enumerate(zip(names, pages)):
+        page_headings = html_headings(page)
+        heading_pages.update((h[1], name) for h in page_headings if h[1] is not None)
+        line_ids = [int(i) for i in K_ANCHOR.findall(page)]
+        first_ids.append(line_ids[0] if line_ids else None)
+
+        nav = page_nav(names, n, output.name)
+        links = [("prev", names[n - 1])] if n > 0 else []
+        links += [("next", names[n + 1]), ("prefetch", names[n + 1])] if n < len(names) - 1 else []
+        html = head_links(add_toc(page_template, page_headings, nav=nav), links)
+        offset = write_page(output.parent / name, html, f"{nav}\n{page}\n{nav}", lazy)
+        if segments is not None and offset is not None:
+            start = offset + len(nav) + 1
+            segments.append([name, start, position, position + len(page)])
+        position += len(page)
+
+        title = next((h[3] for h in page_headings if "hs" in h[2]), None)
+        title = title or (page_headings[0][3] if page_headings else f"Page {n + 1}")
+        lines = f" (lines {line_ids[0]}&ndash;{line_ids[-1]})" if line_ids else ""
+        page_items.append(f'<li><a href="{name}">{escape(title, quote=False)}</a>{lines}</li>')
+
+    # where each page starts, for the #k<id> links
+    starts = [[first_id, name] for first_id, name in zip(first_ids, names) if first_id is not None]
+    index_body = f"""<ol class="page_list">{"".join(page_items)}</ol>
+    <script>
+      (function () {{
+        var starts = {json.dumps(starts)};
+        var m = location.hash.match(/^#k(\\d+)$/);
+        if (!m || !starts.length) return;
+        var id = parseInt(m[1], 10), page = starts[0][1];
+        for (var i = 0; i < starts.length && starts[i][0] <= id; i++) page = starts[i][1];
+        location.replace(page + location.hash);
+      }})();
+    </script>"""
+    html = add_toc(page_template, headings, heading_pages)
+    html = head_links(html, [("prefetch", names[0])] if names else [])
+    if lazy:
+        # nothing to fetch, but the lazy translations start hidden in the TOC
+        index_body += lazy_translations_script({}, lazy)
+    write_page(output, html, index_body)
+    print(f"\nWrote {len(pages)} pages and the index {output}")
+    return names
 
 
 def convert_addTOC(
@@ -232,8 +458,18 @@ def convert_addTOC(
     output_file=None,
     num_translations=4,
     tpo_template="./tpo_html_template.html",
+    use_pandoc=False,
+    page_kb=0,
+    lazy_translations=False,
+    full=False,
 ):
-    """Convert Markdown to HTML, add TOC, and apply translations template."""
+    """Convert Markdown to HTML, add TOC, and apply translations template.
+
+    With page_kb, the book is split into linked pages of about that many KB
+    (see write_pages). With lazy_translations, the pages carry only the
+    source and translation 1; the others are fetched when switched on (see
+    write_page). Unless `full` (or with pandoc), only the sections that
+    changed since the last build are rendered again (see render_sections)."""
 
     # If output_file is not provided, derive it from md_file
     if output_file is None:
@@ -241,11 +477,20 @@ def convert_addTOC(
         output_file = os.path.splitext(md_file)[0] + ".html"
         print(f"OK: No output html filename provided, using {output_file}")
 
-    convert_markdown_to_html(md_file, output_file)
+    # Headings are collected for the TOC while converting
+    headings = []
+    file_html, sections = None, None
+    if not use_pandoc:
+        rendered = render_sections(md_file, output_file, headings, reuse=not full)
+        if rendered is not None:
+            file_html, sections = rendered
+    if file_html is None:
+        file_html = convert_markdown_to_html(md_file, headings, use_pandoc=use_pandoc)
 
     # Manually update the template
+    lazy = range(2, num_translations + 1) if lazy_translations else ()
     TRANSLATIONS_TOGGLE, TRANSLATIONS_ORDER = generate_translation_info(
-        md_file, num_translations=num_translations
+        md_file, num_translations=num_translations, shown=1 if lazy else None
     )
 
     print(f"\n\nUsing {tpo_template}")
@@ -275,16 +520,26 @@ def convert_addTOC(
         )
     )
 
-    # Inject the converted HTML content
-    with open(output_file, "r", encoding="utf-8") as fhtml:
-        html = html.replace("$FILE_HTML", fhtml.read())
-
-    # Save the final HTML file
-    with open(output_file, "w", encoding="utf-8") as fdone:
-        fdone.write(html)
+    segments = []
+    if page_kb:
+        write_pages(
+            output_file, html, file_html, headings, page_kb * 1000, lazy, segments
+        )
+        if sections is not None:
+            save_sections(output_file, sections, segments)
+        print(f"\nDone all. Check {output_file}")
+        return
 
     # Adding TOC
-    add_toc(output_file)
+    html = add_toc(html, headings)
+
+    # Inject the converted HTML content and save the final HTML file
+    offset = write_page(output_file, html, file_html, lazy)
+    if sections is not None:
+        if offset is not None:
+            segments.append([Path(output_file).name, offset, 0, len(file_html)])
+        save_sections(output_file, sections, segments)
+    print(f"\nConverted {md_file} to {output_file}, TOC of {len(headings)} headings")
 
     print(f"\nDone all. Check {output_file}")
 
@@ -321,6 +576,33 @@ def parse_arguments() -> argparse.Namespace:
         default="./tpo_html_template.html",
     )
 
+    parser.add_argument(
+        "--page-kb",
+        type=int,
+        default=0,
+        help="Split long books into linked pages of about this many KB, "
+        "with the output file as the index page (default: 0, one file)",
+    )
+
+    parser.add_argument(
+        "--lazy-translations",
+        action="store_true",
+        help="Put only translation 1 in the HTML; the others go to JSON files "
+        "that are fetched when switched on",
+    )
+
+    parser.add_argument(
+        "--full",
+        action="store_true",
+        help="Render every section again, not only those that changed",
+    )
+
+    parser.add_argument(
+        "--pandoc",
+        action="store_true",
+        help="Convert with pandoc (pypandoc) instead of the built-in md_html.py",
+    )
+
     return parser.parse_args()
 
 
@@ -362,6 +644,10 @@ def main():
             output_file=output_file,
             num_translations=args.translations,
             tpo_template=args.template,
+            use_pandoc=args.pandoc,
+            page_kb=args.page_kb,
+            lazy_translations=args.lazy_translations,
+            full=args.full,
         )
 
     except Exception as e:
@@ -0,0 +1,126 @@
+"""Hedged requests: duplicate a slow chunk request on another lane.
+
+When a request has run longer than a percentile of the latencies observed for
+its model, the same chunk is sent to another lane (another key or model serving
+the same `_translated_N.xml`) and whichever answer arrives first is kept. The
+loser is cancelled: if it has not been sent yet it never is, and if it is in
+flight its answer is dropped. Hedges go through the lanes' rate schedulers like
+any other request and are capped at a fraction of the primary requests.
+"""
+
+from __future__ import annotations
+
+import queue
+import threading
+
+from rate_scheduler import MIN_LATENCY_SAMPLES, latency_stats
+from usage_ledger import get_usage_context, set_usage_context
+
+_local = threading.local()
+
+
+class RequestCancelled(Exception):
+    """Raised instead of sending a request whose hedge race was already decided."""
+
+
+def is_cancelled() -> bool:
+    """True if the request running on this thread lost its hedge race."""
+    event = getattr(_local, "cancel", None)
+    return event is not None and event.is_set()
+
+
+def _run_lane(lane, chunk, cancel: threading.Event, results: queue.Queue, context):
+    _local.cancel = cancel
+    set_usage_context(*context)
+    try:
+        text = lane.translate(chunk)
+    except RequestCancelled:
+        text = None
+    except Exception as e:
+        print(f"Error translating on {lane.name}: {e}")
+        text = None
+    results.put((lane, text))
+
+
+class HedgePolicy:
+    def __init__(self, percentile: float = 95, budget: float = 0.1):
+        self.percentile = percentile
+        self.budget = budget  # max hedges as a fraction of primary requests
+        self.primaries = 0
+        self.hedges = 0
+        self.hedges_won = 0
+        self.lock = threading.Lock()
+
+    def threshold(self, model: str) -> float | None:
+        """Seconds after which a request of `model` gets a hedge (None: too few samples)."""
+        if latency_stats.count(model) < MIN_LATENCY_SAMPLES:
+            return None
+        return latency_stats.percentile(model, self.percentile)
+
+    def _take_budget(self) -> bool:
+        with self.lock:
+            if self.hedges + 1 > self.budget * self.primaries:
+                return False
+            self.hedges += 1
+            return True
+
+    def translate(self, chunk: str, primary, lanes: list, take_quota=None):
+        """Translate `chunk` on `primary`, hedging on another lane if it is slow.
+
+        `take_quota()`, if given, is called before a hedge is launched, which
+        only happens if it returns True (e.g. the daily quota has room for it).
+        Returns (translated text or None, lane whose answer was kept).
+        """
+        with self.lock:
+            self.primaries += 1
+        results = queue.Queue()
+        context = get_usage_context()
+        cancels = {primary: threading.Event()}
+        threading.Thread(
+            target=_run_lane,
+            args=(primary, chunk, cancels[primary], results, context),
+            daemon=True,
+        ).start()
+
+        others = [lane for lane in lanes if lane is not primary]
+        threshold = self.threshold(primary.model)
+        if threshold is None or not others:
+            lane, text = results.get()
+            return text, lane
+        try:
+            lane, text = results.get(timeout=threshold)
+            return text, lane
+        except queue.Empty:
+            pass
+        if not self._take_budget() or (take_quota is not None and not take_quota()):
+            lane, text = results.get()
+            return text, lane
+
+        backup = max(others, key=lambda lane: lane.scheduler.headroom())
+        print(
+            f"Hedging: {primary.name} slower than p{self.percentile:g} ({threshold:.1f}s), "
+            f"duplicating on {backup.name}"
+        )
+        cancels[backup] = threading.Event()
+        threading.Thread(
+            target=_run_lane,
+            args=(backup, chunk, cancels[backup], results, context),
+            daemon=True,
+        ).start()
+
+        lane, text = results.get()
+        if text is None:
+            # a failure does not win the race, wait for the other request
+            lane, text = results.get()
+        loser = backup if lane is primary else primary
+        cancels[loser].set()
+        if lane is backup and text is not None:
+            with self.lock:
+                self.hedges_won += 1
+        return text, lane
+
+    def summary(self) -> str:
+        return (
+            f"Hedged requests: {self.hedges} of {self.primaries} "
+            f"(budget {self.budget:.0%}), won by the hedge: {self.hedges_won}"
+        )
@@ -0,0 +1,332 @@
+"""Lease-based chunk queue in SQLite, shared by several translation workers.
+
+Every chunk of every file/transno is one row. A worker claims a chunk by taking
+a lease on it (owner + expiry time) and extends its leases with heartbeats while
+it works. If a worker dies, its leases expire and other workers pick the chunks
+up again; taking over an expired lease counts as a failed attempt, so a chunk
+that keeps killing its workers ends up failed after MAX_CHUNK_ATTEMPTS. A result
+is only accepted from the current lease owner, so a chunk that was taken over is
+not written twice.
+
+The database uses SQLite's WAL journal, which needs shared memory between the
+workers: keep it on a local filesystem and run the workers on that machine
+(WAL does not work over network filesystems such as NFS).
+
+Results go to the file's ChunkStore; the worker finishing the last chunk of a
+file writes the log/events in chunk order and assembles the `.xml`.
+"""
+
+from __future__ import annotations
+
+import sqlite3
+import threading
+import time
+from contextlib import contextmanager
+from pathlib import Path
+
+from chunk_events import ChunkEventLog, render_event
+from chunk_store import ChunkStore
+
+QUEUE_DB_FILE = "./translation_queue.sqlite"
+DEFAULT_LEASE_SECONDS = 300
+MAX_CHUNK_ATTEMPTS = 3
+
+
+class Job:
+    def __init__(self, row):
+        (
+            self.id,
+            self.input_file,
+            self.output_file,
+            self.transno,
+            self.chunk,
+            self.text,
+            self.attempts,
+        ) = row
+
+
+class JobQueue:
+    def __init__(self, db_file: str = QUEUE_DB_FILE, timeout: float = 60):
+        self.db_file = db_file
+        self.lock = threading.Lock()
+        self.expired_failed = []  # (input_file, output_file, transno) failed in claim()
+        # autocommit mode: transactions are opened explicitly with BEGIN IMMEDIATE
+        self.conn = sqlite3.connect(
+            db_file, timeout=timeout, isolation_level=None, check_same_thread=False
+        )
+        self.conn.execute("PRAGMA journal_mode=WAL")
+        self.conn.executescript(
+            """
+            CREATE TABLE IF NOT EXISTS files (
+                input_file TEXT, transno TEXT, output_file TEXT,
+                assembled INTEGER DEFAULT 0, digest TEXT,
+                PRIMARY KEY (input_file, transno)
+            );
+            CREATE TABLE IF NOT EXISTS chunks (
+                id INTEGER PRIMARY KEY,
+                input_file TEXT, output_file TEXT, transno TEXT, chunk INTEGER,
+                text TEXT, length INTEGER,
+                status TEXT DEFAULT 'pending',
+                owner TEXT, lease_until REAL DEFAULT 0, attempts INTEGER DEFAULT 0,
+                lane TEXT, elapsed REAL, output_chars INTEGER,
+                UNIQUE (input_file, transno, chunk)
+            );
+            CREATE INDEX IF NOT EXISTS chunks_status ON chunks (status, lease_until);
+            """
+        )
+        columns = [row[1] for row in self.conn.execute("PRAGMA table_info(files)")]
+        if "digest" not in columns:
+            self.conn.execute("ALTER TABLE files ADD COLUMN digest TEXT")
+
+    @contextmanager
+    def _transaction(self):
+        """One write transaction; other processes wait on the database lock."""
+        with self.lock:
+            self.conn.execute("BEGIN IMMEDIATE")
+            try:
+                yield self.conn
+            except Exception:
+                self.conn.execute("ROLLBACK")
+                raise
+            self.conn.execute("COMMIT")
+
+    def is_queued(self, input_file, transno: str) -> bool:
+        with self.lock:
+            row = self.conn.execute(
+                "SELECT 1 FROM files WHERE input_file = ? AND transno = ?",
+                (str(input_file), transno),
+            ).fetchone()
+        return row is not None
+
+    def enqueue_file(
+        self,
+        input_file,
+        output_file,
+        transno: str,
+        chunks: list[str],
+        prepare=None,
+        digest: str | None = None,
+    ) -> bool:
+        """Queue the chunks of one file/transno; False if another worker already did.
+
+        With a `digest` of the source, a file queued earlier with another digest
+        (the source changed) is dropped from the queue and queued again. A file
+        queued without a digest (e.g. by queue_worker.py) only gets it saved.
+        `prepare()` runs before the chunks can be claimed (e.g. to write headers).
+        """
+        key = (str(input_file), transno)
+        with self._transaction() as conn:
+            row = conn.execute(
+                "SELECT digest FROM files WHERE input_file = ? AND transno = ?", key
+            ).fetchone()
+            if row is not None:
+                if digest is None or row[0] == digest:
+                    return False
+                if row[0] is None:
+                    # unknown, not changed: keep the translation
+                    conn.execute(
+                        "UPDATE files SET digest = ? WHERE input_file = ? AND transno = ?",
+                        (digest, *key),
+                    )
+                    return False
+                conn.execute(
+                    "DELETE FROM chunks WHERE input_file = ? AND transno = ?", key
+                )
+                conn.execute(
+                    "DELETE FROM files WHERE input_file = ? AND transno = ?", key
+                )
+            conn.execute(
+                "INSERT INTO files (input_file, transno, output_file, digest) VALUES (?, ?, ?, ?)",
+                (*key, str(output_file), digest),
+            )
+            conn.executemany(
+                "INSERT INTO chunks (input_file, output_file, transno, chunk, text, length) "
+                "VALUES (?, ?, ?, ?, ?, ?)",
+                [
+                    (str(input_file), str(output_file), transno, i, chunk, len(chunk))
+                    for i, chunk in enumerate(chunks, 1)
+                ],
+            )
+            if prepare is not None:
+                prepare()
+            return True
+
+    def remember_file(self, input_file, output_file, transno: str, digest: str):
+        """Save the digest of a file translated outside the queue, as finished.
+
+        A later change of the source is then noticed by enqueue_file().
+        """
+        with self._transaction() as conn:
+            conn.execute(
+                "INSERT OR IGNORE INTO files (input_file, transno, output_file, assembled, digest) "
+                "VALUES (?, ?, ?, 1, ?)",
+                (str(input_file), transno, str(output_file), digest),
+            )
+
+    def claim(
+        self,
+        worker_id: str,
+        transnos: list[str],
+        lease_seconds: float = DEFAULT_LEASE_SECONDS,
+        longest_first: bool = False,
+    ) -> Job | None:
+        """Lease the next pending (or expired) chunk of one of `transnos`.
+
+        An expired lease is an attempt whose worker died: it is counted, and a
+        chunk reaching MAX_CHUNK_ATTEMPTS that way is marked failed, not leased
+        (its file is then listed by take_expired_failed()).
+        """
+        now = time.time()
+        order = "length DESC, id" if longest_first else "id"
+        marks = ",".join("?" * len(transnos))
+        with self._transaction() as conn:
+            while True:
+                row = conn.execute(
+                    f"""SELECT id, input_file, output_file, transno, chunk, text, attempts, status
+                        FROM chunks
+                        WHERE transno IN ({marks})
+                          AND (status = 'pending' OR (status = 'leased' AND lease_until < ?))
+                        ORDER BY {order} LIMIT 1""",
+                    (*transnos, now),
+                ).fetchone()
+                if row is None:
+                    return None
+                job = Job(row[:-1])
+                if row[-1] == "leased":
+                    job.attempts += 1
+                    if job.attempts >= MAX_CHUNK_ATTEMPTS:
+                        conn.execute(
+                            "UPDATE chunks SET status = 'failed', attempts = ?, owner = NULL, "
+                            "lease_until = 0 WHERE id = ?",
+                            (job.attempts, job.id),
+                        )
+                        # Write original text instead of translation
+                        ChunkStore(job.output_file).put(job.chunk, job.text)
+                        print(
+                            f"Chunk {job.chunk} of {job.output_file}: lease expired "
+                            f"{job.attempts} times, marked failed"
+                        )
+                        self.expired_failed.append(
+                            (job.input_file, job.output_file, job.transno)
+                        )
+                        continue
+                conn.execute(
+                    "UPDATE chunks SET status = 'leased', owner = ?, lease_until = ?, attempts = ? "
+                    "WHERE id = ?",
+                    (worker_id, now + lease_seconds, job.attempts, job.id),
+                )
+                return job
+
+    def take_expired_failed(self) -> list[tuple[str, str, str]]:
+        """Files with chunks failed by claim() since the last call, to try finishing."""
+        with self.lock:
+            files, self.expired_failed = self.expired_failed, []
+        return files
+
+    def heartbeat(self, worker_id: str, job_ids: list[int], lease_seconds: float = DEFAULT_LEASE_SECONDS):
+        """Extend the leases this worker still holds."""
+        if not job_ids:
+            return
+        marks = ",".join("?" * len(job_ids))
+        with self._transaction() as conn:
+            conn.execute(
+                f"UPDATE chunks SET lease_until = ? WHERE owner = ? AND status = 'leased' AND id IN ({marks})",
+                (time.time() + lease_seconds, worker_id, *job_ids),
+            )
+
+    def complete(self, job: Job, worker_id: str, text: str, lane: str, elapsed: float) -> bool:
+        """Store a finished chunk; False if the lease was lost to another worker."""
+        with self._transaction() as conn:
+            cursor = conn.execute(
+                "UPDATE chunks SET status = 'done', lane = ?, elapsed = ?, output_chars = ? "
+                "WHERE id = ? AND owner = ? AND status = 'leased'",
+                (lane, elapsed, len(text), job.id, worker_id),
+            )
+            if cursor.rowcount:
+                # written inside the transaction, so a taken-over lease can't overwrite it
+                ChunkStore(job.output_file).put(job.chunk, text)
+            return cursor.rowcount == 1
+
+    def fail(self, job: Job, worker_id: str, lane: str) -> str:
+        """Give the chunk back for another attempt; returns its new status."""
+        attempts = job.attempts + 1
+        status = "failed" if attempts >= MAX_CHUNK_ATTEMPTS else "pending"
+        with self._transaction() as conn:
+            cursor = conn.execute(
+                "UPDATE chunks SET status = ?, attempts = ?, owner = NULL, lease_until = 0, lane = ? "
+                "WHERE id = ? AND owner = ? AND status = 'leased'",
+                (status, attempts, lane, job.id, worker_id),
+            )
+            if cursor.rowcount and status == "failed":
+                # Write original text instead of translation
+                ChunkStore(job.output_file).put(job.chunk, job.text)
+        return status
+
+    def try_finish_file(self, input_file, transno: str) -> bool:
+        """True for exactly one caller once every chunk of the file is done or failed."""
+        with self._transaction() as conn:
+            cursor = conn.execute(
+                """UPDATE files SET assembled = 1
+               WHERE input_file = ? AND transno = ? AND assembled = 0
+                 AND NOT EXISTS (
+                   SELECT 1 FROM chunks
+                   WHERE chunks.input_file = files.input_file AND chunks.transno = files.transno
+                     AND status IN ('pending', 'leased'))""",
+                (str(input_file), transno),
+            )
+        return cursor.rowcount == 1
+
+    def finish_file(self, input_file, output_file, transno: str) -> list[int]:
+        """Write the log/events in chunk order and assemble the `.xml`; returns failed chunks."""
+        with self.lock:
+            rows = self.conn.execute(
+                "SELECT chunk, status, lane, elapsed, length, output_chars FROM chunks "
+                "WHERE input_file = ? AND transno = ? ORDER BY chunk",
+                (str(input_file), transno),
+            ).fetchall()
+        events = ChunkEventLog(output_file)
+        log_file = Path(output_file).with_suffix(".log")
+        failed = []
+        with open(log_file, "a", encoding="utf-8") as log_f:
+            for chunk, status, lane, elapsed, length, output_chars in rows:
+                if status == "failed":
+                    failed.append(chunk)
+                    event = events.record(chunk, "failed", lane=lane)
+                else:
+                    event = events.record(
+                        chunk,
+                        "done",
+                        elapsed=round(elapsed, 2),
+                        input_chars=length,
+                        output_chars=output_chars,
+                        lane=lane,
+                    )
+                log_f.write(render_event(event))
+            log_f.write(f"Output saved to {output_file}")
+        ChunkStore(output_file).assemble()
+        return failed
+
+    def finished_transnos(self, input_file) -> list[str]:
+        """Transnos of `input_file` whose translation is assembled."""
+        with self.lock:
+            rows = self.conn.execute(
+                "SELECT transno FROM files WHERE input_file = ? AND assembled = 1",
+                (str(input_file),),
+            ).fetchall()
+        return sorted(row[0] for row in rows)
+
+    def leased(self) -> int:
+        """Number of chunks currently leased by any worker."""
+        return self.progress().get("leased", 0)
+
+    def progress(self) -> dict[str, int]:
+        with self.lock:
+            return dict(
+                self.conn.execute(
+                    "SELECT status, COUNT(*) FROM chunks GROUP BY status"
+                ).fetchall()
+            )
+
+    def close(self):
+        with self.lock:
+            self.conn.close()
@@ -1,27 +1,29 @@
 import argparse
+import heapq
+import os
 import re
 import sys
 from pathlib import Path
-from typing import Dict, Tuple, Optional
+from typing import Optional
 from prompt_toolkit import prompt
 from prompt_toolkit.completion import PathCompleter
 from prompt_toolkit.validation import Validator, ValidationError
 from unidecode import unidecode
 
-from check_translate import check_translation_completeness
+from check_translate import EMPTY_LINE, MISSING_IDS, WRONG_CHUNK, print_check_result
+import line_lexer
+from line_lexer import LineLexer, lex_file
+from section_cache import (
+    code_version,
+    load_manifest,
+    manifest_path,
+    read_chunks,
+    save_manifest,
+    section_key,
+)
 
-
-def extract_id_and_text(line: str) -> Tuple[Optional[int], Optional[str]]:
-    """Extract ID and text from a line tag with an id attribute, handling both closed and unclosed cases."""
-
-    match = re.match(r'<line id="(\d+)">(.*?)(?:</line>)?$', line.strip())
-
-    if match:
-        line_id = int(match.group(1))
-        text = match.group(2).strip() if match.group(2) else None
-        return line_id, text
-
-    return None, None  # Return None if no valid <line> tag is found
+REORDER_WINDOW = 1000  # lines a file may be out of ID order and still be joined
+OUT_OF_ORDER = "out_of_order"  # diagnostic kind of lines beyond REORDER_WINDOW
 
 
 def get_heading_level(text: str) -> Optional[int]:
@@ -32,29 +34,131 @@ def get_heading_level(text: str) -> Optional[int]:
     return count if 0 < count <= 6 else None
 
 
-def get_lines_dict_from_file(file_path: Path) -> Dict[int, str]:
-    """Read XML file and return dictionary of ID -> text mappings"""
-    lines = {}
-    try:
-        with open(file_path, "r", encoding="utf-8") as f:
-            for line in f:
-                id_num, text = extract_id_and_text(line)
-                if id_num:
-                    if id_num in lines:
-                        print(
-                            f"Warning: Duplicate ID {id_num} found in {file_path.name}.  Overwriting previous entry."
-                        )
-                    if text == None:
-                        print("Empty line, id:", id_num)
-                        text = ""
-                    lines[id_num] = text.strip()
-        print(
-            f"Final check by joiner: {len(lines.keys())} line IDs in: {file_path.name}\n\n"
+class LineStream:
+    """The lines of one XML file in ascending ID order, read with the shared lexer.
+
+    Lines up to REORDER_WINDOW places out of ID order are put back in order
+    with a small heap; a line further out of place is reported as late and not
+    joined. Of duplicate IDs the last one is used.
+    """
+
+    def __init__(self, file_path: Path, window: int = REORDER_WINDOW):
+        self.path = file_path
+        self.lexer = LineLexer()
+        self.found = file_path.exists()
+        if not self.found:
+            print(f"Warning: File {file_path} not found")
+        self.records = self._unique(
+            self._ordered(lex_file(file_path, self.lexer), window) if self.found else iter(())
+        )
+        self.count = 0
+        self.duplicates = {}
+        self.late = []
+        self.empty = []
+        # filled in by take()
+        self.missing = []
+        self.extra = []
+        self.diagnostics = []
+        self.misplaced = 0  # lines found in another chunk than in the source
+        self.head = next(self.records, None)
+
+    @staticmethod
+    def _ordered(records, window: int):
+        heap = []
+        for seq, record in enumerate(records):
+            heapq.heappush(heap, (record.id, seq, record))
+            if len(heap) > window:
+                yield heapq.heappop(heap)[2]
+        while heap:
+            yield heapq.heappop(heap)[2]
+
+    def _unique(self, records):
+        previous = None
+        for record in records:
+            if previous is not None and record.id < previous.id:
+                self.late.append(record.id)
+                continue
+            if previous is not None and record.id == previous.id:
+                self.duplicates[record.id] = self.duplicates.get(record.id, 1) + 1
+            elif previous is not None:
+                yield previous
+            previous = record
+        if previous is not None:
+            yield previous
+
+    def __iter__(self):
+        while self.head is not None:
+            record = self.head
+            self._advance()
+            yield record
+
+    def _advance(self):
+        self.count += 1
+        if not self.head.text:
+            self.empty.append(self.head)
+        self.head = next(self.records, None)
+
+    def take(self, source):
+        """Text of the source record's line, or None; lines before it are extra."""
+        while self.head is not None and self.head.id < source.id:
+            self.extra.append(self.head.id)
+            self._advance()
+        if self.head is None or self.head.id != source.id:
+            if self.missing and self.missing[-1][0] == source.chunk:
+                self.missing[-1][1].append(source.id)
+            else:
+                self.missing.append((source.chunk, [source.id]))
+            return None
+        record = self.head
+        self._advance()
+        if record.chunk != source.chunk:
+            self.misplaced += 1
+        if None not in (record.chunk, source.chunk) and record.chunk != source.chunk:
+            self.diagnostics.append(
+                [record.chunk, WRONG_CHUNK, f"ID {record.id} belongs to chunk {source.chunk}"]
+            )
+        return record.text
+
+    def finish(self):
+        """Count the lines after the last source line as extra."""
+        for record in self:
+            self.extra.append(record.id)
+
+    def result(self, source: "LineStream") -> dict:
+        """What the pass found, in the check_translate.compare_scans() format."""
+        if not self.found:
+            return {"ok": False, "error": f"Translation file not found: {self.path}"}
+        diagnostics = list(self.diagnostics)
+        tag_errors = bool(self.lexer.problems or self.late)
+        for chunk, id_, kind, message in self.lexer.problems:
+            diagnostics.append([chunk, kind, message])
+        for record in self.empty:
+            diagnostics.append([record.chunk, EMPTY_LINE, f"ID {record.id}: empty line"])
+        for id_ in self.late:
+            diagnostics.append(
+                [
+                    None,
+                    OUT_OF_ORDER,
+                    f"ID {id_}: more than {REORDER_WINDOW} lines out of order, not joined",
+                ]
+            )
+        for chunk, ids in self.missing:
+            diagnostics.append([chunk, MISSING_IDS, f"missing {len(ids)} IDs: {ids}"])
+        diagnostics.sort(key=lambda d: (d[0] is None, d[0] or 0))
+        missing = [id_ for _, ids in self.missing for id_ in ids]
+        result = {
+            "ids": source.count,
+            "source_duplicates": sorted(source.duplicates.items()),
+            "duplicates": sorted(self.duplicates.items()),
+            "missing": missing,
+            "extra": sorted(self.extra),
+            "diagnostics": diagnostics,
+            "tag_errors": tag_errors,
+        }
+        result["ok"] = bool(source.count) and not (
+            source.duplicates or self.duplicates or missing or tag_errors
         )
-        return lines
-    except FileNotFoundError:
-        print(f"Warning: File {file_path} not found")
-        return {}
+        return result
 
 
 def escape_dot_li(text):
@@ -65,8 +169,193 @@ def escape_dot_li(text):
     return re.sub(r"^(\d+)\.", r"\1\.", text)
 
 
-def create_multilingual_md(source_file: str, num_translations: int = 3) -> None:
-    """Create multilingual markdown from source and target files"""
+def format_entry(id_num: int, source_text: str, trans_texts) -> str:
+    """Markdown of one source line and its translations (None if missing)."""
+    out = [f"<p><i>ID{id_num}</i></p>\n\n"]
+
+    heading_num = get_heading_level(source_text)
+    if heading_num:
+        # Create heading ID based on text content, removing special chars and spaces
+        heading_text = source_text.strip().lstrip("#").strip()
+
+        heading_id_url_friendly = re.sub(
+            r"[^a-zA-Z0-9]+", "-", unidecode(heading_text.lower()).lower()
+        ).strip("-")
+
+        # Add ID number to ensure uniqueness for same text
+
+        heading_id_url_friendly = f"{heading_id_url_friendly}-id{id_num}"
+        out.append(
+            f"<h{heading_num} id='{heading_id_url_friendly}' class='hs'>{escape_dot_li(heading_text)}</h{heading_num}>\n\n"
+        )
+
+        for x, trans_text in enumerate(trans_texts, 1):
+            if trans_text is None:
+                trans_text = f"[MISSING TRANSLATION in translated file {x}]"
+            trans_text = trans_text.strip().lstrip("#").strip()
+            trans_h_id = re.sub(
+                r"[^a-zA-Z0-9]+", "-", unidecode(trans_text).lower()
+            ).strip("-")
+
+            # Add ID number to ensure uniqueness for same text
+            trans_h_id = f"{trans_h_id}-id{id_num}-t{x}"
+
+            out.append(
+                f"<h{heading_num} id='{trans_h_id}' class='ht ht{x}'>{escape_dot_li(trans_text)}</h{heading_num}>\n\n"
+            )
+    else:
+        # k\d+ is the ID for AI Assistant in Tipitakapali.org
+        out.append(f"<p class='s1' id='k{id_num}'>{escape_dot_li(source_text)}</p>\n\n")
+        for i, trans_t_i in enumerate(trans_texts, 1):
+            if trans_t_i is None:
+                trans_t_i = f"[MISSING TRANSLATION in translated file {i}]"
+            out.append(f"<p class='t{i}'>{escape_dot_li(trans_t_i)}</p>\n\n")
+
+    out.append("---\n\n")
+    return "".join(out)
+
+
+def join_version() -> str:
+    return code_version(sys.modules[__name__], line_lexer)
+
+
+def chunk_records(content: bytes, chunk=None, check: Optional[dict] = None) -> dict:
+    """{ID: LineRecord} of one chunk's raw content, the last of duplicate IDs.
+
+    Duplicate IDs, empty lines and tag problems are added to `check` if given.
+    """
+    lexer = LineLexer()
+    records = {}
+    for record in lexer.feed(content) + lexer.close():
+        if check is not None:
+            if record.id in records:
+                check["duplicates"][record.id] = check["duplicates"].get(record.id, 1) + 1
+            if not record.text:
+                check["diagnostics"].append([chunk, EMPTY_LINE, f"ID {record.id}: empty line"])
+        records[record.id] = record
+    if check is not None:
+        for _, _, kind, message in lexer.problems:
+            check["diagnostics"].append([chunk, kind, message])
+            check["tag_errors"] = True
+    return records
+
+
+def join_section(
+    source_content: bytes, trans_contents, chunk=None, checks: Optional[list] = None
+) -> Optional[str]:
+    """Markdown of one source chunk, or None if a translation chunk has lines
+    that are not in the source chunk (they may belong elsewhere).
+
+    With `checks` (one dict per translation, see update_multilingual_md), the
+    lines of the chunk and what is wrong with each translation are added up.
+    """
+    source_records = chunk_records(source_content)
+    trans_lines = []
+    for x, content in enumerate(trans_contents):
+        check = checks[x] if checks is not None else None
+        records = chunk_records(content, chunk, check)
+        if not records.keys() <= source_records.keys():
+            return None
+        if check is not None:
+            check["ids"] += len(source_records)
+            missing = sorted(source_records.keys() - records.keys())
+            if missing:
+                check["missing"] += missing
+                check["diagnostics"].append(
+                    [chunk, MISSING_IDS, f"missing {len(missing)} IDs: {missing}"]
+                )
+        trans_lines.append({id_num: record.text for id_num, record in records.items()})
+    return "".join(
+        format_entry(id_num, source_records[id_num].text, [lines.get(id_num) for lines in trans_lines])
+        for id_num in sorted(source_records)
+    )
+
+
+def update_multilingual_md(source_path: Path, trans_paths, md_output_file: Path) -> bool:
+    """Rejoin only the chunks whose source or translation lines changed since the
+    last join (see section_cache.py). False if a full join is needed."""
+    manifest = load_manifest(md_output_file)
+    if (
+        manifest is None
+        or manifest.get("version") != join_version()
+        or manifest.get("files") != [p.name for p in [source_path] + list(trans_paths)]
+    ):
+        return False
+    source_chunks = read_chunks(source_path)
+    trans_chunks = [read_chunks(path) for path in trans_paths]
+    sections = manifest["sections"]
+    if (
+        source_chunks is None
+        or None in trans_chunks
+        or list(source_chunks) != [section[0] for section in sections]
+        or any(not chunks.keys() <= source_chunks.keys() for chunks in trans_chunks)
+    ):
+        return False
+
+    old_md = None
+    parts, new_sections, position, rejoined = [], [], 0, 0
+    # the compare_scans() result of each translation, for the rejoined chunks
+    checks = [
+        {"ids": 0, "duplicates": {}, "missing": [], "diagnostics": [], "tag_errors": False}
+        for _ in trans_paths
+    ]
+    for chunk, key, start, end in sections:
+        contents = [chunks.get(chunk, b"") for chunks in trans_chunks]
+        new_key = section_key(source_chunks[chunk], *contents)
+        if new_key == key:
+            if old_md is None:
+                with open(md_output_file, "r", encoding="utf-8") as f:
+                    old_md = f.read()
+            text = old_md[start:end]
+        else:
+            text = join_section(source_chunks[chunk], contents, chunk, checks)
+            if text is None:
+                return False
+            rejoined += 1
+        parts.append(text)
+        new_sections.append([chunk, new_key, position, position + len(text)])
+        position += len(text)
+
+    if rejoined:
+        tmp_file = md_output_file.with_name(md_output_file.name + ".tmp")
+        with open(tmp_file, "w", encoding="utf-8") as fo:
+            fo.write("".join(parts))
+        os.replace(tmp_file, md_output_file)
+        manifest["sections"] = new_sections
+        save_manifest(md_output_file, manifest)
+    print(f"Rejoined {rejoined} of {len(sections)} chunks, the others are unchanged.")
+    if rejoined:
+        for path, check in zip(trans_paths, checks):
+            # a translated line outside its source chunk makes a full join, so no extra IDs here
+            result = dict(
+                check,
+                source_duplicates=[],
+                duplicates=sorted(check["duplicates"].items()),
+                extra=[],
+            )
+            result["ok"] = not (result["duplicates"] or result["missing"] or result["tag_errors"])
+            print(f"\n--- {path.name}: {check['ids']} line IDs in the rejoined chunks")
+            print_check_result(
+                result, str(source_path), str(path), f" in the {rejoined} rejoined chunks"
+            )
+    if rejoined < len(sections):
+        # the problems of the unchanged chunks were reported by an earlier join
+        print(
+            f"\nOnly the {rejoined} rejoined chunks were checked, not the other "
+            f"{len(sections) - rejoined}: run check_translate.py or join with --full "
+            "to check the whole file."
+        )
+    return True
+
+
+def create_multilingual_md(
+    source_file: str, num_translations: int = 3, full: bool = False
+) -> None:
+    """Create multilingual markdown from source and target files
+
+    Unless `full`, only the chunks that changed since the last join are joined
+    again, when that is possible (see update_multilingual_md).
+    """
     print(f"\n** Creating a markdown file with {num_translations}-translations...")
 
     source_path = Path(source_file)
@@ -76,73 +365,54 @@ def create_multilingual_md(source_file: str, num_translations: int = 3) -> None:
 
     base_name = source_path.stem
     md_output_file = source_path.parent / f"{base_name}_{num_translations}_translations.md"
+    trans_paths = [
+        source_path.parent / f"{base_name}_translated_{i}.xml"
+        for i in range(1, num_translations + 1)
+    ]
 
-    # Read source and translation files
-    source_lines = get_lines_dict_from_file(source_path)
-    translations = []
-    for i in range(1, num_translations + 1):
-        trans_file = source_path.parent / f"{base_name}_translated_{i}.xml"
-
-        check_translation_completeness(source_file, str(trans_file))
+    if not full and update_multilingual_md(source_path, trans_paths, md_output_file):
+        print(f"\n=== Multilingual markdown updated: {md_output_file}")
+        return
 
-        translations.append(get_lines_dict_from_file(trans_file))
+    # Walk the source and the translations together, in ID order
+    source = LineStream(source_path)
+    translations = [LineStream(path) for path in trans_paths]
 
+    # (chunk, start, end) of each source chunk in the markdown
+    sections = []
+    position = 0
     with open(md_output_file, "w", encoding="utf-8") as fo:
 
         # Write content
-        for id_num in sorted(source_lines.keys()):
-            fo.write(f"<p><i>ID{id_num}</i></p>\n\n")
-            source_text = source_lines[id_num]
-
-            heading_num = get_heading_level(source_text)
-            if heading_num:
-                # Create heading ID based on text content, removing special chars and spaces
-                heading_text = source_text.strip().lstrip("#").strip()
-
-                heading_id_url_friendly = re.sub(
-                    r"[^a-zA-Z0-9]+", "-", unidecode(heading_text.lower()).lower()
-                ).strip("-")
-
-                # Add ID number to ensure uniqueness for same text
-
-                heading_id_url_friendly = f"{heading_id_url_friendly}-id{id_num}"
-                fo.write(
-                    f"<h{heading_num} id='{heading_id_url_friendly}' class='hs'>{escape_dot_li(heading_text)}</h{heading_num}>\n\n"
-                )
-
-                for x, trans in enumerate(translations, 1):
-                    trans_text = (
-                        trans.get(
-                            id_num, f"[MISSING TRANSLATION in translated file {x}]"
-                        )
-                        .strip()
-                        .lstrip("#")
-                        .strip()
-                    )
-                    trans_h_id = re.sub(
-                        r"[^a-zA-Z0-9]+", "-", unidecode(trans_text).lower()
-                    ).strip("-")
-
-                    # Add ID number to ensure uniqueness for same text
-                    trans_h_id = f"{trans_h_id}-id{id_num}-t{x}"
-
-                    fo.write(
-                        f"<h{heading_num} id='{trans_h_id}' class='ht ht{x}'>{escape_dot_li(trans_text)}</h{heading_num}>\n\n"
-                    )
-            else:
-                # k\d+ is the ID for AI Assistant in Tipitakapali.org
-                fo.write(f"<p class='s1' id='k{id_num}'>{escape_dot_li(source_text)}</p>\n\n")
-                for i, trans in enumerate(translations, 1):
-                    trans_t_i = trans.get(
-                        id_num, f"[MISSING TRANSLATION in translated file {i}]"
-                    )
-                    fo.write(f"<p class='t{i}'>{escape_dot_li(trans_t_i)}</p>\n\n")
-
-            fo.write("---\n\n")
+        for record in source:
+            if not sections or sections[-1][0] != record.chunk:
+                sections.append([record.chunk, position, position])
+            entry = format_entry(
+                record.id, record.text, [trans.take(record) for trans in translations]
+            )
+            fo.write(entry)
+            position += len(entry)
+            sections[-1][2] = position
 
         # Write footer
         fo.flush()
 
+    # Report what the pass found, as check_translate.py does
+    if not source.count:
+        print(f"Error: No line IDs found in {source_path.name}")
+    for stream in [source] + translations:
+        for id_num in sorted(stream.duplicates):
+            print(
+                f"Warning: Duplicate ID {id_num} found in {stream.path.name}.  Using the last entry."
+            )
+    for trans in translations:
+        trans.finish()
+        if trans.found:
+            print(f"\n--- {trans.path.name}: {trans.count} line IDs")
+        print_check_result(trans.result(source), source_file, str(trans.path))
+
+    save_join_sections(source, translations, sections, md_output_file)
+
     print(f"\n=== Multilingual markdown created: {md_output_file}")
     print(f"\n\nTo convert to HTML (Tipitakapali.org template):\n\npython3 gen_tpo_html.py --md-file {md_output_file} --translations {num_translations} --title TITLE_HERE")
     print(
@@ -150,6 +420,40 @@ def create_multilingual_md(source_file: str, num_translations: int = 3) -> None:
     )
 
 
+def save_join_sections(source, translations, sections, md_output_file: Path):
+    """Save the keys of the joined chunks, if the next join can rejoin by chunk:
+    every line inside a chunk and every translated line in its source chunk."""
+    chunks = [read_chunks(stream.path) for stream in [source] + translations]
+    chunk_numbers = [section[0] for section in sections]
+    if (
+        None in chunks
+        or None in chunk_numbers
+        or len(set(chunk_numbers)) != len(chunk_numbers)
+        or list(chunks[0]) != chunk_numbers
+        or any(stream.misplaced or stream.late for stream in [source] + translations)
+        or any(not c.keys() <= chunks[0].keys() for c in chunks[1:])
+    ):
+        manifest_path(md_output_file).unlink(missing_ok=True)
+        return
+    source_chunks, trans_chunks = chunks[0], chunks[1:]
+    save_manifest(
+        md_output_file,
+        {
+            "version": join_version(),
+            "files": [stream.path.name for stream in [source] + translations],
+            "sections": [
+                [
+                    chunk,
+                    section_key(source_chunks[chunk], *(c.get(chunk, b"") for c in trans_chunks)),
+                    start,
+                    end,
+                ]
+                for chunk, start, end in sections
+            ],
+        },
+    )
+
+
 class NumberValidator(Validator):
     def validate(self, document):
         text = document.text.strip()
@@ -214,12 +518,17 @@ def main():
             type=int,
             required=True,
         )
+        parser.add_argument(
+            "--full",
+            action="store_true",
+            help="Join every chunk again, not only the chunks that changed",
+        )
 
         args = parser.parse_args()
 
         # Create the markdown file
         create_multilingual_md(
-            args.xml_source_file, num_translations=args.translations
+            args.xml_source_file, num_translations=args.translations, full=args.full
         )
 
 
@@ -0,0 +1,180 @@
+"""Byte-offset index of the chunks and line IDs of a chunk or translation file.
+
+The index is kept next to the file (`X_chunks.xml` -> `X_chunks.idx`) in a
+compact binary form: per line its ID, chunk and the byte range of its text, per
+chunk the byte range of its content. It is built once with the shared lexer
+(line_lexer.py) and rebuilt when the file changes (size/mtime, then sha256).
+The file itself is opened with mmap, so looking up one chunk or line only
+reads that part of it:
+
+index = LineIndex("book_chunks.xml")
+index.chunk(12)      # content of <chunk12>
+index.get(345, "")   # text of <line id="345">
+"""
+
+from __future__ import annotations
+
+import hashlib
+import mmap
+import os
+import struct
+from array import array
+from collections import Counter
+from pathlib import Path
+
+from line_lexer import LineLexer, lex_file
+
+MAGIC = b"LIDX1\0"
+HEADER = struct.Struct("<6sQq32sII")  # magic, size, mtime_ns, sha256, lines, chunks
+NO_CHUNK = 0xFFFFFFFF
+# arrays stored after the header, in this order
+LINE_FIELDS = (("line_ids", "I"), ("line_chunks", "I"), ("text_starts", "Q"), ("text_ends", "Q"))
+CHUNK_FIELDS = (("chunk_numbers", "I"), ("chunk_starts", "Q"), ("chunk_ends", "Q"))
+
+
+def index_path(xml_file) -> Path:
+    return Path(xml_file).with_suffix(".idx")
+
+
+def file_sha256(path) -> bytes:
+    digest = hashlib.sha256()
+    with open(path, "rb") as f:
+        for block in iter(lambda: f.read(1 << 20), b""):
+            digest.update(block)
+    return digest.digest()
+
+
+class LineIndex:
+    """Random access to the chunks and lines of one file, by number and ID."""
+
+    def __init__(self, xml_file):
+        self.xml_file = Path(xml_file)
+        self.f = open(self.xml_file, "rb")
+        stat = os.fstat(self.f.fileno())
+        self.mm = (
+            mmap.mmap(self.f.fileno(), 0, access=mmap.ACCESS_READ) if stat.st_size else b""
+        )
+        if not self._load(stat):
+            self._build(stat)
+        self.positions = {line_id: i for i, line_id in enumerate(self.line_ids)}
+        self.chunk_positions = {n: i for i, n in enumerate(self.chunk_numbers)}
+
+    def _load(self, stat) -> bool:
+        try:
+            with open(index_path(self.xml_file), "rb") as f:
+                data = f.read()
+            magic, size, mtime_ns, sha256, n_lines, n_chunks = HEADER.unpack_from(data)
+        except (OSError, struct.error):
+            return False
+        if magic != MAGIC or size != stat.st_size:
+            return False
+        if mtime_ns != stat.st_mtime_ns:
+            # touched but maybe not changed
+            if sha256 != file_sha256(self.xml_file):
+                return False
+            self._write_header(stat, sha256, n_lines, n_chunks)
+        offset = HEADER.size
+        for fields, count in ((LINE_FIELDS, n_lines), (CHUNK_FIELDS, n_chunks)):
+            for name, typecode in fields:
+                values = array(typecode)
+                end = offset + values.itemsize * count
+                values.frombytes(data[offset:end])
+                setattr(self, name, values)
+                offset = end
+        return True
+
+    def _build(self, stat):
+        lexer = LineLexer(text_spans=True)
+        self.line_ids, self.line_chunks = array("I"), array("I")
+        for chunk, line_id, _, _ in lex_file(self.xml_file, lexer):
+            self.line_ids.append(line_id)
+            self.line_chunks.append(NO_CHUNK if chunk is None else chunk)
+        self.text_starts = array("Q", (start for start, _ in lexer.text_spans))
+        self.text_ends = array("Q", (end for _, end in lexer.text_spans))
+        self.chunk_numbers = array("I", (n for n, _, _ in lexer.chunk_spans))
+        self.chunk_starts = array("Q", (start for _, start, _ in lexer.chunk_spans))
+        self.chunk_ends = array("Q", (end for _, _, end in lexer.chunk_spans))
+
+        path = index_path(self.xml_file)
+        tmp_path = path.with_suffix(".idx.tmp")
+        try:
+            with open(tmp_path, "wb") as f:
+                f.write(
+                    HEADER.pack(
+                        MAGIC,
+                        stat.st_size,
+                        stat.st_mtime_ns,
+                        file_sha256(self.xml_file),
+                        len(self.line_ids),
+                        len(self.chunk_numbers),
+                    )
+                )
+                for name, _ in LINE_FIELDS + CHUNK_FIELDS:
+                    getattr(self, name).tofile(f)
+            os.replace(tmp_path, path)
+        except OSError as e:
+            # a read-only directory only costs the rebuild next time
+            print(f"Could not save index {path}: {e}")
+
+    def _write_header(self, stat, sha256: bytes, n_lines: int, n_chunks: int):
+        try:
+            with open(index_path(self.xml_file), "r+b") as f:
+                f.write(HEADER.pack(MAGIC, stat.st_size, stat.st_mtime_ns, sha256, n_lines, n_chunks))
+        except OSError:
+            pass
+
+    def _text(self, start: int, end: int) -> str:
+        return self.mm[start:end].decode("utf-8", errors="replace")
+
+    def __len__(self) -> int:
+        return len(self.positions)
+
+    def __contains__(self, line_id) -> bool:
+        return line_id in self.positions
+
+    def __getitem__(self, line_id: int) -> str:
+        i = self.positions[line_id]  # the last one of duplicate IDs
+        return self._text(self.text_starts[i], self.text_ends[i]).strip()
+
+    def get(self, line_id: int, default=None):
+        return self[line_id] if line_id in self.positions else default
+
+    def keys(self):
+        return self.positions.keys()
+
+    def duplicates(self) -> dict[int, int]:
+        """{ID: count} of the IDs that appear more than once."""
+        if len(self.positions) == len(self.line_ids):
+            return {}
+        return {i: c for i, c in Counter(self.line_ids).items() if c > 1}
+
+    def chunk_of(self, line_id: int) -> int | None:
+        chunk = self.line_chunks[self.positions[line_id]]
+        return None if chunk == NO_CHUNK else chunk
+
+    def chunk(self, chunk_no: int) -> str | None:
+        """Content of <chunkN> (stripped), or None if there is no such chunk."""
+        i = self.chunk_positions.get(chunk_no)
+        if i is None:
+            return None
+        return self._text(self.chunk_starts[i], self.chunk_ends[i]).strip()
+
+    def chunk_xml(self, chunk_no: int) -> str | None:
+        """`<chunkN>...</chunkN>` with the content as it is in the file."""
+        i = self.chunk_positions.get(chunk_no)
+        if i is None:
+            return None
+        content = self._text(self.chunk_starts[i], self.chunk_ends[i])
+        return f"<chunk{chunk_no}>{content}</chunk{chunk_no}>"
+
+    def close(self):
+        if isinstance(self.mm, mmap.mmap):
+            self.mm.close()
+        self.f.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        self.close()
+        return False
@@ -0,0 +1,190 @@
+"""Tolerant streaming lexer for the `<chunkN>` / `<line id="N">` format.
+
+Chunk files and translations are read through this module so that every tool
+agrees on what a line is. It copes with what LLMs actually send back:
+- a <line> without </line> ends at the next tag, or at the first blank line;
+- newlines inside a line are kept (the text is only stripped);
+- lines outside any chunk get chunk None, a chunk without </chunkN> ends at
+  the next <chunkM> or at the end of the file;
+- stray </line> and unmatched chunk tags are collected in `problems`, each
+  with one of the kinds below.
+
+for chunk, line_id, text, offset in lex_file("book_chunks.xml"):
+    ...
+
+`offset` is the byte offset of the line's `<line id=...>` tag in the file.
+"""
+
+from __future__ import annotations
+
+import re
+from collections import namedtuple
+
+TAG_PATTERN = re.compile(rb'<line id="(\d+)">|</line>|<chunk(\d+)>|</chunk(\d+)>')
+BLANK_LINE = re.compile(rb"\n[ \t\r]*\n")
+READ_SIZE = 1 << 20
+
+LineRecord = namedtuple("LineRecord", "chunk id text offset")
+
+# kinds of `LineLexer.problems`
+UNCLOSED_LINE = "unclosed_line"
+STRAY_LINE_CLOSE = "stray_line_close"
+UNCLOSED_CHUNK = "unclosed_chunk"
+UNMATCHED_CHUNK_CLOSE = "unmatched_chunk_close"
+
+
+def format_line(line_id: int, text: str) -> str:
+    """A line as token_chunk.py writes it."""
+    return f'<line id="{line_id}"> {text} </line>'
+
+
+class LineLexer:
+    """Incremental lexer: feed() it bytes, then close(); both return LineRecords.
+
+    After close(), `problems` holds (chunk, line id or None, kind, message) tuples and
+    `chunk_spans` the (chunk, start, end) byte offsets of each chunk's content.
+    With `text_spans=True`, `text_spans` gets the (start, end) byte range of
+    every record's text (before stripping), in record order.
+    """
+
+    def __init__(self, text_spans: bool = False):
+        self.buffer = b""
+        self.base = 0  # file offset of buffer[0]
+        self.pos = 0  # buffer index lexed so far
+        self.line_no = 1  # line number at self.counted
+        self.counted = 0  # file offset up to which newlines are counted
+        self.chunk = None
+        self.chunk_start = 0
+        self.open_id = None  # <line> whose text is still being read
+        self.open_offset = 0
+        self.text_start = 0  # buffer index of the open line's text
+        self.has_chunks = False
+        self.problems = []
+        self.chunk_spans = []
+        self.text_spans = [] if text_spans else None
+
+    def _line_at(self, index: int) -> int:
+        offset = self.base + index
+        if offset <= self.counted:
+            return self.line_no
+        self.line_no += self.buffer.count(b"\n", self.counted - self.base, index)
+        self.counted = offset
+        return self.line_no
+
+    def _emit(self, end: int, closed: bool) -> LineRecord:
+        text = self.buffer[self.text_start : end]
+        if not closed:
+            blank = BLANK_LINE.search(text)
+            if blank:
+                text = text[: blank.start()]
+            self.problems.append(
+                (
+                    self.chunk,
+                    self.open_id,
+                    UNCLOSED_LINE,
+                    f"ID {self.open_id}: no closing </line>",
+                )
+            )
+        if self.text_spans is not None:
+            start = self.base + self.text_start
+            self.text_spans.append((start, start + len(text)))
+        record = LineRecord(
+            self.chunk,
+            self.open_id,
+            text.decode("utf-8", errors="replace").strip(),
+            self.open_offset,
+        )
+        self.open_id = None
+        return record
+
+    def _end_chunk(self, end: int):
+        self.chunk_spans.append((self.chunk, self.chunk_start, end))
+
+    def feed(self, data: bytes) -> list[LineRecord]:
+        self.buffer += data
+        records = []
+        for match in TAG_PATTERN.finditer(self.buffer, self.pos):
+            line_id, chunk_open, chunk_close = match.groups()
+            if match.group(0) == b"</line>":
+                if self.open_id is not None:
+                    records.append(self._emit(match.start(), closed=True))
+                else:
+                    self.problems.append(
+                        (
+                            self.chunk,
+                            None,
+                            STRAY_LINE_CLOSE,
+                            f"stray </line> at line {self._line_at(match.start())}",
+                        )
+                    )
+            else:
+                if self.open_id is not None:
+                    records.append(self._emit(match.start(), closed=False))
+                if line_id is not None:
+                    self.open_id = int(line_id)
+                    self.open_offset = self.base + match.start()
+                    self.text_start = match.end()
+                elif chunk_open is not None:
+                    self.has_chunks = True
+                    if self.chunk is not None:
+                        self.problems.append(
+                            (
+                                self.chunk,
+                                None,
+                                UNCLOSED_CHUNK,
+                                f"<chunk{self.chunk}> not closed before <chunk{int(chunk_open)}>",
+                            )
+                        )
+                        self._end_chunk(self.base + match.start())
+                    self.chunk = int(chunk_open)
+                    self.chunk_start = self.base + match.end()
+                else:
+                    if self.chunk != int(chunk_close):
+                        self.problems.append(
+                            (
+                                self.chunk,
+                                None,
+                                UNMATCHED_CHUNK_CLOSE,
+                                f"</chunk{int(chunk_close)}> at line {self._line_at(match.start())} does not match",
+                            )
+                        )
+                    if self.chunk is not None:
+                        self._end_chunk(self.base + match.start())
+                    self.chunk = None
+            self.pos = match.end()
+
+        # drop what is lexed, keeping the open line's text and a possibly cut tag
+        keep = self.text_start if self.open_id is not None else self.pos
+        self._line_at(keep)
+        self.buffer = self.buffer[keep:]
+        self.base += keep
+        self.pos -= keep
+        self.text_start -= keep
+        return records
+
+    def close(self) -> list[LineRecord]:
+        records = []
+        if self.open_id is not None:
+            records.append(self._emit(len(self.buffer), closed=False))
+        if self.chunk is not None:
+            self.problems.append(
+                (self.chunk, None, UNCLOSED_CHUNK, f"<chunk{self.chunk}> not closed")
+            )
+            self._end_chunk(self.base + len(self.buffer))
+            self.chunk = None
+        return records
+
+
+def lex_file(path, lexer: LineLexer | None = None):
+    """Yield the LineRecords of a file, reading it in blocks."""
+    lexer = lexer or LineLexer()
+    with open(path, "rb") as f:
+        for block in iter(lambda: f.read(READ_SIZE), b""):
+            yield from lexer.feed(block)
+    yield from lexer.close()
+
+
+def lex_text(text: str, lexer: LineLexer | None = None) -> list[LineRecord]:
+    """LineRecords of a string (offsets are in its UTF-8 encoding)."""
+    lexer = lexer or LineLexer()
+    return lexer.feed(text.encode("utf-8")) + lexer.close()
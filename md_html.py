@@ -0,0 +1,282 @@
+"""Markdown to HTML for the files join_translations.py writes, without pandoc.
+
+The joined markdown only uses a small part of markdown: `<p>`/`<hN>` HTML
+blocks with markdown inside, plain paragraphs, `# headings`, `**bold**`,
+`*italic*`, backslash escapes, inline tags such as `<br />`, and `---`. This
+renders exactly that, the way pandoc (markdown, --wrap=none) does, including
+its smart quotes and dashes.
+
+tests/test_md_html.py compares it with pandoc's output for a sample of joined
+markdown (python3 -m pytest tests). To compare the output with pandoc's on a
+book (needs pypandoc and pandoc):
+
+python3 md_html.py book_chunks_3_translations.md --compare-pandoc
+"""
+
+from __future__ import annotations
+
+import argparse
+import re
+import sys
+from html import escape, unescape
+from html.parser import HTMLParser
+
+BLANK_LINE = re.compile(r"\n[ \t]*\n")
+HR = re.compile(r"(?:-[ \t]*){3,}|(?:\*[ \t]*){3,}|(?:_[ \t]*){3,}")
+ATX_HEADING = re.compile(r"(#{1,6})[ \t]+(.*?)(?:[ \t]+#+)?[ \t]*")
+BLOCK_TAGS = "p|h[1-6]|div|blockquote|section|center"
+HTML_BLOCK = re.compile(rf"<({BLOCK_TAGS})(?=[\s>])[^>]*>", re.IGNORECASE)
+
+# kept as they are: inline tags, comments, entities and backslash escapes
+RAW = re.compile(
+    r"<!--.*?-->|</?[A-Za-z][A-Za-z0-9]*(?:\s[^<>]*)?/?>|&(?:#\d+|#[xX][0-9a-fA-F]+|[A-Za-z][A-Za-z0-9]*);"
+    r"|\\([!-/:-@\[-`{-~])|\\\n| {2,}\n",
+    re.DOTALL,
+)
+STRONG_EMPHASIS = re.compile(r"\*\*\*(?=\S)(.+?)(?<=\S)\*\*\*", re.DOTALL)
+STRONG = re.compile(r"\*\*(?=\S)(.+?)(?<=\S)\*\*", re.DOTALL)
+EMPHASIS = re.compile(r"(?<![\*\w])\*(?=[^\s\*])(.+?)(?<=[^\s\*])\*(?![\*\w])|(?<=\w)\*(?=\w)([^\s\*]+?)\*(?=\w)", re.DOTALL)
+PLACEHOLDER = re.compile("\x00(\\d+)\x00")
+ATTRIBUTE = re.compile(r"""([\w-]+)\s*=\s*(?:"([^"]*)"|'([^']*)'|([^\s"'>]+))""")
+TAG = re.compile(r"<[^>]+>")
+HTML_HEADING = re.compile(r"<h([1-6])(\s[^>]*)?>(.*?)</h\1>", re.IGNORECASE | re.DOTALL)
+
+# pandoc's "smart" extension
+ELLIPSIS = re.compile(r"\.\.\.|\. \. \.")
+EM_DASH = re.compile(r"---")
+EN_DASH = re.compile(r"--")
+DOUBLE_OPEN = re.compile(r'(^|[\s(\[{\u2014\u2013-])"(?=\S)')
+SINGLE_OPEN = re.compile(r"(^|[\s(\[{\u2014\u2013-])'(?=\S)")
+
+
+def smart_punctuation(text: str) -> str:
+    if ". ." in text or "..." in text:
+        text = ELLIPSIS.sub("\u2026", text)
+    if "--" in text:
+        text = EM_DASH.sub("\u2014", text)
+        text = EN_DASH.sub("\u2013", text)
+    if '"' in text:
+        text = DOUBLE_OPEN.sub("\\1\u201c", text).replace('"', "\u201d")
+    if "'" in text:
+        text = SINGLE_OPEN.sub("\\1\u2018", text).replace("'", "\u2019")
+    return text
+
+
+def render_inline(text: str) -> str:
+    """Inline markdown (emphasis, escapes, raw tags) of one block, as HTML."""
+    kept = []
+
+    def keep(match):
+        if match.group(1) is not None:
+            raw = escape(match.group(1), quote=False)
+        elif match.group(0).endswith("\n"):
+            raw = "<br />\n"
+        else:
+            raw = match.group(0)
+        kept.append(raw)
+        return f"\x00{len(kept) - 1}\x00"
+
+    # most lines are plain text, so each rule only runs if its characters are there
+    text = text.strip()
+    if "<" in text or "&" in text or "\\" in text or "  \n" in text:
+        text = RAW.sub(keep, text)
+    if "<" in text or "&" in text or ">" in text:
+        text = escape(text, quote=False)
+    text = smart_punctuation(text)
+    if "*" in text:
+        if "***" in text:
+            text = STRONG_EMPHASIS.sub(r"<strong><em>\1</em></strong>", text)
+        text = STRONG.sub(r"<strong>\1</strong>", text)
+        text = EMPHASIS.sub(lambda m: f"<em>{m.group(1) or m.group(2)}</em>", text)
+    if "\n" in text:
+        text = text.replace("\n", " ")
+    if kept:
+        text = PLACEHOLDER.sub(lambda m: kept[int(m.group(1))], text)
+    return text
+
+
+def heading_identifier(text: str, used: dict) -> str:
+    """Pandoc's auto_identifiers for a `# heading`, unique within the file."""
+    plain = re.sub(r"<[^>]+>", "", text)
+    identifier = re.sub(r"[^\w\s.-]", "", plain.lower(), flags=re.UNICODE)
+    identifier = re.sub(r"\s+", "-", identifier.strip())
+    identifier = re.sub(r"^[^a-z]+", "", identifier) or "section"
+    count = used.get(identifier, 0)
+    used[identifier] = count + 1
+    return identifier if count == 0 else f"{identifier}-{count}"
+
+
+def plain_text(html: str) -> str:
+    """Text of an HTML fragment, whitespace collapsed."""
+    return " ".join(unescape(TAG.sub("", html)).split())
+
+
+def add_heading(headings: list, level: int, opening_tag: str, content: str):
+    """Append (level, id, classes, text) of a heading; id is None if it has none."""
+    attributes = {
+        m.group(1).lower(): next(v for v in m.group(2, 3, 4) if v is not None)
+        for m in ATTRIBUTE.finditer(opening_tag)
+    }
+    headings.append(
+        (level, attributes.get("id"), attributes.get("class", "").split(), plain_text(content))
+    )
+
+
+def html_headings(html: str, headings: list | None = None) -> list:
+    """The headings of rendered HTML, in the format of render_markdown's."""
+    headings = [] if headings is None else headings
+    for match in HTML_HEADING.finditer(html):
+        level, attributes, inner = match.groups()
+        add_heading(headings, int(level), f"<h{level}{attributes or ''}>", inner)
+    return headings
+
+
+def render_markdown(text: str, headings: list | None = None) -> str:
+    """The HTML body for a joined markdown file.
+
+    If a list is given as `headings`, the (level, id, classes, text) of every
+    heading is appended to it while rendering, e.g. for a table of contents.
+    """
+    out = []
+    used_ids = {}
+    # an HTML block whose closing tag is in a later block: (closing, opening, start in out)
+    open_block = None
+    for block in BLANK_LINE.split(text.replace("\r\n", "\n")):
+        block = block.strip()
+        if not block:
+            continue
+        first = block[0]
+        if open_block is not None and block[-len(open_block[0]) :].lower() == open_block[0]:
+            # as pandoc: the text before the closing tag is not a paragraph
+            closing, opening, start = open_block
+            content = block[: -len(closing)]
+            out.append(f"{render_inline(content)}{closing}" if content.strip() else closing)
+            if headings is not None and closing[2] == "h":
+                add_heading(headings, int(closing[3]), opening, "\n".join(out[start:]))
+            open_block = None
+            continue
+        if first in "-*_" and HR.fullmatch(block):
+            out.append("<hr />")
+            continue
+        opening = HTML_BLOCK.match(block) if first == "<" else None
+        if opening:
+            closing = f"</{opening.group(1).lower()}>"
+            inner = block[opening.end() :]
+            if inner[-len(closing) :].lower() == closing:
+                inner = render_inline(inner[: -len(closing)])
+                out.append(f"{opening.group(0)}{inner}{closing}")
+                if headings is not None and closing[2] == "h":
+                    add_heading(headings, int(closing[3]), opening.group(0), inner)
+                continue
+            # markdown blocks inside the tag, until a block ends with its closing tag
+            out.append(opening.group(0))
+            open_block = (closing, opening.group(0), len(out) - 1)
+            if inner.strip():
+                out.append(f"<p>{render_inline(inner)}</p>")
+            continue
+        heading = ATX_HEADING.fullmatch(block) if first == "#" else None
+        if heading:
+            level = len(heading.group(1))
+            content = render_inline(heading.group(2))
+            identifier = heading_identifier(content, used_ids)
+            out.append(f'<h{level} id="{identifier}">{content}</h{level}>')
+            if headings is not None:
+                headings.append((level, identifier, [], plain_text(content)))
+            continue
+        if first == "<" and not RAW.match(block):
+            out.append(block)  # some other raw HTML
+            continue
+        out.append(f"<p>{render_inline(block)}</p>")
+    if open_block is not None and headings is not None and open_block[0][2] == "h":
+        closing, opening, start = open_block
+        add_heading(headings, int(closing[3]), opening, "\n".join(out[start:]))
+    return "\n".join(out) + "\n"
+
+
+def render_markdown_file(md_file, output_file=None) -> str:
+    with open(md_file, "r", encoding="utf-8") as f:
+        html = render_markdown(f.read())
+    if output_file is not None:
+        with open(output_file, "w", encoding="utf-8") as f:
+            f.write(html)
+    return html
+
+
+class _Normalizer(HTMLParser):
+    """Tags and text of an HTML document, ignoring layout whitespace and quoting."""
+
+    def __init__(self):
+        super().__init__(convert_charrefs=True)
+        self.items = []
+
+    def handle_starttag(self, tag, attrs):
+        attrs = " ".join(f'{k}="{v}"' for k, v in sorted(attrs))
+        self.items.append(f"<{tag}{' ' + attrs if attrs else ''}>")
+
+    def handle_endtag(self, tag):
+        self.items.append(f"</{tag}>")
+
+    def handle_data(self, data):
+        data = " ".join(data.split())
+        if data:
+            self.items.append(data)
+
+
+def normalized(html: str) -> list:
+    parser = _Normalizer()
+    parser.feed(html)
+    parser.close()
+    return parser.items
+
+
+def split_sections(items: list) -> list:
+    sections = [[]]
+    for item in items:
+        if item == "<hr>":
+            sections.append([])
+        else:
+            sections[-1].append(item)
+    return sections
+
+
+def compare_with_pandoc(md_file, max_diffs: int = 20) -> bool:
+    """Render md_file with both and print where they differ."""
+    import pypandoc
+
+    with open(md_file, "r", encoding="utf-8") as f:
+        text = f.read()
+    ours = normalized(render_markdown(text))
+    theirs = normalized(
+        pypandoc.convert_text(text, to="html", format="markdown", extra_args=["--wrap=none"])
+    )
+    # one section per joined line, between the <hr />s
+    sections = [split_sections(theirs), split_sections(ours)]
+    if len(sections[0]) != len(sections[1]):
+        print(f"Different number of sections: pandoc {len(sections[0])}, native {len(sections[1])}")
+    diffs = [(a, b) for a, b in zip(*sections) if a != b]
+    for a, b in diffs[:max_diffs]:
+        print(f"pandoc: {' '.join(a)[:300]}\nnative: {' '.join(b)[:300]}\n")
+    print(f"{md_file}: {len(diffs)} of {len(sections[0])} sections differ")
+    diffs += [None] * abs(len(sections[0]) - len(sections[1]))
+    return not diffs
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Render joined markdown as HTML")
+    parser.add_argument("md_file", help="Markdown file from join_translations.py")
+    parser.add_argument("-o", "--output", help="HTML file (default: print it)")
+    parser.add_argument(
+        "--compare-pandoc",
+        action="store_true",
+        help="Diff the output with pandoc's instead of writing it",
+    )
+    args = parser.parse_args()
+    if args.compare_pandoc:
+        sys.exit(0 if compare_with_pandoc(args.md_file) else 1)
+    html = render_markdown_file(args.md_file, args.output)
+    if args.output is None:
+        sys.stdout.write(html)
+
+
+if __name__ == "__main__":
+    main()
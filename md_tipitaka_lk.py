@@ -9,6 +9,8 @@ import sys
 import re
 import re
 
+from line_lexer import lex_file
+
 
 def get_heading(level) -> str:
     """Generates a heading string based on the 'level' in the entry.
@@ -118,11 +120,10 @@ def put_translation_to_id(
 
     lang_key = lang_key.strip()
     trans_dict = {}
-    with open(trans_file, "r", encoding="utf-8") as file:
-        for line in file:
-            k, v = parse_line_for_id(line)
-            if k and v:
-                trans_dict[k] = f"{v}"
+    for _, _, text, _ in lex_file(trans_file):
+        k, v = parse_line_for_id(text)
+        if k and v:
+            trans_dict[k] = f"{v}"
 
     with open(json_file_path, "r", encoding="utf-8") as file:
         json_data = json.load(file)
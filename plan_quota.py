@@ -0,0 +1,277 @@
+"""Plan a directory translation run offline: requests, tokens, cost, ETA and quota days.
+
+The planner reads the `*_chunks.xml` files, counts tokens per chunk and simulates
+the run against the model limits (RPM/TPM/RPD) with the given number of keys and
+concurrent requests. It also re-packs the same lines into other chunk sizes and
+suggests the one that finishes first without exceeding the model's output cap.
+No API call is made.
+
+python3 plan_quota.py -d your_chunks_directory --keys 2 --concurrency 4
+"""
+
+from __future__ import annotations
+
+import argparse
+import fnmatch
+import heapq
+import math
+import os
+import re
+from collections import deque
+
+from quota_store import limits_for
+
+DAY = 24 * 3600
+
+# paid tier USD per 1M tokens (input, output); the free tier costs nothing
+MODEL_PRICES = {
+    "gemini-2.0-flash": (0.10, 0.40),
+    "gemini-2.0-flash-lite": (0.075, 0.30),
+}
+
+CANDIDATE_CHUNK_TOKENS = [2000, 3000, 4000, 5000, 6000, 8000, 10000, 12000, 16000, 20000]
+
+LINE_PATTERN = re.compile(r'<line id="\d+">.*?</line>', re.DOTALL)
+CHUNK_PATTERN = re.compile(r"<chunk(\d+)>(.*?)</chunk\1>", re.DOTALL)
+
+_encoding = None
+
+
+def count_tokens(text: str) -> int:
+    """Token count with tiktoken (as token_chunk.py), or a chars/4 estimate offline."""
+    global _encoding
+    if _encoding is None:
+        try:
+            import tiktoken
+
+            _encoding = tiktoken.encoding_for_model("gpt-4o")
+        except Exception:
+            _encoding = False
+    if _encoding:
+        return len(_encoding.encode(text))
+    return math.ceil(len(text) / 4)
+
+
+def read_chunk_tokens(file_path: str) -> tuple[list[int], list[int]]:
+    """Return (tokens per chunk, tokens per line) of one chunk file."""
+    with open(file_path, "r", encoding="utf-8") as f:
+        content = f.read()
+    chunk_tokens = [count_tokens(m.group(0)) for m in CHUNK_PATTERN.finditer(content)]
+    line_tokens = [count_tokens(line) for line in LINE_PATTERN.findall(content)]
+    return chunk_tokens, line_tokens
+
+
+def repack(line_tokens: list[int], max_tokens: int) -> list[int]:
+    """Greedy re-packing of lines into chunks of at most `max_tokens`, like token_chunk.py."""
+    chunks = []
+    current = 0
+    for tokens in line_tokens:
+        if current and current + tokens > max_tokens:
+            chunks.append(current)
+            current = 0
+        current += tokens
+    if current:
+        chunks.append(current)
+    return chunks
+
+
+def simulate(
+    chunk_tokens: list[int],
+    model: str,
+    keys: int = 1,
+    concurrency: int = 1,
+    rpm: int | None = None,
+    prompt_tokens: int = 0,
+    output_ratio: float = 1.3,
+    base_latency: float = 5.0,
+    output_tps: float = 150.0,
+) -> dict:
+    """Simulate sending every chunk as one request; returns the run statistics."""
+    limits = limits_for(model)
+    rpm = rpm or limits["rpm"]
+    tpm, rpd = limits["tpm"], limits["rpd"]
+
+    requests = [(prompt_tokens + t, math.ceil(t * output_ratio)) for t in chunk_tokens]
+    if concurrency > 1:
+        # same longest-job-first order as chunk_scheduler.py
+        requests.sort(key=lambda r: -r[0])
+
+    # per key: expiry times of the requests / (expiry, tokens) sent in the last minute
+    sent = [deque() for _ in range(keys)]
+    tokens_sent = [deque() for _ in range(keys)]
+    per_day = [{} for _ in range(keys)]  # day -> requests
+    workers = [0.0] * max(1, concurrency)
+    heapq.heapify(workers)
+    finish = 0.0
+    truncated = 0
+
+    def earliest_send(k: int, t: float, tokens: int) -> float:
+        while True:
+            while sent[k] and sent[k][0] <= t:
+                sent[k].popleft()
+            while tokens_sent[k] and tokens_sent[k][0][0] <= t:
+                tokens_sent[k].popleft()
+            day = int(t // DAY)
+            if per_day[k].get(day, 0) >= rpd:
+                t = (day + 1) * DAY
+            elif len(sent[k]) >= rpm:
+                t = sent[k][0]
+            elif tokens_sent[k] and sum(n for _, n in tokens_sent[k]) + tokens > tpm:
+                t = tokens_sent[k][0][0]
+            else:
+                return t
+
+    for input_tokens, output_tokens in requests:
+        t = heapq.heappop(workers)
+        # the key that can send first
+        k, send_at = min(
+            ((k, earliest_send(k, t, input_tokens)) for k in range(keys)),
+            key=lambda x: x[1],
+        )
+        sent[k].append(send_at + 60)
+        tokens_sent[k].append((send_at + 60, input_tokens))
+        day = int(send_at // DAY)
+        per_day[k][day] = per_day[k].get(day, 0) + 1
+        if output_tokens > limits["max_output"]:
+            truncated += 1
+        done = send_at + base_latency + output_tokens / output_tps
+        finish = max(finish, done)
+        heapq.heappush(workers, done)
+
+    input_total = sum(r[0] for r in requests)
+    output_total = sum(r[1] for r in requests)
+    price_in, price_out = MODEL_PRICES.get(model, (0.0, 0.0))
+    days = {day for key_days in per_day for day in key_days}
+    return {
+        "requests": len(requests),
+        "input_tokens": input_total,
+        "output_tokens": output_total,
+        "cost": input_total / 1e6 * price_in + output_total / 1e6 * price_out,
+        "eta_seconds": finish,
+        "quota_days": (max(days) + 1) if days else 0,
+        "over_output_cap": truncated,
+    }
+
+
+def format_duration(seconds: float) -> str:
+    hours, rest = divmod(int(seconds), 3600)
+    minutes, secs = divmod(rest, 60)
+    if hours >= 24:
+        return f"{hours // 24}d {hours % 24}h {minutes}m"
+    return f"{hours}h {minutes}m {secs}s"
+
+
+def format_plan(plan: dict) -> str:
+    return (
+        f"Requests: {plan['requests']}\n"
+        f"Tokens: {plan['input_tokens']:,} input + ~{plan['output_tokens']:,} output\n"
+        f"Estimated cost (paid tier): ${plan['cost']:.2f}\n"
+        f"Estimated wall-clock time: {format_duration(plan['eta_seconds'])}\n"
+        f"Daily quota spans: {plan['quota_days']} day(s)\n"
+        f"Chunks over the output cap (will need continuations): {plan['over_output_cap']}"
+    )
+
+
+def plan_directory(
+    directory: str,
+    file_pattern: str = "*_chunks.xml",
+    model: str = "gemini-2.0-flash",
+    keys: int = 1,
+    concurrency: int = 1,
+    rpm: int | None = None,
+    prompt_file: str | None = None,
+    translations: int = 1,
+    output_ratio: float = 1.3,
+    suggest: bool = True,
+) -> dict:
+    """Print the simulated plan for a directory (and chunk size suggestions)."""
+    files = sorted(f for f in os.listdir(directory) if fnmatch.fnmatch(f, file_pattern))
+    chunk_tokens, line_tokens = [], []
+    for file in files:
+        chunks, lines = read_chunk_tokens(os.path.join(directory, file))
+        chunk_tokens.extend(chunks)
+        line_tokens.extend(lines)
+    # every _translated_N.xml sends every chunk once
+    chunk_tokens = chunk_tokens * translations
+    line_tokens = line_tokens * translations
+
+    prompt_tokens = 0
+    if prompt_file and os.path.exists(prompt_file):
+        with open(prompt_file, "r", encoding="utf-8") as f:
+            prompt_tokens = count_tokens(f.read())
+
+    settings = dict(
+        model=model,
+        keys=keys,
+        concurrency=concurrency,
+        rpm=rpm,
+        prompt_tokens=prompt_tokens,
+        output_ratio=output_ratio,
+    )
+    plan = simulate(chunk_tokens, **settings)
+    print(
+        f"\nPlan for {len(files)} files, {model}, {keys} key(s), {concurrency} concurrent request(s):"
+    )
+    print(format_plan(plan))
+
+    if suggest and line_tokens:
+        max_output = limits_for(model)["max_output"]
+        print("\nChunk size options (--max-tokens for token_chunk.py):")
+        best = None
+        for size in CANDIDATE_CHUNK_TOKENS:
+            option = simulate(repack(line_tokens, size), **settings)
+            fits = math.ceil(size * output_ratio) <= max_output
+            print(
+                f"- {size:>6}: {option['requests']:>5} requests, "
+                f"{format_duration(option['eta_seconds']):>12}, {option['quota_days']} day(s)"
+                f"{'' if fits else '  (output may exceed the cap)'}"
+            )
+            if fits and (best is None or option["eta_seconds"] < best[1]["eta_seconds"]):
+                best = (size, option)
+        if best:
+            print(
+                f"Suggested: --max-tokens {best[0]} "
+                f"({format_duration(best[1]['eta_seconds'])}, {best[1]['requests']} requests)"
+            )
+    return plan
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(
+        description="Simulate a translate_dir_gemini.py run offline (requests, tokens, cost, ETA, quota days)."
+    )
+    parser.add_argument("-d", "--directory", required=True, help="Directory with chunk files")
+    parser.add_argument(
+        "-p", "--pattern", default="*_chunks.xml", help="File pattern (default: *_chunks.xml)"
+    )
+    parser.add_argument("-m", "--model", default="gemini-2.0-flash", help="Model name")
+    parser.add_argument("--keys", type=int, default=1, help="Number of API keys (default: 1)")
+    parser.add_argument(
+        "-c", "--concurrency", type=int, default=1, help="Concurrent requests (default: 1)"
+    )
+    parser.add_argument(
+        "--rpm", type=int, default=None, help="Requests per minute per key (default: model limit)"
+    )
+    parser.add_argument("--prompt", default=None, help="System prompt file sent with every chunk")
+    parser.add_argument(
+        "-n", "--translations", type=int, default=1, help="Number of _translated_N files (default: 1)"
+    )
+    parser.add_argument(
+        "--output-ratio",
+        type=float,
+        default=1.3,
+        help="Output tokens per input token (default: 1.3)",
+    )
+    args = parser.parse_args()
+
+    plan_directory(
+        args.directory,
+        args.pattern,
+        args.model,
+        args.keys,
+        args.concurrency,
+        args.rpm,
+        args.prompt,
+        args.translations,
+        args.output_ratio,
+    )
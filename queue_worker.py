@@ -0,0 +1,302 @@
+"""Translation worker draining a shared job queue (see job_queue.py).
+
+Start one worker per process or machine, each with its own keys; they split the
+chunks of the directory between them instead of translating the same files:
+
+python3 queue_worker.py -d your_chunks_directory -k key_1.txt -c 2
+python3 queue_worker.py -d your_chunks_directory -k key_2.txt key_3.txt -c 4
+
+Every worker queues the files it finds (a file is only queued once), then
+claims chunks until none are left. Use the same --queue file for all workers
+(the workers must run on the machine holding it, see job_queue.py).
+
+To try it without the API, start a few workers with --fake 0.5: each "translates"
+a chunk by returning it unchanged after 0.5s.
+"""
+
+from __future__ import annotations
+
+import argparse
+import fnmatch
+import os
+import socket
+import threading
+import time
+from pathlib import Path
+
+from chunk_events import ChunkEventLog
+from chunk_store import ChunkStore
+from job_queue import DEFAULT_LEASE_SECONDS, QUEUE_DB_FILE, JobQueue
+from run_metrics import metrics, start_metrics_server
+from translator_gemini import (
+    TranslationProfile,
+    load_profiles,
+    read_chunks,
+    set_gemini_key_file,
+    translated_file_exists,
+    write_translation_headers,
+)
+
+
+def fake_translate(latency: float):
+    def translate(chunk: str) -> str:
+        time.sleep(latency)
+        return chunk
+
+    return translate
+
+
+class QueueWorker:
+    def __init__(
+        self,
+        queue: JobQueue,
+        lanes: list[TranslationProfile],
+        concurrency: int = 1,
+        worker_id: str | None = None,
+        lease_seconds: float = DEFAULT_LEASE_SECONDS,
+        on_finished=None,
+    ):
+        self.queue = queue
+        self.lanes = {}
+        for lane in lanes:
+            lane.scheduler.set_in_flight_ceiling(max(1, concurrency))
+            self.lanes.setdefault(lane.transno, []).append(lane)
+            metrics.register_lane(lane)
+        # pending chunks of all workers sharing the queue
+        metrics.progress_source = queue.progress
+        self.concurrency = max(1, concurrency)
+        self.worker_id = worker_id or f"{socket.gethostname()}-{os.getpid()}"
+        self.lease_seconds = lease_seconds
+        self.held = set()  # ids of the chunks this worker is translating
+        self.lock = threading.Lock()
+        self.stopped = threading.Event()
+        self.serving = False
+        self.idle_wait = 5.0
+        self.on_finished = on_finished  # called with (input_file, output_file, transno, failed)
+        self.done = 0
+
+    def queue_file(
+        self, input_file, profile: TranslationProfile, digest: str | None = None
+    ) -> bool:
+        """Queue one file for `profile.transno` unless it is queued or translated already.
+
+        With the source's `digest`, a queued or translated file whose source
+        changed is queued again.
+        """
+        source_path = Path(input_file)
+        transno = profile.transno
+        output_file = source_path.parent / f"{source_path.stem}_{transno}.xml"
+        if self.queue.is_queued(input_file, transno):
+            if digest is None:
+                return False
+        elif translated_file_exists(input_file, transno):
+            if digest is not None:
+                # translated before it was queued: compare digests from now on
+                self.queue.remember_file(input_file, output_file, transno, digest)
+            return False
+        chunks_list = [chunk.strip() for chunk in read_chunks(input_file)]
+        chunks_list = [chunk for chunk in chunks_list if chunk]
+
+        def prepare():
+            # the worker that queues the file writes its headers
+            log_file = output_file.with_suffix(".log")
+            with open(output_file, "w", encoding="utf-8") as f, open(
+                log_file, "w", encoding="utf-8"
+            ) as log_f:
+                header = write_translation_headers(f, log_f, input_file, profile)
+            ChunkEventLog(output_file, fresh=True)
+            ChunkStore(output_file, fresh=True).put_header(header)
+
+        if not chunks_list or not self.queue.enqueue_file(
+            input_file, output_file, transno, chunks_list, prepare, digest
+        ):
+            return False
+        print(f"Queued {len(chunks_list)} chunks of {input_file} [{transno}]")
+        metrics.chunks_queued(transno, len(chunks_list))
+        return True
+
+    def _pick_lane(self, transno: str) -> TranslationProfile:
+        return max(
+            self.lanes[transno],
+            key=lambda lane: (
+                lane.remaining_today() > 0,
+                lane.scheduler.headroom(),
+                -lane.scheduler.in_flight,
+            ),
+        )
+
+    def _heartbeat(self):
+        while not self.stopped.wait(self.lease_seconds / 3):
+            with self.lock:
+                held = list(self.held)
+            try:
+                self.queue.heartbeat(self.worker_id, held, self.lease_seconds)
+            except Exception as e:
+                print(f"Heartbeat failed: {e}")
+
+    def _work(self):
+        transnos = list(self.lanes)
+        while True:
+            job = self.queue.claim(
+                self.worker_id, transnos, self.lease_seconds, self.concurrency > 1
+            )
+            for input_file, output_file, transno in self.queue.take_expired_failed():
+                # a chunk given up after its workers died may have been the last one
+                metrics.chunk_finished(transno, False)
+                self._try_finish(input_file, output_file, transno)
+            if job is None:
+                if self.serving:
+                    # daemon: wait for new files instead of exiting
+                    if self.stopped.wait(self.idle_wait):
+                        return
+                    continue
+                if not self.queue.leased():
+                    return
+                # another worker may die: wait to take over its expired leases
+                time.sleep(min(5, self.lease_seconds / 3))
+                continue
+            with self.lock:
+                self.held.add(job.id)
+            lane = self._pick_lane(job.transno)
+            print(
+                f"\n[{self.worker_id}] [{job.transno}] Translating chunk {job.chunk} of {job.input_file}..."
+            )
+            start_time = time.time()
+            try:
+                translated_text = lane.translate(job.text)
+            except Exception as e:
+                print(f"Error translating chunk {job.chunk}: {e}")
+                translated_text = None
+            elapsed_time = time.time() - start_time
+
+            if translated_text is None:
+                status = self.queue.fail(job, self.worker_id, lane.name)
+                print(f"[{job.transno}] Chunk {job.chunk} failed ({status})")
+                if status == "failed":
+                    metrics.chunk_finished(job.transno, False)
+                else:
+                    metrics.record_chunk_retry()
+            elif self.queue.complete(
+                job, self.worker_id, translated_text, lane.name, elapsed_time
+            ):
+                print(
+                    f"[{job.transno}] Chunk {job.chunk}: Took: {elapsed_time:.2f}s. Lane: {lane.name}"
+                )
+                with self.lock:
+                    self.done += 1
+                metrics.chunk_finished(job.transno, True)
+            else:
+                print(
+                    f"[{job.transno}] Chunk {job.chunk}: lease lost to another worker, result dropped"
+                )
+            with self.lock:
+                self.held.discard(job.id)
+
+            self._try_finish(job.input_file, job.output_file, job.transno)
+
+    def _try_finish(self, input_file, output_file, transno: str):
+        """Assemble the file if this worker is the one to see its last chunk end."""
+        if self.queue.try_finish_file(input_file, transno):
+            failed = self.queue.finish_file(input_file, output_file, transno)
+            print(f"\n=== Finished: {output_file} (failed chunks: {failed or 'none'})")
+            if self.on_finished is not None:
+                self.on_finished(input_file, output_file, transno, failed)
+
+    def start(self) -> list[threading.Thread]:
+        for lanes in self.lanes.values():
+            for lane in lanes:
+                lane.load_quota_state()
+        threading.Thread(target=self._heartbeat, daemon=True).start()
+        workers = [
+            threading.Thread(target=self._work, daemon=True)
+            for _ in range(self.concurrency)
+        ]
+        for worker in workers:
+            worker.start()
+        return workers
+
+    def run(self) -> int:
+        """Drain the queue; returns the number of chunks this worker translated."""
+        for worker in self.start():
+            worker.join()
+        self.stopped.set()
+        return self.done
+
+    def serve(self, idle_wait: float = 5.0) -> list[threading.Thread]:
+        """Keep claiming chunks (checking every `idle_wait`s when idle) until stop()."""
+        self.serving = True
+        self.idle_wait = idle_wait
+        return self.start()
+
+    def stop(self):
+        self.stopped.set()
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(
+        description="Translate chunks from a job queue shared with other workers."
+    )
+    parser.add_argument("-d", "--directory", required=True, help="Directory with chunk files")
+    parser.add_argument(
+        "-p", "--pattern", default="*_chunks.xml", help="File pattern (default: *_chunks.xml)"
+    )
+    parser.add_argument(
+        "-k",
+        "--key-file",
+        nargs="+",
+        default=["./gemini_key_project_1.txt"],
+        help="This worker's Gemini API key files (default: ./gemini_key_project_1.txt)",
+    )
+    parser.add_argument("--profiles", default=None, help="JSON file of model/prompt/key profiles")
+    parser.add_argument(
+        "-c", "--concurrency", type=int, default=1, help="Concurrent requests of this worker"
+    )
+    parser.add_argument(
+        "--queue",
+        default=QUEUE_DB_FILE,
+        help=f"Shared queue database (default: {QUEUE_DB_FILE})",
+    )
+    parser.add_argument(
+        "--lease",
+        type=float,
+        default=DEFAULT_LEASE_SECONDS,
+        help=f"Seconds a claimed chunk stays reserved without heartbeat (default: {DEFAULT_LEASE_SECONDS})",
+    )
+    parser.add_argument("--worker-id", default=None, help="Name of this worker (default: host-pid)")
+    parser.add_argument(
+        "--fake",
+        type=float,
+        default=None,
+        metavar="SECONDS",
+        help="Don't call the API: return each chunk unchanged after SECONDS (for local testing)",
+    )
+    parser.add_argument(
+        "--metrics-port",
+        type=int,
+        default=None,
+        help="Serve live metrics on this local port (/metrics, /status)",
+    )
+    args = parser.parse_args()
+
+    if args.fake is None:
+        set_gemini_key_file(args.key_file[0])
+    if args.profiles:
+        lanes = load_profiles(args.profiles)
+    else:
+        lanes = [TranslationProfile(key_file=k) for k in args.key_file]
+    if args.fake is not None:
+        for lane in lanes:
+            lane.translate = fake_translate(args.fake)
+
+    worker = QueueWorker(
+        JobQueue(args.queue), lanes, args.concurrency, args.worker_id, args.lease
+    )
+    if args.metrics_port:
+        start_metrics_server(args.metrics_port)
+    files = sorted(f for f in os.listdir(args.directory) if fnmatch.fnmatch(f, args.pattern))
+    for file in files:
+        for lane in {lane.transno: lane for lane in lanes}.values():
+            worker.queue_file(os.path.join(args.directory, file), lane)
+
+    done = worker.run()
+    print(f"\nWorker {worker.worker_id} translated {done} chunks. Queue: {worker.queue.progress()}")
@@ -0,0 +1,129 @@
+"""Persistent per-key, per-model request counters for the Gemini quotas.
+
+Every request sent is recorded in a small SQLite file, so a restarted run
+- starts with the requests of the last minute already in its rate window
+  (no burst of 429s right after a crash), and
+- knows how much of the daily quota (RPD) is already used and when it resets.
+
+Keys are stored as a short hash of the API key, never the key itself.
+"""
+
+from __future__ import annotations
+
+import hashlib
+import sqlite3
+import threading
+import time
+from datetime import datetime, timedelta, timezone
+
+QUOTA_DB_FILE = "./gemini_quota.sqlite"
+
+# free tier limits per project, see the table in translator_gemini.py
+# https://ai.google.dev/gemini-api/docs/rate-limits#free-tier
+MODEL_LIMITS = {
+    "gemini-2.0-flash": {"rpm": 15, "tpm": 1_000_000, "rpd": 1500, "max_output": 8192},
+    "gemini-2.0-flash-lite": {"rpm": 30, "tpm": 1_000_000, "rpd": 1500, "max_output": 8192},
+    "gemini-2.0-pro-exp-02-05": {"rpm": 2, "tpm": 1_000_000, "rpd": 50, "max_output": 8192},
+    "gemini-2.0-flash-thinking-exp-01-21": {
+        "rpm": 10,
+        "tpm": 4_000_000,
+        "rpd": 1500,
+        "max_output": 65536,
+    },
+}
+DEFAULT_LIMITS = MODEL_LIMITS["gemini-2.0-flash"]
+DEFAULT_DAILY_LIMIT = DEFAULT_LIMITS["rpd"]
+
+# rows older than this are dropped
+KEEP_SECONDS = 2 * 24 * 3600
+
+try:
+    from zoneinfo import ZoneInfo
+
+    # the daily quota resets at midnight Pacific time
+    QUOTA_TIMEZONE = ZoneInfo("America/Los_Angeles")
+except Exception:
+    QUOTA_TIMEZONE = timezone(timedelta(hours=-8))
+
+
+def limits_for(model: str) -> dict:
+    return MODEL_LIMITS.get(model, DEFAULT_LIMITS)
+
+
+def daily_limit_for(model: str) -> int:
+    return limits_for(model)["rpd"]
+
+
+def key_id_of(key_file: str) -> str:
+    """Short, non-reversible id of the API key in `key_file`."""
+    try:
+        with open(key_file, "r") as file:
+            key = file.read().strip()
+    except OSError:
+        key = key_file
+    return hashlib.sha256(key.encode("utf-8")).hexdigest()[:12]
+
+
+def last_reset(now: datetime | None = None) -> datetime:
+    now = now or datetime.now(QUOTA_TIMEZONE)
+    return now.astimezone(QUOTA_TIMEZONE).replace(
+        hour=0, minute=0, second=0, microsecond=0
+    )
+
+
+def next_reset(now: datetime | None = None) -> datetime:
+    return last_reset(now) + timedelta(days=1)
+
+
+class QuotaStore:
+    def __init__(self, db_file: str = QUOTA_DB_FILE):
+        self.db_file = db_file
+        self.lock = threading.Lock()
+        self.conn = sqlite3.connect(db_file, check_same_thread=False)
+        self.conn.execute(
+            "CREATE TABLE IF NOT EXISTS requests (key_id TEXT, model TEXT, ts REAL)"
+        )
+        self.conn.execute(
+            "CREATE INDEX IF NOT EXISTS requests_key_model_ts ON requests (key_id, model, ts)"
+        )
+        self.conn.execute("DELETE FROM requests WHERE ts < ?", (time.time() - KEEP_SECONDS,))
+        self.conn.commit()
+
+    def record(self, key_id: str, model: str, ts: float | None = None):
+        with self.lock:
+            self.conn.execute(
+                "INSERT INTO requests VALUES (?, ?, ?)", (key_id, model, ts or time.time())
+            )
+            self.conn.commit()
+
+    def recent(self, key_id: str, model: str, seconds: float) -> list[float]:
+        """Wall-clock times of the requests sent in the last `seconds`."""
+        with self.lock:
+            rows = self.conn.execute(
+                "SELECT ts FROM requests WHERE key_id = ? AND model = ? AND ts >= ? ORDER BY ts",
+                (key_id, model, time.time() - seconds),
+            ).fetchall()
+        return [row[0] for row in rows]
+
+    def used_today(self, key_id: str, model: str) -> int:
+        with self.lock:
+            (count,) = self.conn.execute(
+                "SELECT COUNT(*) FROM requests WHERE key_id = ? AND model = ? AND ts >= ?",
+                (key_id, model, last_reset().timestamp()),
+            ).fetchone()
+        return count
+
+    def close(self):
+        with self.lock:
+            self.conn.close()
+
+
+_store = None
+
+
+def get_quota_store() -> QuotaStore:
+    """The shared store in QUOTA_DB_FILE, opened on first use."""
+    global _store
+    if _store is None:
+        _store = QuotaStore()
+    return _store
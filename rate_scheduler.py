@@ -0,0 +1,255 @@
+"""Rate-limit-aware scheduling of Gemini API requests.
+
+A RateScheduler hands out request slots for one key/model so that the number of
+requests sent in any `period` never exceeds `calls_per_minute`, and at most
+`max_in_flight` requests run at the same time. When the API answers with 429,
+`back_off` pauses every worker sharing the scheduler instead of each worker
+sleeping on its own.
+
+AdaptiveRateScheduler additionally tunes its send rate and in-flight count
+(AIMD): it grows additively while requests succeed and shrinks multiplicatively
+on 429 answers or latency spikes. Latencies are collected per model in
+`latency_stats` for p50/p95 reporting.
+"""
+
+from __future__ import annotations
+
+import threading
+import time
+from collections import deque
+
+from run_metrics import metrics
+
+# AIMD tuning
+RATE_DECREASE_ON_429 = 0.7
+RATE_DECREASE_ON_SPIKE = 0.85
+LATENCY_SPIKE_FACTOR = 3.0
+MIN_LATENCY_SAMPLES = 10
+
+
+class LatencyStats:
+    """Recent request latencies per model."""
+
+    def __init__(self, max_samples: int = 500):
+        self.max_samples = max_samples
+        self.samples = {}
+        self.lock = threading.Lock()
+
+    def record(self, model: str, seconds: float):
+        with self.lock:
+            self.samples.setdefault(model, deque(maxlen=self.max_samples)).append(
+                seconds
+            )
+
+    def percentile(self, model: str, p: float) -> float | None:
+        with self.lock:
+            values = sorted(self.samples.get(model, ()))
+        if not values:
+            return None
+        index = min(len(values) - 1, int(round(p / 100 * (len(values) - 1))))
+        return values[index]
+
+    def count(self, model: str) -> int:
+        with self.lock:
+            return len(self.samples.get(model, ()))
+
+    def summary(self) -> str:
+        lines = []
+        for model in sorted(self.samples):
+            lines.append(
+                f"- {model}: {self.count(model)} requests, "
+                f"p50 {self.percentile(model, 50):.2f}s, p95 {self.percentile(model, 95):.2f}s"
+            )
+        return "\n".join(lines)
+
+
+latency_stats = LatencyStats()
+
+
+class RateScheduler:
+    def __init__(
+        self,
+        calls_per_minute: int = 10,
+        period: float = 60,
+        max_in_flight: int = 1,
+        model: str = "",
+    ):
+        self.model = model
+        self.calls_per_minute = calls_per_minute
+        self.period = period
+        self.max_in_flight = max_in_flight
+        self._sent = deque()  # monotonic send times inside the current window
+        self._in_flight = 0
+        self._paused_until = 0.0
+        self._cond = threading.Condition()
+
+    def _drop_expired(self, now: float):
+        while self._sent and now - self._sent[0] >= self.period:
+            self._sent.popleft()
+
+    def acquire(self):
+        """Block until a request may be sent, then reserve the slot."""
+        quota_wait = 0.0  # time spent waiting for the rate limit (not for in-flight)
+        with self._cond:
+            while True:
+                now = time.monotonic()
+                self._drop_expired(now)
+                if now < self._paused_until:
+                    wait = self._paused_until - now
+                elif len(self._sent) >= self.calls_per_minute:
+                    wait = self.period - (now - self._sent[0])
+                elif self._in_flight >= self.max_in_flight:
+                    wait = None  # woken up by release()
+                else:
+                    self._sent.append(now)
+                    self._in_flight += 1
+                    break
+                self._cond.wait(wait)
+                if wait is not None:
+                    quota_wait += time.monotonic() - now
+        if quota_wait:
+            metrics.record_wait(quota_wait)
+
+    def release(self):
+        with self._cond:
+            self._in_flight -= 1
+            self._cond.notify_all()
+
+    def back_off(self, seconds: float):
+        """Pause all new requests for `seconds` (e.g. after a 429)."""
+        with self._cond:
+            self._paused_until = max(self._paused_until, time.monotonic() + seconds)
+            self._cond.notify_all()
+
+    def seed(self, sent_times: list[float]):
+        """Count requests sent before this process started (wall-clock times)."""
+        with self._cond:
+            offset = time.monotonic() - time.time()
+            earlier = sorted(ts + offset for ts in sent_times)
+            self._sent = deque(sorted(earlier + list(self._sent)))
+            self._drop_expired(time.monotonic())
+
+    def set_in_flight_ceiling(self, ceiling: int):
+        """Allow up to `ceiling` concurrent requests."""
+        with self._cond:
+            self.max_in_flight = ceiling
+            self._cond.notify_all()
+
+    def record_success(self, latency: float):
+        """Report a successful request and how long it took."""
+        latency_stats.record(self.model, latency)
+        metrics.record_request(self.model, latency)
+
+    def record_rate_limit(self):
+        """Report a 429 answer."""
+
+    @property
+    def in_flight(self) -> int:
+        return self._in_flight
+
+    def sent_in_window(self) -> int:
+        """Number of requests sent in the last `period`."""
+        with self._cond:
+            self._drop_expired(time.monotonic())
+            return len(self._sent)
+
+    def headroom(self) -> int:
+        """Number of requests that could be sent right now within the window."""
+        with self._cond:
+            self._drop_expired(time.monotonic())
+            return max(0, self.calls_per_minute - len(self._sent))
+
+    def __enter__(self):
+        self.acquire()
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        self.release()
+        return False
+
+
+class AdaptiveRateScheduler(RateScheduler):
+    """RateScheduler whose rate and in-flight count follow AIMD.
+
+    Starts at `calls_per_minute`; after every `max_in_flight` successes both the
+    rate (+1 RPM) and the in-flight count (+1) grow, up to `max_calls_per_minute`
+    and the in-flight ceiling. A 429 cuts both by RATE_DECREASE_ON_429, a request
+    slower than LATENCY_SPIKE_FACTOR x p50 cuts them by RATE_DECREASE_ON_SPIKE.
+    """
+
+    def __init__(
+        self,
+        calls_per_minute: int = 10,
+        period: float = 60,
+        max_in_flight: int = 1,
+        model: str = "",
+        max_calls_per_minute: int | None = None,
+        min_calls_per_minute: float = 1,
+    ):
+        super().__init__(calls_per_minute, period, max_in_flight, model)
+        self.max_calls_per_minute = max_calls_per_minute or calls_per_minute * 4
+        self.min_calls_per_minute = min_calls_per_minute
+        self.in_flight_ceiling = max_in_flight
+        self._recent = deque(maxlen=100)
+        self._streak = 0
+
+    def set_in_flight_ceiling(self, ceiling: int):
+        with self._cond:
+            self.in_flight_ceiling = ceiling
+            self.max_in_flight = min(self.max_in_flight, ceiling)
+            self._cond.notify_all()
+
+    def _decrease(self, factor: float):
+        self.calls_per_minute = max(
+            self.min_calls_per_minute, self.calls_per_minute * factor
+        )
+        self.max_in_flight = max(1, int(self.max_in_flight * factor))
+        self._streak = 0
+
+    def record_success(self, latency: float):
+        super().record_success(latency)
+        with self._cond:
+            if len(self._recent) >= MIN_LATENCY_SAMPLES:
+                p50 = sorted(self._recent)[len(self._recent) // 2]
+                if latency > LATENCY_SPIKE_FACTOR * p50:
+                    self._recent.append(latency)
+                    self._decrease(RATE_DECREASE_ON_SPIKE)
+                    return
+            self._recent.append(latency)
+            self._streak += 1
+            if self._streak >= self.max_in_flight:
+                self._streak = 0
+                self.calls_per_minute = min(
+                    self.max_calls_per_minute, self.calls_per_minute + 1
+                )
+                self.max_in_flight = min(self.in_flight_ceiling, self.max_in_flight + 1)
+                self._cond.notify_all()
+
+    def record_rate_limit(self):
+        with self._cond:
+            self._decrease(RATE_DECREASE_ON_429)
+
+
+def is_rate_limit_error(error: Exception) -> bool:
+    """True if the exception looks like a 429 / RESOURCE_EXHAUSTED answer."""
+    if getattr(error, "code", None) == 429:
+        return True
+    message = str(error)
+    return "429" in message or "RESOURCE_EXHAUSTED" in message
+
+
+def error_class(error: Exception) -> str:
+    """Coarse class of a failed request: rate_limit, server, timeout or other."""
+    if is_rate_limit_error(error):
+        return "rate_limit"
+    code = getattr(error, "code", None)
+    message = str(error)
+    if (isinstance(code, int) and code >= 500) or any(
+        s in message for s in ("500", "503", "INTERNAL", "UNAVAILABLE")
+    ):
+        return "server"
+    if isinstance(error, TimeoutError) or any(
+        s in message.lower() for s in ("timeout", "timed out", "deadline")
+    ):
+        return "timeout"
+    return "other"
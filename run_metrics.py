@@ -0,0 +1,287 @@
+"""Live metrics of a translation run, served locally and shown in a terminal view.
+
+The translators update the shared `metrics` object (chunks queued/done/failed,
+requests and their latency, errors by class, tokens, time spent waiting for a
+rate-limit slot). With `--metrics-port 8765` a run serves them at
+- http://127.0.0.1:8765/metrics  (Prometheus text format)
+- http://127.0.0.1:8765/status   (JSON)
+
+and a compact live view can be opened in another terminal:
+
+python3 run_metrics.py --url http://127.0.0.1:8765
+
+The "bottleneck" field tells where the time goes over the last minutes:
+"failures" (many errors), "quota" (more time waiting for rate-limit slots than
+in requests) or "latency" (the requests themselves).
+"""
+
+from __future__ import annotations
+
+import argparse
+import json
+import threading
+import time
+from collections import Counter, deque
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.request import urlopen
+
+RATE_WINDOW = 60  # seconds for the per-minute rates
+TREND_WINDOW = 300  # seconds for ETA and bottleneck
+
+
+def _percentile(values: list[float], p: float) -> float | None:
+    if not values:
+        return None
+    values = sorted(values)
+    return values[min(len(values) - 1, int(round(p / 100 * (len(values) - 1))))]
+
+
+class RunMetrics:
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.started = time.time()
+        self.chunks = {}  # transno -> Counter(queued, done, failed)
+        self.lanes = {}  # lane name -> lane (with .scheduler)
+        self.errors = Counter()  # error class -> failed requests
+        self.chunk_retries = 0
+        self.wait_seconds = 0.0
+        self.progress_source = None  # optional callable -> {status: count}, e.g. JobQueue.progress
+        self._requests = deque()  # (time, model, latency)
+        self._errors = deque()  # time
+        self._tokens = deque()  # (time, tokens)
+        self._waits = deque()  # (time, seconds)
+        self._finished = deque()  # time a chunk was finished
+
+    def _trim(self, now: float):
+        for events in (self._requests, self._errors, self._tokens, self._waits, self._finished):
+            while events and now - (events[0] if isinstance(events[0], float) else events[0][0]) > TREND_WINDOW:
+                events.popleft()
+
+    def register_lane(self, lane):
+        with self.lock:
+            self.lanes[lane.name] = lane
+
+    def chunks_queued(self, transno: str, count: int):
+        with self.lock:
+            self.chunks.setdefault(transno, Counter())["queued"] += count
+
+    def chunk_finished(self, transno: str, ok: bool):
+        with self.lock:
+            self.chunks.setdefault(transno, Counter())["done" if ok else "failed"] += 1
+            self._finished.append(time.time())
+
+    def record_chunk_retry(self):
+        with self.lock:
+            self.chunk_retries += 1
+
+    def record_request(self, model: str, latency: float):
+        with self.lock:
+            self._requests.append((time.time(), model, latency))
+
+    def record_error(self, error_class: str):
+        with self.lock:
+            self.errors[error_class] += 1
+            self._errors.append(time.time())
+
+    def record_tokens(self, tokens: int):
+        with self.lock:
+            self._tokens.append((time.time(), tokens))
+
+    def record_wait(self, seconds: float):
+        with self.lock:
+            self.wait_seconds += seconds
+            self._waits.append((time.time(), seconds))
+
+    def snapshot(self) -> dict:
+        now = time.time()
+        progress = self.progress_source() if self.progress_source else None
+        with self.lock:
+            self._trim(now)
+            window = min(TREND_WINDOW, max(1.0, now - self.started))
+            last_minute = [r for r in self._requests if now - r[0] <= RATE_WINDOW]
+            models = {}
+            for _, model, latency in self._requests:
+                models.setdefault(model, []).append(latency)
+
+            chunks = {t: dict(c) for t, c in self.chunks.items()}
+            if progress is not None:
+                pending = progress.get("pending", 0) + progress.get("leased", 0)
+            else:
+                pending = sum(
+                    c["queued"] - c["done"] - c["failed"] for c in self.chunks.values()
+                )
+            finish_rate = len(self._finished) / window  # chunks per second
+            eta = pending / finish_rate if finish_rate and pending else None
+
+            busy = sum(r[2] for r in self._requests)
+            waited = sum(w[1] for w in self._waits)
+            recent_errors = len(self._errors)
+            if recent_errors > 0.2 * max(1, recent_errors + len(self._requests)):
+                bottleneck = "failures"
+            elif waited > busy:
+                bottleneck = "quota"
+            else:
+                bottleneck = "latency"
+
+            lanes = {}
+            for name, lane in self.lanes.items():
+                scheduler = lane.scheduler
+                lanes[name] = {
+                    "rpm": scheduler.sent_in_window(),
+                    "rpm_limit": round(scheduler.calls_per_minute, 1),
+                    "in_flight": scheduler.in_flight,
+                }
+
+            return {
+                "elapsed_seconds": round(now - self.started, 1),
+                "chunks": chunks,
+                "pending": pending,
+                "queue": progress,
+                "chunk_retries": self.chunk_retries,
+                "requests_per_minute": len(last_minute),
+                "tokens_per_minute": sum(
+                    t[1] for t in self._tokens if now - t[0] <= RATE_WINDOW
+                ),
+                "latency": {
+                    model: {
+                        "count": len(values),
+                        "p50": round(_percentile(values, 50), 2),
+                        "p95": round(_percentile(values, 95), 2),
+                    }
+                    for model, values in models.items()
+                },
+                "errors": dict(self.errors),
+                "rate_wait_seconds": round(self.wait_seconds, 1),
+                "lanes": lanes,
+                "eta_seconds": round(eta) if eta is not None else None,
+                "bottleneck": bottleneck,
+            }
+
+    def prometheus(self) -> str:
+        s = self.snapshot()
+        lines = [
+            "# HELP translation_chunks Chunks by translation and state.",
+            "# TYPE translation_chunks gauge",
+        ]
+        for transno, counts in s["chunks"].items():
+            for state, value in counts.items():
+                lines.append(f'translation_chunks{{transno="{transno}",state="{state}"}} {value}')
+        lines += [
+            "# TYPE translation_chunks_pending gauge",
+            f"translation_chunks_pending {s['pending']}",
+            "# TYPE translation_chunk_retries_total counter",
+            f"translation_chunk_retries_total {s['chunk_retries']}",
+            "# TYPE translation_eta_seconds gauge",
+            f"translation_eta_seconds {s['eta_seconds'] if s['eta_seconds'] is not None else 'NaN'}",
+            "# TYPE gemini_requests_per_minute gauge",
+            f"gemini_requests_per_minute {s['requests_per_minute']}",
+            "# TYPE gemini_tokens_per_minute gauge",
+            f"gemini_tokens_per_minute {s['tokens_per_minute']}",
+            "# TYPE gemini_rate_wait_seconds_total counter",
+            f"gemini_rate_wait_seconds_total {s['rate_wait_seconds']}",
+            "# TYPE gemini_lane_requests_per_minute gauge",
+        ]
+        for name, lane in s["lanes"].items():
+            lines.append(f'gemini_lane_requests_per_minute{{lane="{name}"}} {lane["rpm"]}')
+        lines.append("# TYPE gemini_lane_rpm_limit gauge")
+        for name, lane in s["lanes"].items():
+            lines.append(f'gemini_lane_rpm_limit{{lane="{name}"}} {lane["rpm_limit"]}')
+        lines.append("# TYPE gemini_request_latency_seconds summary")
+        for model, latency in s["latency"].items():
+            for q in ("50", "95"):
+                lines.append(
+                    f'gemini_request_latency_seconds{{model="{model}",quantile="0.{q}"}} {latency["p" + q]}'
+                )
+            lines.append(f'gemini_request_latency_seconds_count{{model="{model}"}} {latency["count"]}')
+        lines.append("# TYPE gemini_request_errors_total counter")
+        for error_class, count in s["errors"].items():
+            lines.append(f'gemini_request_errors_total{{class="{error_class}"}} {count}')
+        return "\n".join(lines) + "\n"
+
+
+metrics = RunMetrics()
+
+
+class _Handler(BaseHTTPRequestHandler):
+    def do_GET(self):
+        if self.path.startswith("/metrics"):
+            body = metrics.prometheus().encode("utf-8")
+            content_type = "text/plain; version=0.0.4"
+        elif self.path in ("/", "/status"):
+            body = json.dumps(metrics.snapshot(), indent=2).encode("utf-8")
+            content_type = "application/json"
+        else:
+            self.send_error(404)
+            return
+        self.send_response(200)
+        self.send_header("Content-Type", content_type)
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        pass  # keep the translation output readable
+
+
+def start_metrics_server(port: int, host: str = "127.0.0.1") -> ThreadingHTTPServer:
+    """Serve /metrics and /status in a background thread."""
+    server = ThreadingHTTPServer((host, port), _Handler)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    print(f"Metrics at http://{host}:{port}/metrics and /status")
+    return server
+
+
+def format_duration(seconds) -> str:
+    if seconds is None:
+        return "-"
+    minutes, secs = divmod(int(seconds), 60)
+    hours, minutes = divmod(minutes, 60)
+    return f"{hours}h{minutes:02d}m{secs:02d}s" if hours else f"{minutes}m{secs:02d}s"
+
+
+def render_status(s: dict) -> str:
+    """Compact text view of a /status snapshot."""
+    lines = [
+        f"Elapsed {format_duration(s['elapsed_seconds'])}  ETA {format_duration(s['eta_seconds'])}  "
+        f"Bottleneck: {s['bottleneck'].upper()}",
+    ]
+    for transno, c in sorted(s["chunks"].items()):
+        lines.append(
+            f"  {transno}: {c.get('done', 0)} done, {c.get('failed', 0)} failed of {c.get('queued', 0)} queued"
+        )
+    lines.append(
+        f"Pending {s['pending']}  Requests/min {s['requests_per_minute']}  "
+        f"Tokens/min {s['tokens_per_minute']:,}  Rate wait {s['rate_wait_seconds']}s  "
+        f"Chunk retries {s['chunk_retries']}"
+    )
+    for model, latency in sorted(s["latency"].items()):
+        lines.append(f"  {model}: p50 {latency['p50']}s  p95 {latency['p95']}s  ({latency['count']} recent)")
+    for name, lane in sorted(s["lanes"].items()):
+        lines.append(
+            f"  {name}: {lane['rpm']}/{lane['rpm_limit']} RPM, {lane['in_flight']} in flight"
+        )
+    if s["errors"]:
+        lines.append("Errors: " + ", ".join(f"{k} {v}" for k, v in sorted(s["errors"].items())))
+    return "\n".join(lines)
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Live view of a translation run's metrics.")
+    parser.add_argument(
+        "--url", default="http://127.0.0.1:8765", help="Metrics server of the run"
+    )
+    parser.add_argument("--interval", type=float, default=2, help="Refresh seconds (default: 2)")
+    args = parser.parse_args()
+
+    try:
+        while True:
+            try:
+                with urlopen(f"{args.url.rstrip('/')}/status", timeout=5) as response:
+                    view = render_status(json.load(response))
+            except OSError as e:
+                view = f"Cannot reach {args.url}: {e}"
+            # clear the screen and redraw
+            print("\033[2J\033[H" + view, flush=True)
+            time.sleep(args.interval)
+    except KeyboardInterrupt:
+        pass
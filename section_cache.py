@@ -0,0 +1,100 @@
+"""Per-chunk content keys, so a rebuild only redoes the chunks that changed.
+
+join_translations.py keeps `<book>_N_translations.sections.json` next to the
+markdown it writes: for each source chunk (a section) a key made from the raw
+bytes of that chunk in the source and in every translation, and where the
+section is in the markdown. gen_tpo_html.py keeps the rendered HTML of each
+section under the same keys (`<page>.html.sections.json`/`.sections.html`).
+A section whose key did not change is copied from the previous output.
+
+Only files whose lines are all inside `<chunkN>` tags can be split this way;
+for anything else read_chunks() returns None and the callers rebuild all.
+"""
+
+from __future__ import annotations
+
+import hashlib
+import json
+import os
+import re
+from pathlib import Path
+
+CHUNK_TAG = re.compile(rb"<chunk(\d+)>|</chunk(\d+)>")
+LINE_TAG = b'<line id="'
+
+
+def read_chunks(path) -> dict | None:
+    """{chunk number: raw bytes of its content}; {} for a missing file.
+
+    None if the file has lines outside the chunks, a repeated or nested chunk.
+    """
+    try:
+        data = Path(path).read_bytes()
+    except FileNotFoundError:
+        return {}
+    chunks = {}
+    position = 0  # end of the last chunk
+    opened = None
+    for match in CHUNK_TAG.finditer(data):
+        opening, closing = match.groups()
+        if opening is not None:
+            if opened is not None or data.find(LINE_TAG, position, match.start()) != -1:
+                return None
+            opened = (int(opening), match.end())
+        else:
+            if opened is None or int(closing) != opened[0] or opened[0] in chunks:
+                return None
+            chunks[opened[0]] = data[opened[1] : match.start()]
+            position = match.end()
+            opened = None
+    if opened is not None or data.find(LINE_TAG, position) != -1:
+        return None
+    return chunks
+
+
+def section_key(*parts: bytes) -> str:
+    digest = hashlib.sha256()
+    for part in parts:
+        digest.update(len(part).to_bytes(8, "little"))
+        digest.update(part)
+    return digest.hexdigest()
+
+
+def code_version(*modules) -> str:
+    """Key of the code that builds the output, so a change to it rebuilds all."""
+    return section_key(*(Path(module.__file__).read_bytes() for module in modules))
+
+
+def file_signature(path) -> list | None:
+    try:
+        stat = os.stat(path)
+    except OSError:
+        return None
+    return [stat.st_size, stat.st_mtime_ns]
+
+
+def manifest_path(output_file) -> Path:
+    output_file = Path(output_file)
+    return output_file.with_name(output_file.name + ".sections.json")
+
+
+def load_manifest(output_file) -> dict | None:
+    """The manifest saved with output_file, if the file is still as it was written."""
+    try:
+        with open(manifest_path(output_file), "r", encoding="utf-8") as f:
+            manifest = json.load(f)
+    except (OSError, ValueError):
+        return None
+    if manifest.get("output") != file_signature(output_file):
+        return None
+    return manifest
+
+
+def save_manifest(output_file, manifest: dict):
+    """Save the manifest of output_file (after output_file is written)."""
+    manifest["output"] = file_signature(output_file)
+    path = manifest_path(output_file)
+    tmp_path = path.with_name(path.name + ".tmp")
+    with open(tmp_path, "w", encoding="utf-8") as f:
+        json.dump(manifest, f, ensure_ascii=False)
+    os.replace(tmp_path, path)
@@ -0,0 +1,78 @@
+"""chunk_store.py: splitting an existing translation and assembling it again."""
+
+import pytest
+
+from chunk_store import ChunkStore, split_translation
+
+HEADER = "<info>\nTranslated by a model\n</info>\n\n"
+CHUNKS = {
+    1: '<chunk1>\n<line id="1">one</line>\n</chunk1>',
+    2: '<chunk2>\n<line id="2">two</line>\n</chunk2>',
+    3: '<chunk3>\n<line id="3">three</line>\n</chunk3>',
+}
+
+
+def write(path, text):
+    path.write_text(text, encoding="utf-8")
+    return path
+
+
+@pytest.fixture
+def translation(tmp_path):
+    return write(
+        tmp_path / "book_chunks_translated_1.xml",
+        HEADER + "".join(chunk + "\n\n" for chunk in CHUNKS.values()),
+    )
+
+
+def test_split_translation(translation):
+    assert split_translation(translation) == (HEADER, CHUNKS)
+
+
+def test_chunk_without_closing_tag_is_kept(tmp_path):
+    path = write(
+        tmp_path / "x_translated_1.xml",
+        HEADER + '<chunk1>\n<line id="1">one</line>\n\n' + CHUNKS[2] + "\n",
+    )
+    header, chunks = split_translation(path)
+    assert header == HEADER
+    assert chunks == {1: '<chunk1>\n<line id="1">one</line>', 2: CHUNKS[2]}
+
+
+def test_line_outside_chunks_is_an_error(tmp_path):
+    path = write(
+        tmp_path / "x_translated_1.xml",
+        CHUNKS[1] + '\n<line id="9">lost</line>\n' + CHUNKS[2],
+    )
+    with pytest.raises(ValueError, match="outside every chunk"):
+        split_translation(path)
+
+
+def test_repeated_chunk_is_an_error(tmp_path):
+    path = write(tmp_path / "x_translated_1.xml", CHUNKS[1] + "\n" + CHUNKS[1])
+    with pytest.raises(ValueError, match="more than once"):
+        split_translation(path)
+    # a file that can't be split leaves no store behind
+    with pytest.raises(ValueError):
+        ChunkStore(path)
+    assert not path.with_suffix(".chunks").exists()
+
+
+def test_assemble_round_trip(translation):
+    original = translation.read_text(encoding="utf-8")
+    store = ChunkStore(translation)
+    assert store.chunk_numbers() == [1, 2, 3]
+    store.assemble()
+    assert translation.read_text(encoding="utf-8") == original
+
+
+def test_replaced_chunk_is_assembled_in_place(translation):
+    fixed = '<chunk2>\n<line id="2">TWO</line>\n</chunk2>'
+    store = ChunkStore(translation)
+    store.put(2, fixed)
+    store.assemble()
+    header, chunks = split_translation(translation)
+    assert header == HEADER
+    assert chunks == {**CHUNKS, 2: fixed}
+    # reopening uses the store, not a new split of the file
+    assert ChunkStore(translation).get(2) == chunks[2]
@@ -0,0 +1,91 @@
+"""line_index.py: the .idx sidecar is reused only while the file is unchanged."""
+
+import os
+import re
+
+import pytest
+
+import line_index
+from line_index import LineIndex, file_sha256, index_path
+
+TEXT = "".join(
+    f'<chunk{c}>\n'
+    + "".join(f'<line id="{c * 10 + i}"> pāḷi {c}.{i} </line>\n' for i in range(3))
+    + f"</chunk{c}>\n\n"
+    for c in range(1, 5)
+)
+
+
+@pytest.fixture
+def book(tmp_path):
+    path = tmp_path / "book_chunks.xml"
+    path.write_text(TEXT, encoding="utf-8")
+    return path
+
+
+@pytest.fixture
+def builds(monkeypatch):
+    calls = []
+    build = LineIndex._build
+
+    def counting_build(self, stat):
+        calls.append(self.xml_file)
+        build(self, stat)
+
+    monkeypatch.setattr(LineIndex, "_build", counting_build)
+    return calls
+
+
+def open_index(path):
+    with LineIndex(path) as index:
+        return {line_id: index[line_id] for line_id in index.keys()}
+
+
+def test_index_is_saved_and_reused(book, builds):
+    first = open_index(book)
+    assert index_path(book).exists()
+    assert open_index(book) == first
+    assert len(builds) == 1
+    assert first[21] == "pāḷi 2.1"
+
+
+def test_size_change_rebuilds(book, builds):
+    open_index(book)
+    book.write_text(TEXT + '<chunk5>\n<line id="50">new</line>\n</chunk5>\n', encoding="utf-8")
+    assert open_index(book)[50] == "new"
+    assert len(builds) == 2
+
+
+def test_touched_file_is_checked_by_sha256(book, builds, monkeypatch):
+    open_index(book)
+    hashed = []
+    monkeypatch.setattr(
+        line_index, "file_sha256", lambda path: hashed.append(path) or file_sha256(path)
+    )
+    stat = book.stat()
+    os.utime(book, ns=(stat.st_atime_ns, stat.st_mtime_ns + 10**9))
+    open_index(book)
+    assert (len(builds), len(hashed)) == (1, 1)
+    # the new mtime is saved, so the hash is not computed again
+    open_index(book)
+    assert (len(builds), len(hashed)) == (1, 1)
+
+
+def test_same_size_edit_rebuilds(book, builds):
+    open_index(book)
+    stat = book.stat()
+    book.write_text(TEXT.replace("pāḷi 3.2", "PĀḶI 3.2"), encoding="utf-8")
+    assert book.stat().st_size == stat.st_size
+    os.utime(book, ns=(stat.st_atime_ns, stat.st_mtime_ns + 10**9))
+    assert open_index(book)[32] == "PĀḶI 3.2"
+    assert len(builds) == 2
+
+
+def test_chunk_xml_matches_regex_extraction(book):
+    with LineIndex(book) as index:
+        assert sorted(index.chunk_numbers) == [1, 2, 3, 4]
+        for n in index.chunk_numbers:
+            match = re.search(rf"<chunk{n}>.*?</chunk{n}>", TEXT, re.DOTALL)
+            assert index.chunk_xml(n) == match.group(0)
+            assert index.chunk_of(n * 10) == n
+        assert index.chunk_xml(9) is None
@@ -0,0 +1,88 @@
+"""line_lexer.py on the broken files LLMs send back."""
+
+from line_lexer import (
+    STRAY_LINE_CLOSE,
+    UNCLOSED_CHUNK,
+    UNCLOSED_LINE,
+    UNMATCHED_CHUNK_CLOSE,
+    LineLexer,
+    lex_text,
+)
+
+
+def lex(text: str):
+    lexer = LineLexer()
+    records = lex_text(text, lexer)
+    return [(r.chunk, r.id, r.text) for r in records], lexer
+
+
+def kinds(lexer):
+    return [(chunk, id_, kind) for chunk, id_, kind, _ in lexer.problems]
+
+
+def test_well_formed_chunks():
+    records, lexer = lex(
+        '<chunk1>\n<line id="1"> a </line>\n<line id="2">b\nc</line>\n</chunk1>\n'
+        '<chunk2>\n<line id="3">d</line>\n</chunk2>\n'
+    )
+    assert records == [(1, 1, "a"), (1, 2, "b\nc"), (2, 3, "d")]
+    assert lexer.problems == []
+    assert [chunk for chunk, _, _ in lexer.chunk_spans] == [1, 2]
+
+
+def test_unclosed_line_ends_at_next_tag_or_blank_line():
+    records, lexer = lex(
+        '<chunk1>\n<line id="1">a\n<line id="2">b\n\nnot a line\n</chunk1>\n'
+    )
+    assert records == [(1, 1, "a"), (1, 2, "b")]
+    assert kinds(lexer) == [(1, 1, UNCLOSED_LINE), (1, 2, UNCLOSED_LINE)]
+
+
+def test_stray_line_close():
+    records, lexer = lex('<chunk1>\n<line id="1">a</line></line>\n</chunk1>\n')
+    assert records == [(1, 1, "a")]
+    assert kinds(lexer) == [(1, None, STRAY_LINE_CLOSE)]
+    assert "at line 2" in lexer.problems[0][3]
+
+
+def test_missing_chunk_close():
+    records, lexer = lex(
+        '<chunk1>\n<line id="1">a</line>\n<chunk2>\n<line id="2">b</line>\n'
+    )
+    assert records == [(1, 1, "a"), (2, 2, "b")]
+    assert kinds(lexer) == [(1, None, UNCLOSED_CHUNK), (2, None, UNCLOSED_CHUNK)]
+    assert [chunk for chunk, _, _ in lexer.chunk_spans] == [1, 2]
+
+
+def test_unmatched_chunk_close_and_lines_outside_chunks():
+    records, lexer = lex(
+        '<line id="1">a</line>\n<chunk1>\n<line id="2">b</line>\n</chunk2>\n'
+    )
+    assert records == [(None, 1, "a"), (1, 2, "b")]
+    assert kinds(lexer) == [(1, None, UNMATCHED_CHUNK_CLOSE)]
+
+
+def test_tags_split_across_feed():
+    text = (
+        '<chunk1>\n<line id="1">pāḷi</line>\n<line id="22">b</line>\n</chunk1>\n'
+        '<chunk2>\n<line id="3">c</line>\n</chunk2>\n'
+    ).encode("utf-8")
+    expected, _ = lex(text.decode("utf-8"))
+    # every split point, including inside tags and inside a UTF-8 character
+    for cut in range(1, len(text)):
+        lexer = LineLexer()
+        records = lexer.feed(text[:cut]) + lexer.feed(text[cut:]) + lexer.close()
+        assert [(r.chunk, r.id, r.text) for r in records] == expected, cut
+        assert lexer.problems == [], cut
+
+
+def test_offsets_point_at_line_tags():
+    text = '<chunk1>\n<line id="1">ā</line>\n<line id="2">b</line>\n</chunk1>\n'
+    data = text.encode("utf-8")
+    lexer = LineLexer()
+    records = []
+    for i in range(0, len(data), 7):
+        records += lexer.feed(data[i : i + 7])
+    records += lexer.close()
+    for record in records:
+        assert data[record.offset :].startswith(f'<line id="{record.id}">'.encode())
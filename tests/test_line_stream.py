@@ -0,0 +1,100 @@
+"""join_translations.LineStream: merging a translation into the source's ID order."""
+
+import pytest
+
+from check_translate import MISSING_IDS
+from join_translations import OUT_OF_ORDER, LineStream
+
+
+def write_chunks(path, chunks):
+    """chunks: {chunk number: [(line id, text), ...]} in file order."""
+    path.write_text(
+        "".join(
+            f"<chunk{n}>\n"
+            + "".join(f'<line id="{i}">{text}</line>\n' for i, text in lines)
+            + f"</chunk{n}>\n\n"
+            for n, lines in chunks.items()
+        ),
+        encoding="utf-8",
+    )
+    return path
+
+
+@pytest.fixture
+def source(tmp_path):
+    return write_chunks(
+        tmp_path / "book_chunks.xml",
+        {
+            1: [(i, f"s{i}") for i in range(1, 6)],
+            2: [(i, f"s{i}") for i in range(6, 11)],
+        },
+    )
+
+
+def join(source_path, trans_path, window):
+    source = LineStream(source_path)
+    trans = LineStream(trans_path, window)
+    texts = {record.id: trans.take(record) for record in source}
+    trans.finish()
+    return texts, trans.result(source)
+
+
+def test_out_of_order_lines_within_the_window(source, tmp_path):
+    trans = write_chunks(
+        tmp_path / "book_chunks_translated_1.xml",
+        {
+            1: [(3, "t3"), (1, "t1"), (2, "t2"), (5, "t5"), (4, "t4")],
+            2: [(i, f"t{i}") for i in range(6, 11)],
+        },
+    )
+    texts, result = join(source, trans, window=3)
+    assert texts == {i: f"t{i}" for i in range(1, 11)}
+    assert result["ok"]
+    assert result["diagnostics"] == []
+
+
+def test_lines_beyond_the_window_are_late(source, tmp_path):
+    # ID 1 comes after five later IDs: further out of place than the window of 3
+    trans = write_chunks(
+        tmp_path / "book_chunks_translated_1.xml",
+        {
+            1: [(i, f"t{i}") for i in range(2, 6)],
+            2: [(6, "t6"), (1, "t1")] + [(i, f"t{i}") for i in range(7, 11)],
+        },
+    )
+    texts, result = join(source, trans, window=3)
+    assert texts[1] is None
+    assert all(texts[i] == f"t{i}" for i in range(2, 11))
+    assert not result["ok"] and result["tag_errors"]
+    assert result["missing"] == [1]
+    kinds = [(chunk, kind) for chunk, kind, _ in result["diagnostics"]]
+    assert kinds == [(1, MISSING_IDS), (None, OUT_OF_ORDER)]
+    # with a window wide enough the same file joins
+    texts, result = join(source, trans, window=10)
+    assert texts == {i: f"t{i}" for i in range(1, 11)}
+
+
+def test_missing_and_extra_ids(source, tmp_path):
+    trans = write_chunks(
+        tmp_path / "book_chunks_translated_1.xml",
+        {
+            1: [(1, "t1"), (2, "t2"), (2, "t2 again"), (4, "t4")],
+            2: [(6, "t6"), (12, "t12")],
+        },
+    )
+    texts, result = join(source, trans, window=3)
+    assert texts[2] == "t2 again"
+    assert result["duplicates"] == [(2, 2)]
+    assert result["missing"] == [3, 5, 7, 8, 9, 10]
+    assert result["extra"] == [12]
+    missing = [
+        (chunk, message)
+        for chunk, kind, message in result["diagnostics"]
+        if kind == MISSING_IDS
+    ]
+    assert missing == [(1, "missing 2 IDs: [3, 5]"), (2, "missing 4 IDs: [7, 8, 9, 10]")]
+
+
+def test_missing_translation_file(source, tmp_path):
+    _, result = join(source, tmp_path / "book_chunks_translated_9.xml", window=3)
+    assert not result["ok"] and "not found" in result["error"]
@@ -0,0 +1,44 @@
+"""md_html.py against pandoc's output for the same joined markdown.
+
+The expected HTML is checked in, so pandoc is not needed to run the tests. After
+changing tests/data/joined_sample.md, make it again with:
+
+pandoc -f markdown -t html --wrap=none tests/data/joined_sample.md -o tests/data/joined_sample.pandoc.html
+
+(pandoc 3.9 made the current file.)
+"""
+
+from pathlib import Path
+
+import pytest
+
+from md_html import html_headings, normalized, render_markdown, split_sections
+
+DATA = Path(__file__).parent / "data"
+SAMPLE = (DATA / "joined_sample.md").read_text(encoding="utf-8")
+PANDOC_HTML = (DATA / "joined_sample.pandoc.html").read_text(encoding="utf-8")
+
+PANDOC_SECTIONS = split_sections(normalized(PANDOC_HTML))
+NATIVE_SECTIONS = split_sections(normalized(render_markdown(SAMPLE)))
+
+
+def test_same_sections():
+    assert len(NATIVE_SECTIONS) == len(PANDOC_SECTIONS)
+
+
+# one joined line (between the ---) per case, so a failure names the line
+@pytest.mark.parametrize("index", range(len(PANDOC_SECTIONS)))
+def test_section_matches_pandoc(index):
+    assert NATIVE_SECTIONS[index] == PANDOC_SECTIONS[index]
+
+
+def test_headings_match_pandoc():
+    headings = []
+    render_markdown(SAMPLE, headings)
+    assert headings == html_headings(PANDOC_HTML)
+
+
+def test_duplicate_heading_ids():
+    headings = []
+    render_markdown("# Namo tassa\n\n# Namo tassa\n\n# Namo tassa\n", headings)
+    assert [h[1] for h in headings] == ["namo-tassa", "namo-tassa-1", "namo-tassa-2"]
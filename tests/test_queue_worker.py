@@ -0,0 +1,116 @@
+"""Several `queue_worker.py --fake` processes sharing one queue database."""
+
+import signal
+import sqlite3
+import subprocess
+import sys
+import time
+from pathlib import Path
+
+import pytest
+
+WORKER = Path(__file__).resolve().parent.parent / "queue_worker.py"
+N_FILES = 3
+N_CHUNKS = 6
+
+
+def write_sources(directory: Path):
+    for n in range(1, N_FILES + 1):
+        chunks = "".join(
+            f'<chunk{i}>\n<line id="{i}">file {n} line {i}</line>\n</chunk{i}>\n\n'
+            for i in range(1, N_CHUNKS + 1)
+        )
+        (directory / f"book{n}_chunks.xml").write_text(chunks, encoding="utf-8")
+
+
+def start_worker(tmp_path: Path, name: str, fake: float, lease: float):
+    return subprocess.Popen(
+        [
+            sys.executable,
+            str(WORKER),
+            "-d", str(tmp_path / "books"),
+            "--queue", str(tmp_path / "queue.sqlite"),
+            "--worker-id", name,
+            "--lease", str(lease),
+            "--fake", str(fake),
+        ],
+        cwd=tmp_path,
+        stdout=subprocess.PIPE,
+        stderr=subprocess.STDOUT,
+        text=True,
+    )
+
+
+def chunk_rows(tmp_path: Path):
+    conn = sqlite3.connect(tmp_path / "queue.sqlite")
+    try:
+        return conn.execute(
+            "SELECT input_file, chunk, status, owner, attempts FROM chunks"
+        ).fetchall()
+    finally:
+        conn.close()
+
+
+def check_outputs(tmp_path: Path, outputs: list[str]):
+    rows = chunk_rows(tmp_path)
+    assert len(rows) == N_FILES * N_CHUNKS
+    assert {row[2] for row in rows} == {"done"}
+    log = "".join(outputs)
+    # "translated N chunks" only counts results accepted by the queue
+    completed = sum(
+        int(line.split(" translated ")[1].split()[0])
+        for line in log.splitlines()
+        if line.startswith("Worker ")
+    )
+    assert completed == N_FILES * N_CHUNKS
+    for n in range(1, N_FILES + 1):
+        output = tmp_path / "books" / f"book{n}_chunks_translated_1.xml"
+        assert log.count(f"=== Finished: {output}") == 1
+        text = output.read_text(encoding="utf-8")
+        positions = [text.index(f"file {n} line {i}<") for i in range(1, N_CHUNKS + 1)]
+        assert positions == sorted(positions)
+        for i in range(1, N_CHUNKS + 1):
+            assert text.count(f"<chunk{i}>") == 1
+
+
+@pytest.fixture
+def books(tmp_path):
+    (tmp_path / "books").mkdir()
+    write_sources(tmp_path / "books")
+    return tmp_path
+
+
+def test_workers_complete_every_chunk_once(books):
+    workers = [start_worker(books, f"w{i}", 0.05, 3) for i in range(3)]
+    outputs = [worker.communicate(timeout=120)[0] for worker in workers]
+    assert [worker.returncode for worker in workers] == [0, 0, 0]
+    check_outputs(books, outputs)
+
+
+def test_chunk_of_killed_worker_is_claimed_again(books):
+    # the first worker "translates" for a minute, so it still holds its lease
+    slow = start_worker(books, "slow", 60, 1)
+    deadline = time.time() + 60
+    while time.time() < deadline:
+        if (books / "queue.sqlite").exists():
+            try:
+                if any(row[3] == "slow" for row in chunk_rows(books)):
+                    break
+            except sqlite3.OperationalError:
+                pass  # tables not created yet
+        time.sleep(0.1)
+    else:
+        pytest.fail("the slow worker claimed no chunk")
+    slow.send_signal(signal.SIGKILL)
+    slow.communicate(timeout=30)
+    (taken,) = [row[:2] for row in chunk_rows(books) if row[3] == "slow"]
+
+    workers = [start_worker(books, f"w{i}", 0.05, 1) for i in range(2)]
+    outputs = [worker.communicate(timeout=120)[0] for worker in workers]
+    assert [worker.returncode for worker in workers] == [0, 0]
+    check_outputs(books, outputs)
+    rows = {row[:2]: row for row in chunk_rows(books)}
+    # taking over the expired lease counted as an attempt
+    assert rows[taken][4] == 1
+    assert rows[taken][3] in ("w0", "w1")
+    assert sum(row[4] for row in rows.values()) == 1
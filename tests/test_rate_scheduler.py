@@ -0,0 +1,95 @@
+"""rate_scheduler.AdaptiveRateScheduler: additive increase, multiplicative decrease."""
+
+import pytest
+
+from rate_scheduler import (
+    RATE_DECREASE_ON_429,
+    RATE_DECREASE_ON_SPIKE,
+    AdaptiveRateScheduler,
+    is_rate_limit_error,
+)
+
+
+def scheduler(**kwargs):
+    s = AdaptiveRateScheduler(10, max_in_flight=1, model="test-model", **kwargs)
+    s.set_in_flight_ceiling(4)
+    return s
+
+
+def succeed(s, n, latency=1.0):
+    for _ in range(n):
+        s.record_success(latency)
+
+
+def test_grows_by_one_per_round_of_successes():
+    s = scheduler()
+    # a "round" is as many successes as requests may be in flight
+    succeed(s, 1)
+    assert (s.calls_per_minute, s.max_in_flight) == (11, 2)
+    succeed(s, 2)
+    assert (s.calls_per_minute, s.max_in_flight) == (12, 3)
+    succeed(s, 3)
+    assert (s.calls_per_minute, s.max_in_flight) == (13, 4)
+
+
+def test_growth_stops_at_the_ceilings():
+    s = scheduler(max_calls_per_minute=15)
+    succeed(s, 40)
+    assert s.max_in_flight == 4
+    assert s.calls_per_minute == 15
+
+
+def test_rate_limit_cuts_rate_and_in_flight():
+    s = scheduler()
+    succeed(s, 6)
+    assert (s.calls_per_minute, s.max_in_flight) == (13, 4)
+    s.record_rate_limit()
+    assert s.calls_per_minute == pytest.approx(13 * RATE_DECREASE_ON_429)
+    assert s.max_in_flight == int(4 * RATE_DECREASE_ON_429)
+    # and growth starts over from there
+    succeed(s, s.max_in_flight)
+    assert s.calls_per_minute == pytest.approx(13 * RATE_DECREASE_ON_429 + 1)
+
+
+def test_rate_never_drops_below_the_minimum():
+    s = scheduler(min_calls_per_minute=2)
+    for _ in range(20):
+        s.record_rate_limit()
+    assert s.calls_per_minute == 2
+    assert s.max_in_flight == 1
+
+
+def test_latency_spike_cuts_rate():
+    s = scheduler()
+    succeed(s, 10)
+    before = s.calls_per_minute, s.max_in_flight
+    s.record_success(10.0)  # well over LATENCY_SPIKE_FACTOR x the p50 of 1s
+    assert s.calls_per_minute == pytest.approx(before[0] * RATE_DECREASE_ON_SPIKE)
+    assert s.max_in_flight == max(1, int(before[1] * RATE_DECREASE_ON_SPIKE))
+
+
+def test_lower_ceiling_applies_at_once():
+    s = scheduler()
+    succeed(s, 6)
+    s.set_in_flight_ceiling(2)
+    assert s.max_in_flight == 2
+    succeed(s, 10)
+    assert s.max_in_flight == 2
+
+
+class ApiError(Exception):
+    def __init__(self, message, code=None):
+        super().__init__(message)
+        self.code = code
+
+
+@pytest.mark.parametrize(
+    "error, expected",
+    [
+        (ApiError("Too many requests", code=429), True),
+        (Exception("429 RESOURCE_EXHAUSTED: quota exceeded"), True),
+        (Exception("500 INTERNAL"), False),
+    ],
+)
+def test_is_rate_limit_error(error, expected):
+    assert is_rate_limit_error(error) == expected
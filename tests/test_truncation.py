@@ -0,0 +1,90 @@
+"""truncation.py: finding cut-off responses and stitching the continuations."""
+
+from types import SimpleNamespace
+
+import truncation
+from truncation import needs_continuation, stitch_lines, translate_with_continuation
+
+SOURCE = (
+    '<chunk7>\n\n<line id="1">a</line>\n\n<line id="2">b</line>\n\n'
+    '<line id="3">c</line>\n\n<line id="4">d</line>\n\n</chunk7>'
+)
+
+
+def response(text, finish_reason="STOP"):
+    # the parts of a GenerateContentResponse that truncation.py reads
+    reason = SimpleNamespace(name=finish_reason)
+    return SimpleNamespace(text=text, candidates=[SimpleNamespace(finish_reason=reason)])
+
+
+def test_complete_response_needs_no_continuation():
+    text = '<chunk7>\n<line id="1">A</line>\n<line id="2">B</line>\n</chunk7>'
+    assert needs_continuation(text, SOURCE, "STOP") is None
+
+
+def test_max_tokens_continues_after_last_complete_line():
+    text = '<chunk7>\n<line id="1">A</line>\n<line id="2">B</line>\n<line id="3">hal'
+    remaining = needs_continuation(text, SOURCE, "MAX_TOKENS")
+    assert remaining == '<chunk7>\n\n<line id="3">c</line>\n\n<line id="4">d</line>\n\n</chunk7>'
+
+
+def test_unclosed_chunk_continues_without_max_tokens():
+    text = '<chunk7>\n<line id="1">A</line>'
+    remaining = needs_continuation(text, SOURCE, "STOP")
+    assert remaining.startswith('<chunk7>\n\n<line id="2">b</line>')
+
+
+def test_nothing_left_to_continue():
+    text = "<chunk7>\n" + "".join(f'<line id="{i}">x</line>' for i in range(1, 5))
+    assert needs_continuation(text, SOURCE, "MAX_TOKENS") is None
+
+
+def test_stitch_drops_half_line_and_keeps_one_close_tag():
+    head = '<chunk7>\n<line id="1">A</line>\n<line id="2">B</line>\n<line id="3">ha'
+    continuation = (
+        'Sure:\n<chunk7>\n<line id="3">C</line>\n<line id="4">D</line>\n</chunk7>\n'
+    )
+    assert stitch_lines(head, continuation) == (
+        '<chunk7>\n<line id="1">A</line>\n<line id="2">B</line>\n\n'
+        '<line id="3">C</line>\n<line id="4">D</line>\n\n</chunk7>'
+    )
+
+
+def test_stitch_without_close_tag_in_continuation():
+    head = '<chunk7>\n<line id="1">A</line>'
+    continuation = '<chunk7>\n<line id="2">B</line>'
+    assert stitch_lines(head, continuation) == (
+        '<chunk7>\n<line id="1">A</line>\n\n<line id="2">B</line>'
+    )
+
+
+def test_translate_with_continuation_requests_the_rest():
+    answers = [
+        response('<chunk7>\n<line id="1">A</line>\n<line id="2">B', "MAX_TOKENS"),
+        response(
+            '<chunk7>\n<line id="2">B</line>\n<line id="3">C</line>\n'
+            '<line id="4">D</line>\n</chunk7>'
+        ),
+    ]
+    sent = []
+
+    def request(chunk):
+        sent.append(chunk)
+        return answers.pop(0)
+
+    text = translate_with_continuation(request, SOURCE)
+    assert sent[0] == SOURCE
+    assert sent[1].startswith('<chunk7>\n\n<line id="2">b</line>')
+    assert [int(i) for i in truncation.COMPLETE_LINE_PATTERN.findall(text)] == [1, 2, 3, 4]
+    assert text.endswith("</chunk7>")
+
+
+def test_gives_up_after_max_continuations():
+    calls = []
+
+    def request(chunk):
+        calls.append(chunk)
+        return response('<chunk7>\n<line id="1">A', "MAX_TOKENS")
+
+    assert translate_with_continuation(request, SOURCE) is None
+    assert len(calls) == truncation.MAX_CONTINUATIONS + 1
@@ -0,0 +1,171 @@
+"""Separate the final translation from the reasoning text of a thinking model.
+
+The thinking model streams its reasoning and its final `<chunkN>` answer as one
+text. ThinkStreamExtractor is fed the streamed pieces as they arrive and splits
+them into the translation (the last `<chunkN>...</chunkN>` block) and the
+reasoning (everything else), so the translation can go straight into a
+`_translated_N.xml` file.
+"""
+
+from __future__ import annotations
+
+import re
+from collections import Counter
+
+from truncation import cut_after_last_line, lines_body
+
+LINE_ID_PATTERN = re.compile(r'<line id="(\d+)">')
+LINE_TAG_PATTERN = re.compile(r'<line id="\d+">.*?(?:</line>|$)', re.MULTILINE)
+
+
+def _partial_tag_len(text: str, tags: tuple) -> int:
+    """Length of the longest suffix of text that could be the start of a tag."""
+    longest = 0
+    for tag in tags:
+        for size in range(min(len(tag) - 1, len(text)), longest, -1):
+            if text.endswith(tag[:size]):
+                longest = size
+                break
+    return longest
+
+
+class ThinkStreamExtractor:
+    def __init__(self, chunk_no: int):
+        self.chunk_no = chunk_no
+        self.open_tag = f"<chunk{chunk_no}>"
+        self.close_tag = f"</chunk{chunk_no}>"
+        self.buffer = ""
+        self.raw = []
+        self.inside = False
+        self.reasoning = []
+        self.current = []  # translation of the block being streamed
+        self.translation = None  # last complete (or unclosed) block
+        self.unclosed = False
+        self.found_tag = False
+
+    def feed(self, text: str):
+        """Consume the next streamed piece of text."""
+        self.raw.append(text)
+        self.buffer += text
+        tags = (self.open_tag, self.close_tag)
+        while True:
+            if not self.inside:
+                pos = self.buffer.find(self.open_tag)
+                if pos == -1:
+                    keep = _partial_tag_len(self.buffer, tags)
+                    self.reasoning.append(self.buffer[: len(self.buffer) - keep])
+                    self.buffer = self.buffer[len(self.buffer) - keep :]
+                    return
+                self.reasoning.append(self.buffer[:pos])
+                self.buffer = self.buffer[pos + len(self.open_tag) :]
+                self._start_block()
+                continue
+
+            close_pos = self.buffer.find(self.close_tag)
+            reopen_pos = self.buffer.find(self.open_tag)
+            if reopen_pos != -1 and (close_pos == -1 or reopen_pos < close_pos):
+                # the model started the answer again: the first try was a draft
+                self.current.append(self.buffer[:reopen_pos])
+                self.reasoning.append(self._block_text(self.current))
+                self.buffer = self.buffer[reopen_pos + len(self.open_tag) :]
+                self._start_block()
+                continue
+            if close_pos == -1:
+                keep = _partial_tag_len(self.buffer, tags)
+                self.current.append(self.buffer[: len(self.buffer) - keep])
+                self.buffer = self.buffer[len(self.buffer) - keep :]
+                return
+            self.current.append(self.buffer[:close_pos])
+            self.buffer = self.buffer[close_pos + len(self.close_tag) :]
+            if self.translation is not None:
+                # keep only the last complete answer, earlier ones are drafts
+                self.reasoning.append(self._block_text([self.translation]))
+            self.translation = "".join(self.current).strip()
+            self.current = []
+            self.inside = False
+
+    def _start_block(self):
+        self.inside = True
+        self.found_tag = True
+        self.current = []
+
+    def _block_text(self, parts: list) -> str:
+        return f"{self.open_tag}{''.join(parts)}{self.close_tag}"
+
+    def close(self):
+        """Flush what is left after the stream ended."""
+        if self.inside:
+            # stream stopped inside the answer (e.g. output token cap)
+            self.current.append(self.buffer)
+            if self.translation is not None:
+                self.reasoning.append(self._block_text([self.translation]))
+            self.translation = "".join(self.current).strip()
+            self.unclosed = True
+            self.inside = False
+        else:
+            self.reasoning.append(self.buffer)
+        self.buffer = ""
+
+        if self.translation is None:
+            # no <chunkN> tag at all: fall back to the bare <line id> lines
+            lines = LINE_TAG_PATTERN.findall(self.reasoning_text())
+            if lines:
+                self.translation = "\n\n".join(line.strip() for line in lines)
+
+    def extend(self, other: ThinkStreamExtractor):
+        """Append a continuation: its lines go after the last complete line here."""
+        self.raw.append(other.raw_text())
+        self.reasoning.append(other.reasoning_text())
+        if other.translation is not None:
+            self.translation = cut_after_last_line(self.translation or "").rstrip()
+            self.translation = f"{self.translation}\n\n{lines_body(other.translation)}".strip()
+        self.unclosed = other.unclosed
+
+    def answer_text(self) -> str:
+        """The answer as streamed: without `</chunkN>` if it was never closed."""
+        if self.translation is None:
+            return ""
+        closing = "" if self.unclosed else self.close_tag
+        return f"{self.open_tag}\n\n{self.translation}\n\n{closing}"
+
+    def raw_text(self) -> str:
+        return "".join(self.raw)
+
+    def reasoning_text(self) -> str:
+        return "".join(self.reasoning).strip()
+
+    def translation_block(self) -> str | None:
+        if self.translation is None:
+            return None
+        return f"{self.open_tag}\n\n{self.translation}\n\n{self.close_tag}"
+
+
+def validate_chunk_ids(source_chunk: str, translated_chunk: str) -> dict:
+    """Compare the line IDs of one source chunk with its translation."""
+    source_ids = [int(i) for i in LINE_ID_PATTERN.findall(source_chunk)]
+    translated_counts = Counter(
+        int(i) for i in LINE_ID_PATTERN.findall(translated_chunk or "")
+    )
+    source_set = set(source_ids)
+    return {
+        "expected": len(source_set),
+        "missing": sorted(source_set - translated_counts.keys()),
+        "extra": sorted(translated_counts.keys() - source_set),
+        "duplicates": {
+            id_: count for id_, count in sorted(translated_counts.items()) if count > 1
+        },
+    }
+
+
+def format_id_report(chunk_no: int, report: dict) -> str:
+    """One-line summary of validate_chunk_ids, empty parts left out."""
+    problems = []
+    if report["missing"]:
+        problems.append(f"missing IDs {report['missing']}")
+    if report["extra"]:
+        problems.append(f"extra IDs {report['extra']}")
+    if report["duplicates"]:
+        problems.append(f"duplicate IDs {report['duplicates']}")
+    if not problems:
+        return f"Chunk {chunk_no}: {report['expected']} line ids == with the source chunk"
+    return f"Chunk {chunk_no}: ID_MISMATCH " + "; ".join(problems)
@@ -4,10 +4,24 @@ import os
 import argparse
 import fnmatch
 import re
-from datetime import datetime
 import time
 
-from translator_gemini import gemini_translate, gemini_translator, set_gemini_key_file
+from chunk_events import ChunkEventLog, render_event
+from chunk_scheduler import ChunkScheduler
+from chunk_store import ChunkStore
+from hedging import HedgePolicy
+from line_index import LineIndex
+from plan_quota import plan_directory
+from rate_scheduler import AdaptiveRateScheduler, latency_stats
+from run_metrics import start_metrics_server
+from translator_gemini import (
+    TranslationProfile,
+    gemini_translate,
+    load_profiles,
+    set_gemini_key_file,
+)
+
+ADAPTIVE_INFLIGHT_PER_LANE = 4  # default in-flight ceiling of adaptive lanes
 
 
 def count_chunks(file_path):
@@ -22,47 +36,51 @@ def count_chunks(file_path):
         return 0
 
 
-def retry_failed_chunks(directory, matching_files, key_file):
-    print("\nChecking for failed chunks...")
+def retry_failed_chunks(
+    directory, matching_files, key_file, transno="translated_1", translate=None
+):
+    print(f"\nChecking for failed chunks ({transno})...")
+    if translate is None:
+        translate = lambda text: gemini_translate(text, key_file)
     for file_path in matching_files:
         base_name = os.path.splitext(file_path)[0]
-        log_file = os.path.join(directory, f"{base_name}_translated_1.log")
-        translated_file = os.path.join(directory, f"{base_name}_translated_1.xml")
+        log_file = os.path.join(directory, f"{base_name}_{transno}.log")
+        translated_file = os.path.join(directory, f"{base_name}_{transno}.xml")
 
-        if not os.path.exists(log_file) or not os.path.exists(translated_file):
+        if not os.path.exists(translated_file):
             continue
 
-        # Read log file to find failed chunks
-        with open(log_file, "r", encoding="utf-8") as f:
-            log_content = f.read()
-            failed_chunks = re.findall(r"Chunk (\d+): CHUNK_FAILED", log_content)
+        # failed chunks come from the status index (see chunk_events.py)
+        events = ChunkEventLog(translated_file)
+        failed_chunks = events.failed_chunks()
 
         if failed_chunks:
             print(f"\nFound {len(failed_chunks)} failed chunks in: {translated_file}")
+            try:
+                # split before translating: a file that can't be split is left as it is
+                store = ChunkStore(translated_file)
+            except ValueError as e:
+                print(f"Skipping {translated_file}, fix it by hand first: {e}")
+                continue
             print("Re-translating failed chunks:")
 
-            # Read original file content
-            with open(os.path.join(directory, file_path), "r", encoding="utf-8") as f:
-                content = f.read()
-
-            # Read current translated content
-            with open(translated_file, "r", encoding="utf-8") as f:
-                translated_content = f.read()
+            # source text of the failed chunks, read through the offset index
+            source_chunks = LineIndex(os.path.join(directory, file_path))
 
             # Process each failed chunk
-            fixed_chunks_ok = []
-            for chunk_num in failed_chunks:
-                try:
-                    # Find the specific chunk using its number
-                    chunk_pattern = f"<chunk{chunk_num}>(.*?)</chunk{chunk_num}>"
-                    chunk_match = re.search(chunk_pattern, content, re.DOTALL)
-
-                    if chunk_match:
-                        full_chunk = chunk_match.group(
-                            0
-                        )  # Get the complete chunk with tags
+            fixed = {}
+            with open(log_file, "a", encoding="utf-8") as log_f:
+                # the log ends with "Output saved to ..." without a newline
+                log_f.write("\n")
+                for chunk_num in failed_chunks:
+                    try:
+                        full_chunk = source_chunks.chunk_xml(chunk_num)
+                        if full_chunk is None:
+                            print(f"Could not find chunk {chunk_num} in original file")
+                            continue
+
                         print(f"Processing chunk {chunk_num}...")
-                        translated_text = gemini_translate(full_chunk, key_file)
+                        translated_text = translate(full_chunk)
 
                         # fix of fix
                         if not translated_text:
@@ -70,58 +88,69 @@ def retry_failed_chunks(directory, matching_files, key_file):
                                 f"Translating still failed for chunk {chunk_num}...\n Will retry again after 5s"
                             )
                             time.sleep(5)
-                            translated_text = gemini_translate(full_chunk, key_file)
+                            translated_text = translate(full_chunk)
                             if translated_text:
                                 print(
                                     "\n2nd Re-translated successfully chunk: ",
                                     chunk_num,
                                 )
                         if translated_text:
-                            # Replace the failed chunk in the translated file
-                            translated_content = re.sub(
-                                f"<chunk{chunk_num}>.*?</chunk{chunk_num}>",
-                                translated_text,
-                                translated_content,
-                                flags=re.DOTALL,
-                            )
-
-                            # Update the log file
-                            # Update the log file - mark the original failure as fixed
-                            with open(log_file, "r", encoding="utf-8") as log_f:
-                                updated_log = log_f.read()
-                                updated_log = re.sub(
-                                    f"Chunk {chunk_num}: CHUNK_FAILED",
-                                    f"Chunk {chunk_num}: FIXED_CHUNK_FAILED",
-                                    updated_log,
-                                )
-                            with open(log_file, "w", encoding="utf-8") as log_f:
-                                log_f.write(updated_log)
-                                log_time = datetime.now().strftime("%Y-%m-%d %H:%M:%S")
-                                log_f.write(
-                                    f"\nRetry successful - Chunk {chunk_num}: {log_time}\n"
-                                )
-                            fixed_chunks_ok.append(chunk_num)
-
+                            # one small write per fixed chunk; "fixed" is recorded
+                            # once the .xml is assembled with it
+                            store.put(chunk_num, translated_text)
+                            fixed[chunk_num] = (len(full_chunk), len(translated_text))
                             print("\nRe-translated successfully chunk: ", chunk_num)
-                    else:
-                        print(f"Could not find chunk {chunk_num} in original file")
-
-                except Exception as e:
-                    print(f"Error retrying chunk {chunk_num}: {str(e)}")
-                    continue
-
-            # Write updated content back to file
-            with open(translated_file, "w", encoding="utf-8") as f:
-                f.write(translated_content)
-
-            remaining = [num for num in failed_chunks if num not in fixed_chunks_ok]
+                        else:
+                            event = events.record(chunk_num, "retry_failed")
+                            log_f.write(render_event(event))
+                            log_f.flush()
+
+                    except Exception as e:
+                        print(f"Error retrying chunk {chunk_num}: {str(e)}")
+                        continue
+            source_chunks.close()
+
+            if fixed:
+                # stream the pieces into the .xml, then mark the chunks fixed
+                store.assemble()
+                with open(log_file, "a", encoding="utf-8") as log_f:
+                    for chunk_num, (input_chars, output_chars) in fixed.items():
+                        event = events.record(
+                            chunk_num,
+                            "fixed",
+                            input_chars=input_chars,
+                            output_chars=output_chars,
+                        )
+                        log_f.write(render_event(event))
+
+            fixed_chunks_ok = sorted(fixed)
+            remaining = [num for num in failed_chunks if num not in fixed]
             print(
                 f"File: {translated_file}\nFixed/Total: {len(fixed_chunks_ok)}/{len(failed_chunks)}\nFailed chunks: {failed_chunks}. Fixed chunks: {fixed_chunks_ok}. Remaining CHUNKS: {remaining}"
             )
 
 
+def build_lanes(key_files, profiles=None, adaptive=False):
+    """Translation lanes for the scheduler: the profiles, or one lane per key file."""
+    if profiles:
+        return profiles
+    if isinstance(key_files, str):
+        key_files = [key_files]
+    return [
+        TranslationProfile(transno="translated_1", key_file=k, adaptive=adaptive)
+        for k in key_files
+    ]
+
+
 def process_files(
-    directory=".", file_pattern="*_chunks.xml", key_file="gemini_key_project_1.txt"
+    directory=".",
+    file_pattern="*_chunks.xml",
+    key_file="gemini_key_project_1.txt",
+    profiles=None,
+    concurrency=None,
+    adaptive=False,
+    hedge=None,
+    max_inflight=None,
 ):
 
     print(f"Using file filter pattern: {file_pattern}")
@@ -143,9 +172,42 @@ def process_files(
     print(f"\nTotal matching files: {len(matching_files)}")
     print(f"Total chunks across all files: {total_chunks}\n")
 
+    lanes = build_lanes(key_file, profiles, adaptive)
+    transnos = sorted({lane.transno for lane in lanes})
+    if concurrency is None:
+        concurrency = len(lanes)
+    if any(isinstance(lane.scheduler, AdaptiveRateScheduler) for lane in lanes):
+        # AIMD starts each lane at one request in flight and grows up to this
+        max_inflight = max_inflight or max(
+            concurrency, ADAPTIVE_INFLIGHT_PER_LANE * len(lanes)
+        )
+        print(f"Translation lanes (adaptive, up to {max_inflight} concurrent requests):")
+    else:
+        max_inflight = None
+        print(f"Translation lanes ({concurrency} concurrent requests):")
+    for lane in lanes:
+        print(f"- {lane.name} ({lane.prompt_file}, {lane.calls_per_minute} RPM)")
+    total_requests = total_chunks * len(transnos)
+
+    # offline estimate of time, cost and quota days (see plan_quota.py)
+    plan_directory(
+        directory,
+        file_pattern,
+        model=lanes[0].model,
+        keys=max(1, len(lanes) // len(transnos)),
+        concurrency=max_inflight or concurrency,
+        rpm=lanes[0].calls_per_minute,
+        prompt_file=lanes[0].prompt_file,
+        translations=len(transnos),
+        suggest=False,
+    )
+
     # Ask for user confirmation
+    print("\nDaily quota (requests/per project/ per day):")
+    for lane in lanes:
+        print(f"- {lane.quota_status()}")
     print(
-        f"Reminder: Free tier Gemini API call limit is 1,500 requests/per project/ per day. This session will use ~ {total_chunks} requests of your project limit."
+        f"This session will use ~ {total_requests} requests of your project limit. Files the remaining quota can't finish are deferred."
     )
     response = input("Do you want to proceed with translation? (y/n): ").lower().strip()
     if response != "y":
@@ -157,19 +219,26 @@ def process_files(
         print(f"No files found matching pattern: {file_pattern}")
         return
 
-    # Process each file
+    # Queue the chunks of every file, then drain the queue with all lanes
+    scheduler = ChunkScheduler(lanes, concurrency, hedge, max_inflight)
     for n, file_path in enumerate(matching_files, 1):
         try:
-            print(f"---------\nProcessing file: {file_path}")
             n_file = f"File {n} of {len(matching_files)}"
-            gemini_translator(os.path.join(directory, file_path), n_file, key_file)
-            print(f"{n_file}. Translated: {file_path}\n")
-
+            queued = scheduler.add_file(os.path.join(directory, file_path), n_file, n)
+            print(f"{n_file}. Queued {queued} chunk requests: {file_path}")
         except Exception as e:
             print(f"Error processing {file_path}: {str(e)}")
 
-    # After all files are processed, retry any failed chunks
-    retry_failed_chunks(directory, matching_files, key_file)
+    finished = scheduler.run()
+    print(f"\nFinished {len(finished)} translated files.")
+    print(f"Request latency per model:\n{latency_stats.summary()}")
+    if hedge is not None:
+        print(hedge.summary())
+    for lane in lanes:
+        print(
+            f"- {lane.name}: ended at {lane.scheduler.calls_per_minute:.1f} RPM, "
+            f"{lane.scheduler.max_in_flight} in flight"
+        )
 
 
 if __name__ == "__main__":
@@ -193,18 +262,104 @@ if __name__ == "__main__":
     parser.add_argument(
         "-k",
         "--key-file",
-        default="./gemini_key_project_1.txt",
-        help="Path to the Gemini API key file (default: ./gemini_key_project_1.txt)",
+        nargs="+",
+        default=["./gemini_key_project_1.txt"],
+        help="Path(s) to Gemini API key files; chunks are spread across all keys (default: ./gemini_key_project_1.txt)",
+    )
+
+    parser.add_argument(
+        "--profiles",
+        default=None,
+        help="JSON file of model/prompt/key profiles to fan out into _translated_1..N in one pass",
+    )
+    parser.add_argument(
+        "-c",
+        "--concurrency",
+        type=int,
+        default=None,
+        help="Concurrent requests across all lanes (default: one per key/profile)",
+    )
+    parser.add_argument(
+        "--adaptive",
+        action="store_true",
+        help="Adapt each key's rate and in-flight requests to observed 429s and latency (AIMD)",
+    )
+    parser.add_argument(
+        "--max-inflight",
+        type=int,
+        default=None,
+        help=f"With --adaptive (or adaptive profiles): the most concurrent requests AIMD may grow to; -c is not used for them (default: {ADAPTIVE_INFLIGHT_PER_LANE} per key/profile)",
+    )
+    parser.add_argument(
+        "--hedge-percentile",
+        type=float,
+        default=None,
+        help="Duplicate a request on another key/profile once it runs longer than this latency percentile (e.g. 95; default: off)",
+    )
+    parser.add_argument(
+        "--hedge-budget",
+        type=float,
+        default=0.1,
+        help="Max hedged requests as a fraction of chunk requests (default: 0.1). "
+        "Hedges count against the daily quota, and the slower request is not "
+        "cancelled once sent: its answer is only dropped, both are paid for",
+    )
+    parser.add_argument(
+        "--retry-failed",
+        action="store_true",
+        help="Only re-translate the chunks listed as failed in the status index "
+        "(X_translated_N.status.json + .events.jsonl; CHUNK_FAILED in the .log for older runs)",
+    )
+    parser.add_argument(
+        "--metrics-port",
+        type=int,
+        default=None,
+        help="Serve live metrics on this local port (/metrics, /status; view with run_metrics.py)",
     )
 
     args = parser.parse_args()
 
     # Setting key-file on translator_gemini.py
-    set_gemini_key_file(args.key_file)
+    set_gemini_key_file(args.key_file[0])
+
+    profiles = load_profiles(args.profiles) if args.profiles else None
+
+    if args.retry_failed:
+        matching_files = sorted(
+            f for f in os.listdir(args.directory) if fnmatch.fnmatch(f, args.pattern)
+        )
+        retried = set()
+        for lane in build_lanes(args.key_file, profiles, args.adaptive):
+            if lane.transno in retried:
+                continue
+            retried.add(lane.transno)
+            retry_failed_chunks(
+                args.directory,
+                matching_files,
+                lane.get_key_file(),
+                transno=lane.transno,
+                translate=lane.translate,
+            )
+        exit(0)
 
     print(f"Starting translation of files in {args.directory}...")
-
-    process_files(args.directory, args.pattern, args.key_file)
+    if args.metrics_port:
+        start_metrics_server(args.metrics_port)
+
+    process_files(
+        args.directory,
+        args.pattern,
+        args.key_file,
+        profiles,
+        args.concurrency,
+        args.adaptive,
+        (
+            HedgePolicy(args.hedge_percentile, args.hedge_budget)
+            if args.hedge_percentile
+            else None
+        ),
+        args.max_inflight,
+    )
 
     print(
         "Translation tasks completed!\nPlease search 'CHUNK_FAILED' in the log files to see any failed chunks"
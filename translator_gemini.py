@@ -5,7 +5,9 @@ import time
 import re
 import argparse
 import random
+import json
 
+from concurrent.futures import ThreadPoolExecutor, as_completed
 from datetime import datetime
 from pathlib import Path
 from ratelimit import limits, sleep_and_retry
@@ -14,6 +16,20 @@ from functools import wraps
 from google import genai  # pip install google-genai
 from google.genai import types
 
+from chunk_events import ChunkEventLog, render_event
+from chunk_store import ChunkStore
+from hedging import RequestCancelled, is_cancelled
+from quota_store import daily_limit_for, get_quota_store, key_id_of, next_reset
+from rate_scheduler import (
+    AdaptiveRateScheduler,
+    RateScheduler,
+    error_class,
+    is_rate_limit_error,
+)
+from run_metrics import metrics
+from truncation import finish_reason_name, translate_with_continuation
+from usage_ledger import record_usage, set_usage_context
+
 GEMINI_API_PROJECT_KEY_FILE:str = "./gemini_key_project_1.txt"
 AI_MODEL = "gemini-2.0-flash"
 
@@ -85,16 +101,22 @@ def load_sytem_prompt(prompt_file="./prompt_Sinhala_English.md"):
         return file.read()
 
 
-def retry_with_exponential_backoff(func):
+def retry_with_exponential_backoff(func, max_retries: int | None = None):
+    """Retry `func` up to `max_retries` (default MAX_RETRIES) attempts in total."""
+    max_retries = max_retries or MAX_RETRIES
+
     @wraps(func)
     def wrapper(*args, **kwargs):
         retry_count = 0
-        while retry_count < MAX_RETRIES:
+        while retry_count < max_retries:
             try:
                 return func(*args, **kwargs)
+            except RequestCancelled:
+                raise
             except Exception as e:
+                metrics.record_error(error_class(e))
                 retry_count += 1
-                if retry_count == MAX_RETRIES:
+                if retry_count == max_retries:
                     print(f"Final attempt failed: {str(e)}")
                     return None
 
@@ -116,12 +138,16 @@ def retry_with_exponential_backoff(func):
 @sleep_and_retry
 @limits(calls=CALLS_PER_MINUTE, period=PERIOD)
 @retry_with_exponential_backoff
-def gemini_translate(chunk: str, key_file: str = GEMINI_API_PROJECT_KEY_FILE) -> str:
+def gemini_request(chunk: str, key_file: str = GEMINI_API_PROJECT_KEY_FILE):
+    """One rate-limited request; returns the full response (text and finish reason)."""
     global client
     if not client:
         print("Init client...")
         client = genai.Client(api_key=read_gemini_api_key(key_file=GEMINI_API_PROJECT_KEY_FILE))
-    response: str = client.models.generate_content(
+    key_id = key_id_of(GEMINI_API_PROJECT_KEY_FILE)
+    get_quota_store().record(key_id, AI_MODEL)
+    start_time = time.time()
+    response = client.models.generate_content(
         model=AI_MODEL,
         contents=f"{load_sytem_prompt()}\n{chunk}",
         config=types.GenerateContentConfig(
@@ -135,106 +161,380 @@ def gemini_translate(chunk: str, key_file: str = GEMINI_API_PROJECT_KEY_FILE) ->
             safety_settings=GEMINI_SAFE_SETTINGS,
         ),
     )
-    return response.text
+    record_usage(
+        getattr(response, "usage_metadata", None),
+        AI_MODEL,
+        key_id,
+        time.time() - start_time,
+        finish_reason_name(response),
+    )
+    return response
 
-# key_file is not used, just for the call in translate_dir_gemini
-def process_xml_file_with_regex(input_file, n_file, transno="translated_1"):
-    try:
-        # Check if file is already translated
-        source_path = Path(input_file)
-        base_name = source_path.stem
 
-        # Look for existing translations with the same base name and AI model
-        existing_translations = list(
-            source_path.parent.glob(f"{base_name}_translated_1.xml")
+def gemini_translate(chunk: str, key_file: str = GEMINI_API_PROJECT_KEY_FILE) -> str:
+    # a response cut at the output-token cap is continued from the next line ID
+    return translate_with_continuation(
+        lambda text: gemini_request(text, key_file), chunk
+    )
+
+class TranslationProfile:
+    """A model/prompt/key combination that writes its own `_{transno}.xml` file.
+
+    Each profile keeps its own client and rate limit, so several profiles can
+    translate the same chunks concurrently without sharing one quota.
+    """
+
+    def __init__(
+        self,
+        transno: str = "translated_1",
+        model: str = AI_MODEL,
+        prompt_file: str = "./prompt_Sinhala_English.md",
+        key_file: str | None = None,
+        calls_per_minute: int = CALLS_PER_MINUTE,
+        max_in_flight: int = 1,
+        adaptive: bool = False,
+        max_calls_per_minute: int | None = None,
+        daily_limit: int | None = None,
+    ):
+        self.transno = transno
+        self.model = model
+        self.prompt_file = prompt_file
+        self.key_file = key_file
+        self.calls_per_minute = calls_per_minute
+        self.daily_limit = daily_limit or daily_limit_for(model)
+        self.client = None
+        self._key_id = None
+        if adaptive:
+            # rate and in-flight count follow observed 429s and latency (AIMD)
+            self.scheduler = AdaptiveRateScheduler(
+                calls_per_minute,
+                period=PERIOD,
+                max_in_flight=max_in_flight,
+                model=model,
+                max_calls_per_minute=max_calls_per_minute,
+            )
+        else:
+            self.scheduler = RateScheduler(
+                calls_per_minute, period=PERIOD, max_in_flight=max_in_flight, model=model
+            )
+        self.on_request = None
+        self.request = retry_with_exponential_backoff(self._scheduled_generate)
+
+    def set_max_retries(self, max_retries: int):
+        """Use `max_retries` attempts per request, e.g. when a caller retries whole chunks."""
+        self.request = retry_with_exponential_backoff(
+            self._scheduled_generate, max_retries
+        )
+
+    @property
+    def name(self) -> str:
+        return f"{self.transno}:{self.model}:{Path(self.get_key_file()).name}"
+
+    @property
+    def key_id(self) -> str:
+        if self._key_id is None:
+            self._key_id = key_id_of(self.get_key_file())
+        return self._key_id
+
+    def load_quota_state(self):
+        """Seed the rate window with the requests sent by earlier runs."""
+        quota = get_quota_store()
+        self.scheduler.seed(quota.recent(self.key_id, self.model, PERIOD))
+
+    def quota_status(self) -> str:
+        used = get_quota_store().used_today(self.key_id, self.model)
+        return (
+            f"{self.name}: {used}/{self.daily_limit} requests used today, "
+            f"quota resets at {next_reset():%Y-%m-%d %H:%M %Z}"
         )
-        if existing_translations:
-            print(f"------> SKIPPING {input_file} - THERE IS A translated FILE here:")
-            for trans in existing_translations:
-                print(f"  {trans.name}")
-            return
-
-        with open(input_file, "r", encoding="utf-8") as file:
-            content = file.read()
-
-        # Find all chunks using regex
-        chunk_pattern = r"<chunk\d+>(.*?)</chunk\d+>"
-        chunks = re.finditer(chunk_pattern, content, re.DOTALL)
-        chunks_list = list(chunks)
-        total_chunks = len(chunks_list)
-        print(f"Found {total_chunks} chunks to translate")
-
-        # Create output file
-        timestamp = datetime.now().strftime("%Y%m%d_%H%M%S")
-
-        output_file = source_path.parent / f"{base_name}_translated_1.xml"
-        log_file = source_path.parent / f"{base_name}_translated_1.log"
-
-        with open(output_file, "w", encoding="utf-8") as f, open(
-            log_file, "w", encoding="utf-8"
-        ) as log_f:
-
-            # Write warning info to the translated files
-            info_warning = f"""<info>
-Translated by {AI_MODEL}
+
+    def remaining_today(self) -> int:
+        used = get_quota_store().used_today(self.key_id, self.model)
+        return max(0, self.daily_limit - used)
+
+    def translate(self, chunk: str) -> str | None:
+        return translate_with_continuation(self.request, chunk)
+
+    def _scheduled_generate(self, chunk: str):
+        # every attempt (retries included) takes a slot of this key's rate budget
+        if is_cancelled():
+            raise RequestCancelled()
+        with self.scheduler:
+            if is_cancelled():
+                raise RequestCancelled()
+            # the caller may refuse requests, e.g. when its daily budget is spent
+            if self.on_request is not None and not self.on_request(self):
+                raise RequestCancelled("no daily quota left")
+            get_quota_store().record(self.key_id, self.model)
+            start_time = time.time()
+            try:
+                response = self._generate(chunk)
+            except Exception as e:
+                if is_rate_limit_error(e):
+                    self.scheduler.record_rate_limit()
+                    self.scheduler.back_off(INITIAL_RETRY_DELAY)
+                raise
+            latency = time.time() - start_time
+            self.scheduler.record_success(latency)
+            record_usage(
+                getattr(response, "usage_metadata", None),
+                self.model,
+                self.key_id,
+                latency,
+                finish_reason_name(response),
+            )
+            return response
+
+    def _generate(self, chunk: str):
+        if not self.client:
+            print(f"Init client for {self.transno} ({self.model})...")
+            self.client = genai.Client(
+                api_key=read_gemini_api_key(key_file=self.get_key_file())
+            )
+        response = self.client.models.generate_content(
+            model=self.model,
+            contents=f"{load_sytem_prompt(self.prompt_file)}\n{chunk}",
+            config=types.GenerateContentConfig(
+                top_p=0.8,
+                safety_settings=GEMINI_SAFE_SETTINGS,
+            ),
+        )
+        return response
+
+    def get_key_file(self) -> str:
+        # fall back to the key set by the CLI (set_gemini_key_file)
+        return self.key_file or GEMINI_API_PROJECT_KEY_FILE
+
+
+def load_profiles(profiles_file: str) -> list[TranslationProfile]:
+    """Load translation profiles from a JSON list, e.g.
+
+    [
+      {"model": "gemini-2.0-flash", "prompt": "./prompt_Pali_English.md", "key_file": "./key_1.txt", "rpm": 14},
+      {"model": "gemini-2.0-flash-lite", "prompt": "./prompt_Pali_English.md", "key_file": "./key_2.txt", "rpm": 28}
+    ]
+
+    "rpd" overrides the model's requests-per-day quota.
+    "adaptive": true lets the rate float between 1 and "max_rpm" (default 4 x rpm).
+    The n-th profile writes `_translated_n.xml` unless it sets "index".
+    Profiles sharing an "index" are extra keys for the same translation:
+    translate_dir_gemini.py spreads the chunks across them, while this script
+    (one file, one writer per output) uses the first one and warns.
+    """
+    with open(profiles_file, "r", encoding="utf-8") as file:
+        entries = json.load(file)
+
+    profiles = []
+    explicit = {}  # transno -> whether a profile set "index" for it
+    for i, entry in enumerate(entries, 1):
+        transno = f"translated_{entry.get('index', i)}"
+        if transno in explicit and not (explicit[transno] and "index" in entry):
+            # sharing an index by position only is most likely a numbering mistake
+            print(
+                f"Warning: profile {i} of {profiles_file} also writes {transno}; "
+                'set the same "index" on both if it is an extra key'
+            )
+        explicit[transno] = explicit.get(transno, True) and "index" in entry
+        profiles.append(
+            TranslationProfile(
+                transno=transno,
+                model=entry.get("model", AI_MODEL),
+                prompt_file=entry.get("prompt", "./prompt_Sinhala_English.md"),
+                key_file=entry.get("key_file"),
+                calls_per_minute=int(entry.get("rpm", CALLS_PER_MINUTE)),
+                adaptive=bool(entry.get("adaptive", False)),
+                max_calls_per_minute=entry.get("max_rpm"),
+                daily_limit=entry.get("rpd"),
+            )
+        )
+    return profiles
+
+
+def read_chunks(input_file) -> list[str]:
+    """Return every `<chunkN>...</chunkN>` block (tags included) of a chunk file."""
+    with open(input_file, "r", encoding="utf-8") as file:
+        content = file.read()
+
+    # Find all chunks using regex
+    chunk_pattern = r"<chunk\d+>(.*?)</chunk\d+>"
+    return [m.group(0) for m in re.finditer(chunk_pattern, content, re.DOTALL)]
+
+
+def translated_file_exists(input_file, transno: str) -> bool:
+    """True (and reported) if `<input>_{transno}.xml` is already there."""
+    source_path = Path(input_file)
+    existing_translations = list(
+        source_path.parent.glob(f"{source_path.stem}_{transno}.xml")
+    )
+    if existing_translations:
+        print(f"------> SKIPPING {input_file} - THERE IS A translated FILE here:")
+        for trans in existing_translations:
+            print(f"  {trans.name}")
+        return True
+    return False
+
+
+def write_translation_headers(f, log_f, input_file, profile: TranslationProfile):
+    """Write the <info> warning to the translated file and the log header; returns the <info> text."""
+    timestamp = datetime.now().strftime("%Y%m%d_%H%M%S")
+
+    # Write warning info to the translated files
+    info_warning = f"""<info>
+Translated by {profile.model}
 Started at: {timestamp}
 **WARNING: THIS IS AN AI-TRANSLATED EXPERIMENT.**
 
 - Please do not blindly trust the LLM output. LLMs can produce errors. If you are uncertain, refer to the original Pāḷi text for verification.
 </info>\n\n"""
-            f.write(info_warning)
-            # Write initial log info
-            log_f.write(f"Translation log for: {input_file}\n")
-            log_f.write(f"Started at: {timestamp}\n")
-            log_f.write(f"API Key file: {GEMINI_API_PROJECT_KEY_FILE}\n\n")
-            log_f.write(f"Used model: {AI_MODEL}\n\n")
-
-            for i, chunk in enumerate(chunks_list, 1):
-                input_chunk_text = chunk.group(0)  # Full chunk with tags
-
-                if input_chunk_text.strip():
-                    input_chunk_text = input_chunk_text.strip()
-
-                    print(f"\n{n_file}. Translating chunk {i}/{total_chunks}...")
-
-                    start_time = time.time()
-                    translated_text = gemini_translate(input_chunk_text)
-                    end_time = time.time()
-                    elapsed_time = end_time - start_time
-
-                    # Handle None returns from translation
-                    if translated_text is None:
-                        log_time = datetime.now().strftime("%Y-%m-%d %H:%M:%S")
-                        error_message = f"Chunk {i}: CHUNK_FAILED at {log_time}. Translation returned None after all retries.\n"
-                        print(error_message.strip())
-                        log_f.write(error_message)
-                        # Write original text instead of translation
-                        f.write(input_chunk_text)
-                        f.write("\n\n")
-                    else:
-                        f.write(translated_text)
-                        f.write("\n\n")
-                        f.flush()
-
-                        log_time = datetime.now().strftime("%Y-%m-%d %H:%M:%S")
-                        log_message = f"Chunk {i}: {log_time}. Took: {elapsed_time:.2f}s. Len tr./input chars: {len(translated_text)}/{len(input_chunk_text)}\n"
-                        print(log_message.strip())
-                        log_f.write(log_message)
-
-                    log_f.flush()
-
-            log_f.write(f"Output saved to {output_file}")
-            log_f.flush()
-
-        print(f"Translation completed. Output saved to {output_file}")
-        print(f"Log saved to {log_file}")
+    f.write(info_warning)
+    # Write initial log info
+    log_f.write(f"Translation log for: {input_file}\n")
+    log_f.write(f"Started at: {timestamp}\n")
+    log_f.write(f"API Key file: {profile.get_key_file()}\n\n")
+    log_f.write(f"Used model: {profile.model}\n\n")
+    log_f.write(f"Used prompt: {profile.prompt_file}\n\n")
+    return info_warning
+
+
+def translate_chunks_to_file(
+    input_file, chunks_list: list[str], n_file, profile: TranslationProfile
+):
+    """Translate already-read chunks with one profile into its own xml and log file."""
+    source_path = Path(input_file)
+    base_name = source_path.stem
+    transno = profile.transno
+    total_chunks = len(chunks_list)
+
+    # Look for existing translations with the same base name and transno
+    if translated_file_exists(input_file, transno):
+        return
+
+    output_file = source_path.parent / f"{base_name}_{transno}.xml"
+    log_file = source_path.parent / f"{base_name}_{transno}.log"
+
+    events = ChunkEventLog(output_file, fresh=True)
+    store = ChunkStore(output_file, fresh=True)
+    with open(output_file, "w", encoding="utf-8") as f, open(
+        log_file, "w", encoding="utf-8"
+    ) as log_f:
+        store.put_header(write_translation_headers(f, log_f, input_file, profile))
+
+        for i, input_chunk_text in enumerate(chunks_list, 1):
+            if input_chunk_text.strip():
+                input_chunk_text = input_chunk_text.strip()
+
+                print(f"\n{n_file}. [{transno}] Translating chunk {i}/{total_chunks}...")
+
+                start_time = time.time()
+                set_usage_context(input_file, i)
+                translated_text = profile.translate(input_chunk_text)
+                end_time = time.time()
+                elapsed_time = end_time - start_time
+
+                # Handle None returns from translation
+                if translated_text is None:
+                    error_message = render_event(events.record(i, "failed"))
+                    print(f"[{transno}] {error_message.strip()}")
+                    log_f.write(error_message)
+                    # Write original text instead of translation
+                    f.write(input_chunk_text)
+                    f.write("\n\n")
+                    store.put(i, input_chunk_text)
+                else:
+                    f.write(translated_text)
+                    store.put(i, translated_text)
+                    f.write("\n\n")
+                    f.flush()
+
+                    log_message = render_event(
+                        events.record(
+                            i,
+                            "done",
+                            elapsed=round(elapsed_time, 2),
+                            input_chars=len(input_chunk_text),
+                            output_chars=len(translated_text),
+                        )
+                    )
+                    print(f"[{transno}] {log_message.strip()}")
+                    log_f.write(log_message)
+
+                log_f.flush()
+
+        log_f.write(f"Output saved to {output_file}")
+        log_f.flush()
+
+    print(f"Translation completed. Output saved to {output_file}")
+    print(f"Log saved to {log_file}")
+
+
+# key_file is not used, just for the call in translate_dir_gemini
+def process_xml_file_with_regex(input_file, n_file, transno="translated_1"):
+    try:
+        chunks_list = read_chunks(input_file)
+        print(f"Found {len(chunks_list)} chunks to translate")
+
+        profile = TranslationProfile(transno=transno)
+        # keep sharing the module-level limiter/client of gemini_translate
+        profile.translate = gemini_translate
+        translate_chunks_to_file(input_file, chunks_list, n_file, profile)
+
+    except Exception as e:
+        print(f"Error processing file: {e}")
+
+
+def process_xml_file_fan_out(input_file, n_file, profiles: list[TranslationProfile]):
+    """Read chunks once and translate them with every profile concurrently.
+
+    Each profile writes its own `_translated_N.xml` and log in chunk order, so the
+    wall-clock time is roughly that of the slowest profile.
+    """
+    try:
+        chunks_list = read_chunks(input_file)
+        print(
+            f"Found {len(chunks_list)} chunks to translate with {len(profiles)} profiles"
+        )
+
+        # one writer per output file: extra keys for the same transno are unused here
+        by_transno = {}
+        for profile in profiles:
+            if profile.transno in by_transno:
+                print(
+                    f"Warning: not using {profile.name}, {profile.transno} is written with "
+                    f"{by_transno[profile.transno].name} (use translate_dir_gemini.py "
+                    "to spread chunks across keys)"
+                )
+                continue
+            by_transno[profile.transno] = profile
+        profiles = list(by_transno.values())
+
+        with ThreadPoolExecutor(max_workers=len(profiles)) as executor:
+            futures = {
+                executor.submit(
+                    translate_chunks_to_file, input_file, chunks_list, n_file, profile
+                ): profile
+                for profile in profiles
+            }
+            for future in as_completed(futures):
+                profile = futures[future]
+                try:
+                    future.result()
+                except Exception as e:
+                    print(f"Error processing file with {profile.transno}: {e}")
 
     except Exception as e:
         print(f"Error processing file: {e}")
 
 
-def gemini_translator(input_xml: str,  n_file: str = "1", key_file: str = GEMINI_API_PROJECT_KEY_FILE):
-    process_xml_file_with_regex(input_xml, n_file)
+def gemini_translator(
+    input_xml: str,
+    n_file: str = "1",
+    key_file: str = GEMINI_API_PROJECT_KEY_FILE,
+    profiles: list[TranslationProfile] | None = None,
+):
+    if profiles:
+        process_xml_file_fan_out(input_xml, n_file, profiles)
+    else:
+        process_xml_file_with_regex(input_xml, n_file)
 
 
 if __name__ == "__main__":
@@ -253,6 +553,12 @@ if __name__ == "__main__":
         default="./prompt_Sinhala_English.md",
         help="Path to the prompt file (default: ./prompt_Sinhala_English.md)",
     )
+    parser.add_argument(
+        "--profiles",
+        type=str,
+        default=None,
+        help="JSON file of model/prompt/key profiles; translates into _translated_1..N in one pass",
+    )
 
 
     args = parser.parse_args()
@@ -262,4 +568,5 @@ if __name__ == "__main__":
         print(f"Error: Input file '{args.input_file}' does not exist")
         exit(1)
 
-    gemini_translator(args.input_file, "1")
+    profiles = load_profiles(args.profiles) if args.profiles else None
+    gemini_translator(args.input_file, "1", profiles=profiles)
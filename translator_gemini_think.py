@@ -2,15 +2,43 @@
 # https://aistudio.google.com/prompts/new_chat
 # in the top right corner, click Get code
 
+from __future__ import annotations
+
 import argparse
+import random
+import threading
 import time
+
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime
+from pathlib import Path
 from google import genai
 from google.genai import types
 from prompt_toolkit import prompt
 from prompt_toolkit.completion import PathCompleter
 from prompt_toolkit.validation import Validator, ValidationError
 
-from chunk_copier import load_file_content, extract_chunks
+from chunk_copier import load_file_content
+from chunk_events import ChunkEventLog, render_event
+from chunk_store import ChunkStore
+from line_index import LineIndex
+from quota_store import daily_limit_for, get_quota_store, key_id_of, next_reset
+from rate_scheduler import (
+    AdaptiveRateScheduler,
+    RateScheduler,
+    error_class,
+    is_rate_limit_error,
+    latency_stats,
+)
+from run_metrics import metrics
+from think_extract import ThinkStreamExtractor, format_id_report, validate_chunk_ids
+from truncation import (
+    MAX_CONTINUATIONS,
+    finish_reason_name,
+    last_complete_line_id,
+    needs_continuation,
+)
+from usage_ledger import record_usage, set_usage_context
 
 
 key_file = "./gemini_key_project_1.txt"
@@ -63,19 +91,140 @@ class NumberValidator(Validator):
             raise ValidationError(message="Please enter a valid number")
 
 
-def do_think(
+THINK_MODEL = "gemini-2.0-flash-thinking-exp-01-21"
+
+# Gemini 2.0 Flash Thinking Experimental 01-21: 10 RPM, 4,000,000 TPM, 1,500 RPD
+THINK_CALLS_PER_MINUTE = 10
+THINK_WORKERS = 3
+
+MAX_RETRIES = 5
+INITIAL_RETRY_DELAY = 10
+MAX_RETRY_DELAY = 320
+
+client = None
+
+
+def get_client():
+    """Return the long-lived client, creating it on first use."""
+    global client
+    if client is None:
+        client = genai.Client(api_key=load_file_content(key_file).strip())
+    return client
+
+
+class OrderedThinkWriter:
+    """Single writer that saves finished chunks in chunk order.
+
+    Workers finish out of order; their results are buffered until every earlier
+    chunk has been written. For each chunk it:
+    - appends the raw stream as a `<thinkN>` block to `save_stream_file`,
+    - stores the extracted `<chunkN>` translation in the ChunkStore of the
+      `_translated_N.xml` file,
+    - appends the reasoning text as a `<thinkN>` block to the `_thinking.xml` sidecar,
+    - appends a `Chunk N: ...` line to the log (CHUNK_FAILED like translator_gemini.py).
+
+    The `_translated_N.xml` file is assembled from the store on close(), so a
+    rerun of some chunks replaces them instead of adding them a second time.
+    """
+
+    def __init__(
+        self,
+        save_stream_file: str,
+        chunk_order: list[int],
+        translated_file: Path,
+        thinking_file: Path,
+        log_file: Path,
+    ):
+        self.save_stream_file = save_stream_file
+        self.chunk_order = chunk_order
+        self.next_index = 0
+        self.pending = {}
+        self.failed = []
+        self.lock = threading.Lock()
+        is_new = not translated_file.exists() or translated_file.stat().st_size == 0
+        # an existing translation is split into the store before anything runs
+        self.store = ChunkStore(translated_file, fresh=is_new)
+        self.events = ChunkEventLog(translated_file, fresh=is_new)
+        self.file = open(save_stream_file, "a", encoding="utf-8")
+        self.thinking = open(thinking_file, "a", encoding="utf-8")
+        self.log = open(log_file, "a", encoding="utf-8")
+        if is_new:
+            timestamp = datetime.now().strftime("%Y%m%d_%H%M%S")
+            header = f"""<info>
+Translated by {THINK_MODEL}
+Started at: {timestamp}
+**WARNING: THIS IS AN AI-TRANSLATED EXPERIMENT.**
+
+- Please do not blindly trust the LLM output. LLMs can produce errors. If you are uncertain, refer to the original Pāḷi text for verification.
+</info>\n\n"""
+            self.store.put_header(header)
+            self.log.write(f"Used model: {THINK_MODEL}\n\n")
+
+    def put(self, chunk_no: int, source_chunk: str, result: ThinkStreamExtractor | None):
+        with self.lock:
+            self.pending[chunk_no] = (source_chunk, result)
+            while (
+                self.next_index < len(self.chunk_order)
+                and self.chunk_order[self.next_index] in self.pending
+            ):
+                n = self.chunk_order[self.next_index]
+                self._write(n, *self.pending.pop(n))
+                self.next_index += 1
+
+    def _write(self, n: int, source_chunk: str, result: ThinkStreamExtractor | None):
+        if result is not None:
+            self.file.write(f"<think{n}>\n\n{result.raw_text()}\n\n</think{n}>\n\n\n")
+            self.file.flush()
+            self.thinking.write(
+                f"<think{n}>\n\n{result.reasoning_text()}\n\n</think{n}>\n\n\n"
+            )
+            self.thinking.flush()
+
+        block = result.translation_block() if result is not None else None
+        if block is None:
+            self.failed.append(n)
+            # Write original text instead of translation
+            self.store.put(n, source_chunk.strip())
+            self.log.write(
+                render_event(
+                    self.events.record(
+                        n,
+                        "failed",
+                        reason="No translation extracted from the thinking output.",
+                    )
+                )
+            )
+        else:
+            self.store.put(n, block)
+            ids = validate_chunk_ids(source_chunk, block)
+            event = self.events.record(
+                n,
+                "done",
+                report=format_id_report(n, ids),
+                missing=ids["missing"],
+                extra=ids["extra"],
+                unclosed=result.unclosed,
+                input_chars=len(source_chunk),
+                output_chars=len(block),
+            )
+            self.log.write(render_event(event))
+        self.log.flush()
+
+    def close(self):
+        """Assemble the `_translated_N.xml` file and close the appended files."""
+        self.store.assemble()
+        for f in (self.file, self.thinking, self.log):
+            f.close()
+
+
+def stream_once(
     chunk_no: int,
     system_prompt: str,
     chunk_text: str,
-    save_stream_file: str = "thought.xml",
-):
-    # output token can be upto 65,536,
-    # so input (prompt + translating chunks) tokens can be around 40,000, but please use around 20,000
-    # python3 token_chunk.py -f dvematikapali.txt --max-tokens 20000
-
-    client = genai.Client(api_key=load_file_content(key_file).strip())
-    model = "gemini-2.0-flash-thinking-exp-01-21"
-
+    scheduler: RateScheduler,
+    echo: bool = False,
+) -> tuple[ThinkStreamExtractor, str | None] | None:
+    """Stream one request with retries; returns (extractor, finish reason) or None."""
     pc = chunk_text.strip()
     prompt_contents = [
         types.Content(
@@ -98,28 +247,93 @@ def do_think(
         ],
     )
 
-    try:
-        with open(save_stream_file, "a") as f:
-            f.write(f"<think{chunk_no}>\n\n")
-            f.flush()
-
-            for chunk in client.models.generate_content_stream(
-                model=model,
-                contents=prompt_contents,
-                config=generate_content_config,
-            ):
-                f.write(chunk.text)
-                f.flush()
-                print(chunk.text, end="")
+    for attempt in range(1, MAX_RETRIES + 1):
+        extractor = ThinkStreamExtractor(chunk_no)
+        finish_reason = None
+        usage = None
+        try:
+            with scheduler:
+                key_id = key_id_of(key_file)
+                get_quota_store().record(key_id, THINK_MODEL)
+                start_time = time.time()
+                for chunk in get_client().models.generate_content_stream(
+                    model=THINK_MODEL,
+                    contents=prompt_contents,
+                    config=generate_content_config,
+                ):
+                    # the last streamed piece carries the finish reason
+                    finish_reason = finish_reason_name(chunk) or finish_reason
+                    usage = getattr(chunk, "usage_metadata", None) or usage
+                    if chunk.text:
+                        extractor.feed(chunk.text)
+                        if echo:
+                            print(chunk.text, end="")
+                latency = time.time() - start_time
+                scheduler.record_success(latency)
+                record_usage(usage, THINK_MODEL, key_id, latency, finish_reason)
+            extractor.close()
+            return extractor, finish_reason
+
+        except Exception as e:
+            delay = min(INITIAL_RETRY_DELAY * (2 ** (attempt - 1)), MAX_RETRY_DELAY)
+            delay += random.uniform(0, 0.1 * delay)
+            print(f"\nChunk {chunk_no}: attempt {attempt} failed: {e}")
+            metrics.record_error(error_class(e))
+            if is_rate_limit_error(e):
+                # pause every stream sharing this key, not just this one
+                scheduler.record_rate_limit()
+                scheduler.back_off(delay)
+            elif attempt < MAX_RETRIES:
+                time.sleep(delay)
+
+    print(f"Chunk {chunk_no}: THINK_FAILED after {MAX_RETRIES} attempts")
+    return None
 
-            f.write(f"\n\n</think{chunk_no}>\n\n\n")
-            f.flush()
 
-    except Exception as e:
-        print(f"An error occurred: {e}")
-    finally:
-        print(f"\nStreaming output saved to: {save_stream_file}")
-    return True
+def do_think(
+    chunk_no: int,
+    system_prompt: str,
+    chunk_text: str,
+    scheduler: RateScheduler | None = None,
+    echo: bool = False,
+) -> ThinkStreamExtractor | None:
+    """Stream one chunk through the thinking model.
+
+    The streamed text is split into translation and reasoning as it arrives.
+    If the answer stops at the output-token cap, only the lines after the last
+    complete line ID are requested again and stitched to the first part.
+    Returns the extractor, or None if the chunk still fails after MAX_RETRIES.
+    """
+    # output token can be upto 65,536,
+    # so input (prompt + translating chunks) tokens can be around 40,000, but please use around 20,000
+    # python3 token_chunk.py -f dvematikapali.txt --max-tokens 20000
+
+    if scheduler is None:
+        scheduler = RateScheduler(THINK_CALLS_PER_MINUTE)
+
+    result = stream_once(chunk_no, system_prompt, chunk_text, scheduler, echo)
+    if result is None:
+        return None
+    extractor, finish_reason = result
+
+    for _ in range(MAX_CONTINUATIONS):
+        remaining = needs_continuation(
+            extractor.answer_text(), chunk_text, finish_reason
+        )
+        if remaining is None:
+            break
+        print(
+            f"\nChunk {chunk_no}: TRUNCATED ({finish_reason}) after line "
+            f"{last_complete_line_id(extractor.answer_text())}. Requesting the remaining lines..."
+        )
+        continuation = stream_once(chunk_no, system_prompt, remaining, scheduler, echo)
+        if continuation is None:
+            # keep the partial answer, the per-chunk ID check reports the gap
+            break
+        extractor.extend(continuation[0])
+        finish_reason = continuation[1]
+
+    return extractor
 
 
 def gemini_think(
@@ -127,29 +341,89 @@ def gemini_think(
     save_stream_file,
     start_chunk=1,
     sys_prompt_file="./prompt_think_pali_eng.md",
+    workers=THINK_WORKERS,
+    calls_per_minute=THINK_CALLS_PER_MINUTE,
+    index=1,
+    adaptive=False,
 ):
     system_prompt = load_file_content(sys_prompt_file)
     system_prompt = system_prompt.strip()
-    chunks = extract_chunks(load_file_content(chunk_file))
+    with LineIndex(chunk_file) as chunk_index:
+        chunks = [(n, chunk_index.chunk(n)) for n in sorted(chunk_index.chunk_numbers)]
 
+    todo = []
     for n, text in chunks:
         if n < start_chunk:
             print(f"Skipping chunk {n}")
             continue
+        todo.append((n, f"<chunk{n}>\n\n{text}\n\n</chunk{n}>"))
 
-        chunk_text = f"<chunk{n}>\n\n{text}\n\n</chunk{n}>"
+    # one client and one scheduler shared by all streams
+    if adaptive:
+        scheduler = AdaptiveRateScheduler(
+            calls_per_minute, max_in_flight=1, model=THINK_MODEL
+        )
+        scheduler.set_in_flight_ceiling(workers)
+    else:
+        scheduler = RateScheduler(
+            calls_per_minute, max_in_flight=workers, model=THINK_MODEL
+        )
+    # continue the rate window and daily count of earlier runs
+    quota = get_quota_store()
+    scheduler.seed(quota.recent(key_id_of(key_file), THINK_MODEL, scheduler.period))
+    remaining = max(
+        0, daily_limit_for(THINK_MODEL) - quota.used_today(key_id_of(key_file), THINK_MODEL)
+    )
+    print(
+        f"{THINK_MODEL}: {remaining} requests left today, "
+        f"quota resets at {next_reset():%Y-%m-%d %H:%M %Z}"
+    )
+    if len(todo) > remaining:
+        deferred = [n for n, _ in todo[remaining:]]
+        todo = todo[:remaining]
+        print(f"Not enough daily quota, deferring chunks {deferred}")
+
+    chunk_path = Path(chunk_file)
+    translated_file = chunk_path.parent / f"{chunk_path.stem}_translated_{index}.xml"
+    thinking_file = chunk_path.parent / f"{chunk_path.stem}_translated_{index}_thinking.xml"
+    log_file = chunk_path.parent / f"{chunk_path.stem}_translated_{index}.log"
+    writer = OrderedThinkWriter(
+        save_stream_file, [n for n, _ in todo], translated_file, thinking_file, log_file
+    )
 
-        # limit 10 requests/minute
+    def think_chunk(n, chunk_text):
         print(f"\nThinking chunk {n}")
-
-        do_think(
+        start_time = time.time()
+        set_usage_context(chunk_file, n)
+        result = do_think(
             chunk_no=n,
             system_prompt=system_prompt,
             chunk_text=chunk_text,
-            save_stream_file=save_stream_file,
+            scheduler=scheduler,
+            echo=workers == 1,
         )
-        print(f"Done thinking chunk {n}. Will sleep for 30 seconds.")
-        time.sleep(30)
+        if result is not None:
+            print(
+                "\n"
+                + format_id_report(n, validate_chunk_ids(chunk_text, result.translation_block()))
+            )
+        writer.put(n, chunk_text, result)
+        print(f"\nDone thinking chunk {n}. Took: {time.time() - start_time:.2f}s")
+
+    try:
+        with ThreadPoolExecutor(max_workers=workers) as executor:
+            for future in [executor.submit(think_chunk, n, t) for n, t in todo]:
+                future.result()
+    finally:
+        writer.close()
+
+    print(f"\nStreaming output saved to: {save_stream_file}")
+    print(f"Translation saved to: {translated_file}")
+    print(f"Reasoning saved to: {thinking_file}")
+    print(f"Log saved to: {log_file}")
+    if writer.failed:
+        print(f"Failed chunks (source text written instead): {writer.failed}")
+    print(f"Latency:\n{latency_stats.summary()}")
     print("Done chunks are processed")
 
 
@@ -171,6 +445,29 @@ def main():
         default="./prompt_think_pali_eng.md",
         help="Path to the system prompt file",
     )
+    parser.add_argument(
+        "--adaptive",
+        action="store_true",
+        help="Adapt the rate and concurrent streams to observed 429s and latency (AIMD)",
+    )
+    parser.add_argument(
+        "--index",
+        type=int,
+        default=1,
+        help="Write the extracted translation to _translated_{index}.xml (default: 1)",
+    )
+    parser.add_argument(
+        "--workers",
+        type=int,
+        default=THINK_WORKERS,
+        help=f"Number of concurrent streams (default: {THINK_WORKERS})",
+    )
+    parser.add_argument(
+        "--rpm",
+        type=int,
+        default=THINK_CALLS_PER_MINUTE,
+        help=f"Requests per minute allowed for the model (default: {THINK_CALLS_PER_MINUTE})",
+    )
 
     args = parser.parse_args()
 
@@ -210,7 +507,16 @@ def main():
                 "Invalid input. Please enter a number or press Enter to start from the beginning."
             )
 
-    gemini_think(chunk_file, save_stream_file, start_chunk, sys_prompt_file)
+    gemini_think(
+        chunk_file,
+        save_stream_file,
+        start_chunk,
+        sys_prompt_file,
+        workers=args.workers,
+        calls_per_minute=args.rpm,
+        index=args.index,
+        adaptive=args.adaptive,
+    )
 
 
 if __name__ == "__main__":
@@ -0,0 +1,141 @@
+"""Detect responses cut off at the output-token cap and continue them.
+
+When a response stops at `max_output_tokens`, only the lines after the last
+complete `<line id>` are sent again (as a smaller chunk with the same number),
+and the pieces are stitched into one `<chunkN>...</chunkN>` block.
+"""
+
+from __future__ import annotations
+
+import re
+
+MAX_CONTINUATIONS = 3
+
+CHUNK_NO_PATTERN = re.compile(r"<chunk(\d+)>")
+COMPLETE_LINE_PATTERN = re.compile(r'<line id="(\d+)">.*?</line>', re.DOTALL)
+
+
+def finish_reason_name(response) -> str | None:
+    """Return the finish reason of the first candidate as a plain name, e.g. 'MAX_TOKENS'."""
+    try:
+        reason = response.candidates[0].finish_reason
+    except (AttributeError, IndexError, TypeError):
+        return None
+    if reason is None:
+        return None
+    return getattr(reason, "name", str(reason)).split(".")[-1]
+
+
+def chunk_number(text: str) -> int | None:
+    match = CHUNK_NO_PATTERN.search(text)
+    return int(match.group(1)) if match else None
+
+
+def last_complete_line_id(text: str) -> int | None:
+    """ID of the last `<line id>` that was closed with `</line>`."""
+    last = None
+    for match in COMPLETE_LINE_PATTERN.finditer(text):
+        last = int(match.group(1))
+    return last
+
+
+def cut_after_last_line(text: str) -> str:
+    """Drop everything after the last complete `</line>` (a half-written line)."""
+    end = None
+    for match in COMPLETE_LINE_PATTERN.finditer(text):
+        end = match.end()
+    if end is None:
+        match = CHUNK_NO_PATTERN.search(text)
+        return text[: match.end()] if match else ""
+    return text[:end]
+
+
+def lines_body(text: str) -> str:
+    """The part of a response from its first `<line id>` to its last `</line>`."""
+    matches = list(COMPLETE_LINE_PATTERN.finditer(text))
+    if not matches:
+        return ""
+    return text[matches[0].start() : matches[-1].end()]
+
+
+def remaining_source_chunk(source_chunk: str, last_id: int | None) -> str | None:
+    """Source chunk reduced to the lines after `last_id`, or None if nothing is left."""
+    n = chunk_number(source_chunk)
+    lines = [
+        m.group(0)
+        for m in COMPLETE_LINE_PATTERN.finditer(source_chunk)
+        if last_id is None or int(m.group(1)) > last_id
+    ]
+    if not lines:
+        return None
+    body = "\n\n".join(lines)
+    return f"<chunk{n}>\n\n{body}\n\n</chunk{n}>"
+
+
+def needs_continuation(
+    text: str, source_chunk: str, finish_reason: str | None
+) -> str | None:
+    """Return the continuation chunk to send if `text` was truncated, else None.
+
+    A response is truncated if it stopped at MAX_TOKENS, or if it opened
+    `<chunkN>` but never closed it while source lines are still missing.
+    """
+    n = chunk_number(source_chunk)
+    unclosed = f"<chunk{n}>" in text and f"</chunk{n}>" not in text
+    if finish_reason != "MAX_TOKENS" and not unclosed:
+        return None
+    return remaining_source_chunk(source_chunk, last_complete_line_id(text))
+
+
+def stitch_lines(head: str, continuation: str) -> str:
+    """Join a truncated response and its continuation.
+
+    The closing `</chunkN>` is kept only if the continuation itself closed it.
+    """
+    n = chunk_number(head)
+    body = lines_body(continuation)
+    head = cut_after_last_line(head).rstrip()
+    text = f"{head}\n\n{body}" if body else head
+    if n is not None and f"</chunk{n}>" in continuation:
+        text = f"{text}\n\n</chunk{n}>"
+    return text
+
+
+def translate_with_continuation(request, chunk: str) -> str | None:
+    """Call `request(chunk)` and follow up on truncated responses.
+
+    `request` returns a GenerateContentResponse, or None if it failed after all
+    retries. Returns the stitched text, or None if any piece failed or the chunk
+    is still truncated after MAX_CONTINUATIONS, so it is logged as CHUNK_FAILED.
+    """
+    response = request(chunk)
+    if response is None:
+        return None
+    text = response.text
+    finish_reason = finish_reason_name(response)
+    if text is None:
+        return None
+
+    n = chunk_number(chunk)
+    continuations = 0
+    while True:
+        remaining = needs_continuation(text, chunk, finish_reason)
+        if remaining is None:
+            break
+        if continuations == MAX_CONTINUATIONS:
+            print(f"Chunk {n}: still truncated after {MAX_CONTINUATIONS} continuations")
+            return None
+        print(
+            f"Chunk {n}: TRUNCATED ({finish_reason}) after line "
+            f"{last_complete_line_id(text)}. Requesting the remaining lines..."
+        )
+        response = request(remaining)
+        if response is None or response.text is None:
+            return None
+        text = stitch_lines(text, response.text)
+        finish_reason = finish_reason_name(response)
+        continuations += 1
+
+    if continuations and f"</chunk{n}>" not in text:
+        text = f"{text.rstrip()}\n\n</chunk{n}>"
+    return text
@@ -0,0 +1,181 @@
+"""Per-request token usage ledger.
+
+Every Gemini call writes one row with its usage metadata (prompt, output, cached
+and thinking tokens), model, key, latency and finish reason, together with the
+book (chunk file) and chunk number it was made for. The rows are never trimmed,
+so they can be summed per book, per model or per day:
+
+python3 usage_ledger.py --by book
+python3 usage_ledger.py --by day --model gemini-2.0-flash
+"""
+
+from __future__ import annotations
+
+import argparse
+import sqlite3
+import threading
+import time
+from pathlib import Path
+
+from run_metrics import metrics
+
+USAGE_DB_FILE = "./gemini_usage.sqlite"
+
+_local = threading.local()
+
+
+def set_usage_context(book: str | None = None, chunk: int | None = None):
+    """Book and chunk the requests made on this thread are for."""
+    _local.context = (str(Path(book).name) if book else None, chunk)
+
+
+def get_usage_context() -> tuple[str | None, int | None]:
+    return getattr(_local, "context", (None, None))
+
+
+def usage_counts(usage) -> dict:
+    """Token counts of a response's `usage_metadata` (missing counts are 0)."""
+
+    def count(name):
+        return getattr(usage, name, None) or 0
+
+    return {
+        "prompt_tokens": count("prompt_token_count"),
+        "output_tokens": count("candidates_token_count"),
+        "cached_tokens": count("cached_content_token_count"),
+        "thoughts_tokens": count("thoughts_token_count"),
+        "total_tokens": count("total_token_count"),
+    }
+
+
+class UsageLedger:
+    def __init__(self, db_file: str = USAGE_DB_FILE):
+        self.db_file = db_file
+        self.lock = threading.Lock()
+        self.conn = sqlite3.connect(db_file, check_same_thread=False)
+        self.conn.execute(
+            """CREATE TABLE IF NOT EXISTS usage (
+                ts REAL, book TEXT, chunk INTEGER, model TEXT, key_id TEXT,
+                prompt_tokens INTEGER, output_tokens INTEGER, cached_tokens INTEGER,
+                thoughts_tokens INTEGER, total_tokens INTEGER,
+                latency REAL, finish_reason TEXT
+            )"""
+        )
+        self.conn.commit()
+
+    def record(
+        self,
+        usage,
+        model: str,
+        key_id: str,
+        latency: float,
+        finish_reason: str | None = None,
+    ):
+        """Write one request; `usage` is the response's `usage_metadata` (may be None)."""
+        book, chunk = get_usage_context()
+        counts = usage_counts(usage)
+        with self.lock:
+            self.conn.execute(
+                "INSERT INTO usage VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)",
+                (
+                    time.time(),
+                    book,
+                    chunk,
+                    model,
+                    key_id,
+                    counts["prompt_tokens"],
+                    counts["output_tokens"],
+                    counts["cached_tokens"],
+                    counts["thoughts_tokens"],
+                    counts["total_tokens"],
+                    latency,
+                    finish_reason,
+                ),
+            )
+            self.conn.commit()
+
+    def summary(self, by: str = "book", model: str | None = None) -> list[tuple]:
+        """Rows of (group, requests, prompt, output, cached, thoughts, avg latency)."""
+        group = {
+            "book": "COALESCE(book, '-')",
+            "model": "model",
+            "day": "date(ts, 'unixepoch', 'localtime')",
+            "key": "key_id",
+        }[by]
+        where, params = ("WHERE model = ?", (model,)) if model else ("", ())
+        with self.lock:
+            return self.conn.execute(
+                f"""SELECT {group} AS g, COUNT(*), SUM(prompt_tokens), SUM(output_tokens),
+                    SUM(cached_tokens), SUM(thoughts_tokens), AVG(latency)
+                    FROM usage {where} GROUP BY g ORDER BY g""",
+                params,
+            ).fetchall()
+
+    def close(self):
+        with self.lock:
+            self.conn.close()
+
+
+_ledger = None
+_ledger_lock = threading.Lock()
+
+
+def get_usage_ledger() -> UsageLedger:
+    """The shared ledger in USAGE_DB_FILE, opened on first use."""
+    global _ledger
+    with _ledger_lock:
+        if _ledger is None:
+            _ledger = UsageLedger()
+    return _ledger
+
+
+def record_usage(
+    usage, model: str, key_id: str, latency: float, finish_reason: str | None = None
+):
+    """Record one request in the shared ledger; a ledger error never fails a translation."""
+    if usage is not None:
+        metrics.record_tokens(usage_counts(usage)["total_tokens"])
+    try:
+        get_usage_ledger().record(usage, model, key_id, latency, finish_reason)
+    except Exception as e:
+        print(f"Could not record token usage: {e}")
+
+
+def print_summary(rows: list[tuple], by: str):
+    print(
+        f"{by:<40} {'requests':>9} {'prompt':>12} {'output':>12} {'cached':>10} {'thoughts':>10} {'avg s':>7}"
+    )
+    totals = [0, 0, 0, 0, 0]
+    for group, requests, prompt, output, cached, thoughts, latency in rows:
+        print(
+            f"{str(group):<40} {requests:>9} {prompt or 0:>12,} {output or 0:>12,} "
+            f"{cached or 0:>10,} {thoughts or 0:>10,} {latency or 0:>7.1f}"
+        )
+        for i, value in enumerate((requests, prompt, output, cached, thoughts)):
+            totals[i] += value or 0
+    print(
+        f"{'Total':<40} {totals[0]:>9} {totals[1]:>12,} {totals[2]:>12,} "
+        f"{totals[3]:>10,} {totals[4]:>10,}"
+    )
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Summarize the Gemini token usage ledger.")
+    parser.add_argument(
+        "--by",
+        choices=["book", "model", "day", "key"],
+        default="book",
+        help="Group the usage by book, model, day or key (default: book)",
+    )
+    parser.add_argument("-m", "--model", default=None, help="Only this model")
+    parser.add_argument(
+        "--db", default=USAGE_DB_FILE, help=f"Ledger file (default: {USAGE_DB_FILE})"
+    )
+    args = parser.parse_args()
+
+    if not Path(args.db).exists():
+        print(f"No usage ledger found at {args.db}")
+    else:
+        ledger = UsageLedger(args.db)
+        print_summary(ledger.summary(args.by, args.model), args.by)
+        ledger.close()
@@ -0,0 +1,253 @@
+"""Watch directories and translate new or changed chunk files as they appear.
+
+Runs until stopped (Ctrl+C). New `*_chunks.xml` files (and files whose content
+changed) are put into the persistent job queue (job_queue.py) and translated by
+one long-running worker, so the API clients and rate limiters stay warm between
+files. When a file is finished it is checked for missing line IDs; once all of
+its translations are finished they are joined into the multilingual markdown
+and converted to HTML.
+
+python3 watch_translate.py -d folder_1 folder_2 -k key_1.txt -c 2
+
+New files are noticed with inotify when the optional `inotify_simple` package is
+installed (pip install inotify_simple), otherwise the directories are polled.
+A file is only queued once it has not changed for --settle seconds.
+"""
+
+from __future__ import annotations
+
+import argparse
+import fnmatch
+import hashlib
+import os
+import re
+import time
+from concurrent.futures import ThreadPoolExecutor
+from pathlib import Path
+
+from check_translate import check_translation_completeness
+from job_queue import DEFAULT_LEASE_SECONDS, QUEUE_DB_FILE, JobQueue
+from queue_worker import QueueWorker, fake_translate
+from run_metrics import start_metrics_server
+from translator_gemini import TranslationProfile, load_profiles, set_gemini_key_file
+
+try:
+    from inotify_simple import INotify, flags  # optional, Linux only
+except ImportError:
+    INotify = None
+
+STAGES = ("check", "join", "html")
+
+
+def file_digest(path) -> str:
+    with open(path, "rb") as f:
+        return hashlib.sha256(f.read()).hexdigest()
+
+
+class DirectoryWatcher:
+    """Reports files matching `pattern` that are new or changed and then left alone."""
+
+    def __init__(self, directories, pattern: str, poll_interval: float = 10, settle: float = 5):
+        self.directories = [Path(d) for d in directories]
+        self.pattern = pattern
+        self.poll_interval = poll_interval
+        self.settle = settle
+        self.signatures = {}  # path -> (mtime, size) last seen
+        self.changed_at = {}  # path -> when that signature was first seen
+        self.reported = {}  # path -> signature already reported
+        self.scanned = False
+        self.inotify = None
+        if INotify is not None:
+            self.inotify = INotify()
+            watch_flags = flags.CREATE | flags.CLOSE_WRITE | flags.MOVED_TO
+            for directory in self.directories:
+                self.inotify.add_watch(str(directory), watch_flags)
+
+    @property
+    def mode(self) -> str:
+        return "inotify" if self.inotify is not None else f"polling every {self.poll_interval:g}s"
+
+    def scan(self) -> list[Path]:
+        now = time.time()
+        ready = []
+        for directory in self.directories:
+            for name in sorted(os.listdir(directory)):
+                if not fnmatch.fnmatch(name, self.pattern):
+                    continue
+                path = directory / name
+                try:
+                    stat = path.stat()
+                except OSError:
+                    continue
+                signature = (stat.st_mtime, stat.st_size)
+                if self.signatures.get(path) != signature:
+                    self.signatures[path] = signature
+                    # files already there at start are not being written any more
+                    self.changed_at[path] = now if self.scanned else 0
+                if self.reported.get(path) == signature:
+                    continue
+                if now - self.changed_at[path] >= self.settle:
+                    self.reported[path] = signature
+                    ready.append(path)
+        self.scanned = True
+        return ready
+
+    def _settling(self) -> bool:
+        return any(self.reported.get(p) != s for p, s in self.signatures.items())
+
+    def wait(self):
+        """Block until a directory changes, a file may have settled or the poll interval passed."""
+        timeout = min(self.settle, self.poll_interval) if self._settling() else self.poll_interval
+        if self.inotify is not None:
+            self.inotify.read(timeout=int(timeout * 1000))
+        else:
+            time.sleep(timeout)
+
+
+def book_title(input_file) -> str:
+    """Title from the file name: `vinaya_dvematika_46_chunks.xml` -> `Vinaya Dvematika`."""
+    stem = re.sub(r"(_\d+)?_chunks$", "", Path(input_file).stem)
+    return stem.replace("_", " ").replace("-", " ").title()
+
+
+class Stages:
+    """Check, join and HTML steps run after a file's translations are finished."""
+
+    def __init__(self, queue: JobQueue, transnos: list[str], stages, template: str):
+        self.queue = queue
+        self.transnos = transnos
+        self.stages = stages
+        self.template = template
+        # one at a time, next to the translation workers
+        self.executor = ThreadPoolExecutor(max_workers=1)
+
+    def file_finished(self, input_file, output_file, transno, failed):
+        self.executor.submit(self._run, input_file, output_file, transno)
+
+    def _run(self, input_file, output_file, transno):
+        try:
+            if "check" in self.stages:
+                check_translation_completeness(str(input_file), str(output_file))
+            if set(self.queue.finished_transnos(input_file)) != set(self.transnos):
+                return
+            num_translations = max(
+                int(t.rsplit("_", 1)[-1]) for t in self.transnos if t[-1].isdigit()
+            )
+            md_file = None
+            if "join" in self.stages:
+                from join_translations import create_multilingual_md
+
+                create_multilingual_md(str(input_file), num_translations)
+                source_path = Path(input_file)
+                md_file = source_path.parent / f"{source_path.stem}_{num_translations}_translations.md"
+            if "html" in self.stages and md_file is not None and md_file.exists():
+                from gen_tpo_html import convert_addTOC
+
+                convert_addTOC(
+                    str(md_file),
+                    book_title(input_file),
+                    num_translations=num_translations,
+                    tpo_template=self.template,
+                )
+        except Exception as e:
+            print(f"Error in post-processing {input_file}: {e}")
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(
+        description="Watch directories and translate new or changed chunk files as they appear."
+    )
+    parser.add_argument(
+        "-d", "--directory", nargs="+", required=True, help="Directories to watch"
+    )
+    parser.add_argument(
+        "-p", "--pattern", default="*_chunks.xml", help="File pattern (default: *_chunks.xml)"
+    )
+    parser.add_argument(
+        "-k",
+        "--key-file",
+        nargs="+",
+        default=["./gemini_key_project_1.txt"],
+        help="Gemini API key files (default: ./gemini_key_project_1.txt)",
+    )
+    parser.add_argument("--profiles", default=None, help="JSON file of model/prompt/key profiles")
+    parser.add_argument("-c", "--concurrency", type=int, default=1, help="Concurrent requests")
+    parser.add_argument(
+        "--queue", default=QUEUE_DB_FILE, help=f"Job queue database (default: {QUEUE_DB_FILE})"
+    )
+    parser.add_argument(
+        "--poll", type=float, default=10, help="Seconds between directory scans (default: 10)"
+    )
+    parser.add_argument(
+        "--settle",
+        type=float,
+        default=5,
+        help="Seconds a new file must stay unchanged before it is queued (default: 5)",
+    )
+    parser.add_argument(
+        "--stages",
+        default=",".join(STAGES),
+        help="Steps after a file is translated (default: check,join,html; empty for none)",
+    )
+    parser.add_argument(
+        "--template",
+        default="./tpo_html_template.html",
+        help="HTML template for gen_tpo_html.py (default: ./tpo_html_template.html)",
+    )
+    parser.add_argument(
+        "--fake",
+        type=float,
+        default=None,
+        metavar="SECONDS",
+        help="Don't call the API: return each chunk unchanged after SECONDS (for local testing)",
+    )
+    parser.add_argument(
+        "--metrics-port",
+        type=int,
+        default=None,
+        help="Serve live metrics on this local port (/metrics, /status)",
+    )
+    args = parser.parse_args()
+
+    if args.fake is None:
+        set_gemini_key_file(args.key_file[0])
+    if args.profiles:
+        lanes = load_profiles(args.profiles)
+    else:
+        lanes = [TranslationProfile(key_file=k) for k in args.key_file]
+    if args.fake is not None:
+        for lane in lanes:
+            lane.translate = fake_translate(args.fake)
+    lanes_by_transno = {lane.transno: lane for lane in lanes}
+
+    queue = JobQueue(args.queue)
+    stages = Stages(
+        queue,
+        list(lanes_by_transno),
+        [s for s in args.stages.split(",") if s in STAGES],
+        args.template,
+    )
+    worker = QueueWorker(
+        queue,
+        lanes,
+        args.concurrency,
+        lease_seconds=DEFAULT_LEASE_SECONDS,
+        on_finished=stages.file_finished,
+    )
+    if args.metrics_port:
+        start_metrics_server(args.metrics_port)
+    watcher = DirectoryWatcher(args.directory, args.pattern, args.poll, args.settle)
+    print(f"Watching {', '.join(args.directory)} for {args.pattern} ({watcher.mode}). Ctrl+C to stop.")
+
+    worker.serve(idle_wait=min(args.poll, 5))
+    try:
+        while True:
+            for path in watcher.scan():
+                digest = file_digest(path)
+                for lane in lanes_by_transno.values():
+                    worker.queue_file(path, lane, digest)
+            watcher.wait()
+    except KeyboardInterrupt:
+        print("\nStopping: chunks in progress are released when their lease expires.")
+        worker.stop()
+        stages.executor.shutdown(wait=True)